@@ -1,20 +1,28 @@
+import asyncio
 from abc import ABC, abstractmethod
+from copy import copy
 from datetime import datetime, timedelta
+from enum import IntEnum
 from pathlib import Path
 from threading import Event
 from time import time
-from typing import Any, Dict, List, Optional, Sequence, Union
+from typing import (Any, Awaitable, Callable, Dict, List, Optional, Sequence,
+                    Union)
+from uuid import uuid4
 
 import numpy as np
 import pandas as pd
 import pytz
+from fastapi import HTTPException
 from fastapi.responses import FileResponse, PlainTextResponse
 from loguru import logger
 from openpyxl.styles import Alignment, Border, Side
 from pandas import DataFrame
+from playwright.async_api import Error as PlaywrightError
 from playwright.async_api import async_playwright
 from playwright_stealth import Stealth
 from pymongo.database import Database
+from pymongo.errors import PyMongoError
 from pymongo.results import InsertManyResult
 
 from config import settings
@@ -23,6 +31,14 @@ from utils import (_get_db_instance, _handle_exists_collection,
                    save_url)
 
 
+class BrowserNeed(IntEnum):
+    """Нужен ли парсеру браузер: не нужен, нужен иногда (запускается при первом обращении) или нужен всегда"""
+
+    NONE: int = 1
+    LAZY: int = 2
+    REQUIRED: int = 3
+
+
 class ParserBase(ABC):
 
     @abstractmethod
@@ -43,6 +59,11 @@ class ParserBase(ABC):
 
 
 class Parser(ParserBase):
+    browser_need: BrowserNeed = BrowserNeed.REQUIRED
+    # только дописать слепок в History, без чтения всей истории и сборки excel
+    history_only: bool = False
+    _log_names: set = set()
+
     def __init__(self, is_running: Event):
         self._value = None
         self.radio_period = '24 часа'
@@ -57,7 +78,10 @@ class Parser(ParserBase):
         self._url = None
         self._path = None
         self.logger = logger
-        self.logger.add(f'logs/{self.name}.log', filter=self.parser_log_filter)
+        if self.name not in self._log_names:
+            # второй экземпляр парсера (например, для слепков) пишет в тот же файл без дублирования строк
+            self._log_names.add(self.name)
+            self.logger.add(f'logs/{self.name}.log', filter=self.parser_log_filter)
         self._now_msk = None
 
     def read_mongo(
@@ -210,6 +234,20 @@ class Parser(ParserBase):
     def is_running(self):
         return self._is_running.is_set()
 
+    def copy_for_run(self) -> 'Parser':
+        """копия парсера для одного запуска: настройки формы на момент постановки и свое состояние запуска"""
+
+        parser = copy(self)
+        parser._is_running = Event()
+        parser._count_links = None
+        parser._count_processed_links = None
+        parser._elapsed_time = None
+        parser._eta = None
+        parser._status = None
+        parser._path = None
+        parser._now_msk = None
+        return parser
+
     @property
     def now_msk(self):
         return self._now_msk
@@ -304,6 +342,24 @@ class Parser(ParserBase):
             self._eta = (len(links) - (i + 1)) * delta
             start = end
 
+    def update_progress(self, count_processed: int, started_at: float):
+        """Обновляет счетчик и оценку оставшегося времени, когда ссылки обрабатываются параллельно"""
+
+        self.count_processed_links = count_processed
+        if self._count_links and count_processed:
+            self._eta = (self._count_links - count_processed) * (time() - started_at) / count_processed
+
+    def get_progress(self) -> Dict[str, Any]:
+        """прогресс запуска числами, для GET /jobs/{id}"""
+
+        return {
+            'status': self._status,
+            'count_links': self._count_links,
+            'count_processed_links': self._count_processed_links,
+            'elapsed_time': time() - self._elapsed_time if self._elapsed_time else None,
+            'eta': self._eta,
+        }
+
     @property
     def eta(self):
         if self._eta:
@@ -455,6 +511,10 @@ class Parser(ParserBase):
             ).round(2)
             df['Дата'] = df['Дата'].dt.tz_localize(None)
             df['Дата слепка, МСК'] = df['Дата слепка, МСК'].dt.tz_localize(None)
+            if self.history_only:
+                self.to_mongo(df, 'History', settings.MONGO_URL.encoded_string(), if_exists='append', index=False)
+                self.status = f'Слепок сохранен в History: {len(df)}'
+                return PlainTextResponse(f'Слепок сохранен в History: {len(df)}')
             older_df = pd.DataFrame(columns=columns)
             if not settings.DEBUG:
                 older_df = self.read_mongo('History', [], settings.MONGO_URL.encoded_string())
@@ -553,11 +613,198 @@ class Parser(ParserBase):
         return result
 
 
+BROWSER_USER_DATA_DIR = Path('browser')
+BROWSER_LAUNCH_OPTIONS = {
+    'channel': 'chrome',
+    'headless': False,
+    'args': [
+        '--start-maximized',
+        '--disable-blink-features=AutomationControlled'
+    ],
+    'screen': {
+        "width": 1920,
+        "height": 1080
+    },
+    'viewport': {
+        "width": 1920,
+        "height": 1080
+    },
+}
+
+
+class BrowserLease:
+    """Контекст браузера, выданный одному запуску
+
+    Остальные атрибуты берутся из контекста. close закрывает только страницы, открытые запуском,
+    сам Chrome остается запущенным для следующих запусков.
+    """
+
+    def __init__(self, service: 'BrowserService', context):
+        self._service = service
+        self._context = context
+        self._pages = []
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    async def new_page(self):
+        page = await self._context.new_page()
+        self._pages.append(page)
+        self._service.count_pages += 1
+        return page
+
+    async def close(self):
+        pages, self._pages = self._pages, []
+        for page in pages:
+            if not page.is_closed():
+                await page.close()
+
+
+class BrowserService:
+    """Долгоживущий Chrome с профилем browser/, общий для запусков парсеров
+
+    Chrome запускается при старте приложения, запуски получают его контекст через acquire,
+    не более pool_size одновременно. Перед выдачей контекст проверяется запросом cookies
+    и перезапускается, если Chrome упал. После max_pages открытых страниц Chrome
+    перезапускается при следующей выдаче, чтобы ограничить рост памяти.
+    """
+
+    health_timeout: int = 10
+
+    def __init__(self, max_pages: int = 200, pool_size: int = 1):
+        self.max_pages = max_pages
+        self.pool_size = pool_size
+        self.count_pages = 0
+        self._leases = 0
+        self._ctx_browser = None
+        self._context = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._semaphore = asyncio.Semaphore(self.pool_size)
+        return self._lock
+
+    async def _launch(self):
+        (BROWSER_USER_DATA_DIR / Path('SingletonLock')).unlink(missing_ok=True)
+        self._ctx_browser = Stealth().use_async(async_playwright())
+        p = await self._ctx_browser.__aenter__()
+        self._context = await p.chromium.launch_persistent_context(
+            user_data_dir=BROWSER_USER_DATA_DIR,
+            **BROWSER_LAUNCH_OPTIONS
+        )
+        self.count_pages = 0
+
+    async def _close(self):
+        context, ctx_browser = self._context, self._ctx_browser
+        self._context = None
+        self._ctx_browser = None
+        try:
+            if context is not None:
+                await context.close()
+        except PlaywrightError:
+            logger.exception('Ошибка закрытия браузера')
+        finally:
+            if ctx_browser is not None:
+                await ctx_browser.__aexit__(None, None, None)
+
+    async def is_alive(self) -> bool:
+        if self._context is None:
+            return False
+        try:
+            await asyncio.wait_for(self._context.cookies(), timeout=self.health_timeout)
+        except (PlaywrightError, asyncio.TimeoutError):
+            logger.exception('Браузер не отвечает')
+            return False
+        return True
+
+    async def start(self):
+        """Запускает Chrome заранее, ошибка запуска не мешает старту приложения: повтор при первой выдаче"""
+
+        try:
+            async with self._get_lock():
+                if not await self.is_alive():
+                    await self._launch()
+        except Exception:
+            logger.exception('Не удалось запустить браузер')
+
+    async def acquire(self) -> BrowserLease:
+        lock = self._get_lock()
+        await self._semaphore.acquire()
+        try:
+            async with lock:
+                if self._context is not None and self.count_pages >= self.max_pages and not self._leases:
+                    logger.info(f'Открыто страниц: {self.count_pages}, перезапускаем браузер')
+                    await self._close()
+                if not await self.is_alive():
+                    await self._close()
+                    await self._launch()
+                self._leases += 1
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return BrowserLease(self, self._context)
+
+    async def release(self, lease: BrowserLease):
+        try:
+            await lease.close()
+        except PlaywrightError:
+            logger.exception('Ошибка закрытия страниц запуска')
+        finally:
+            self._leases -= 1
+            self._semaphore.release()
+
+    async def stop(self):
+        async with self._get_lock():
+            await self._close()
+
+
+class LazyBrowser:
+    """Браузер, который запускается при первом обращении к нему"""
+
+    def __init__(self, launch: Callable[[], Awaitable[Any]]):
+        self._launch = launch
+        self._browser = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_started(self) -> bool:
+        return self._browser is not None
+
+    async def get(self):
+        async with self._lock:
+            if self._browser is None:
+                self._browser = await self._launch()
+        return self._browser
+
+    async def new_page(self):
+        return await (await self.get()).new_page()
+
+    async def add_cookies(self, cookies):
+        return await (await self.get()).add_cookies(cookies)
+
+    async def close(self):
+        if self._browser is not None:
+            await self._browser.close()
+
+
 class BrowserManager:
-    def __init__(self, is_running: Event, parser: Parser):
+    """Запуск парсера с браузером по parser.browser_need
+
+    Для BrowserNeed.NONE Chrome не запускается и parse получает None, для BrowserNeed.LAZY -
+    LazyBrowser, который запускает Chrome при первом использовании. is_started - запуск
+    принадлежит этому менеджеру, а не отклонен из-за уже идущего парсинга.
+    """
+
+    def __init__(self, is_running: Event, parser: Parser, service: Optional[BrowserService] = None):
         self._is_running = is_running
         self._parser = parser
+        self._service = service
+        self._lease: Optional[BrowserLease] = None
         self._ctx_browser = None
+        self.is_started = False
 
     @property
     def parser(self):
@@ -567,41 +814,471 @@ class BrowserManager:
     def is_running(self):
         return self._is_running.is_set()
 
+    async def launch_browser(self):
+        if self._service is not None:
+            self._lease = await self._service.acquire()
+            return self._lease
+        singleton_lock_file = BROWSER_USER_DATA_DIR / Path('SingletonLock')
+        if singleton_lock_file.exists():
+            singleton_lock_file.unlink()
+        self._ctx_browser = Stealth().use_async(async_playwright())
+        p = await self._ctx_browser.__aenter__()
+        return await p.chromium.launch_persistent_context(
+            user_data_dir=BROWSER_USER_DATA_DIR,
+            base_url=self.parser.url,
+            **BROWSER_LAUNCH_OPTIONS
+        )
+
     async def __aenter__(self):
-        if not self.is_running:
-            singleton_lock_file = Path('browser/SingletonLock')
-            if singleton_lock_file.exists():
-                singleton_lock_file.unlink()
-            self._ctx_browser = Stealth().use_async(async_playwright())
-            p = await self._ctx_browser.__aenter__()
-            browser = await p.chromium.launch_persistent_context(
-                user_data_dir='browser/',
-                channel='chrome',
-                headless=False,
-                args=[
-                    '--start-maximized',
-                    '--disable-blink-features=AutomationControlled'
-                ],
-                base_url=self.parser.url,
-                screen={
-                    "width": 1920,
-                    "height": 1080
-                },
-                viewport={
-                    "width": 1920,
-                    "height": 1080
-                }
-            )
-            self._is_running.set()
-            return browser
+        if self.is_running:
+            return None
+        self._is_running.set()
+        self.is_started = True
+        browser_need = self.parser.browser_need
+        if browser_need == BrowserNeed.NONE:
+            return None
+        if browser_need == BrowserNeed.LAZY:
+            return LazyBrowser(self.launch_browser)
+        try:
+            return await self.launch_browser()
+        except BaseException:
+            await self._release()
+            raise
 
     async def parse(self, browser):
         self.parser.start()
         result = await self.parser.parse(browser)
         return result
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
+    async def _release(self, exc_type=None, exc_val=None, exc_tb=None):
         self._is_running.clear()
-        self.parser.stop()
+        self.is_started = False
+        if self._lease is not None:
+            await self._service.release(self._lease)
+            self._lease = None
         if self._ctx_browser:
             await self._ctx_browser.__aexit__(exc_type, exc_val, exc_tb)
+            self._ctx_browser = None
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.is_started:
+            self.parser.stop()
+            await self._release(exc_type, exc_val, exc_tb)
+
+
+class JobState(IntEnum):
+    QUEUED: int = 1
+    RUNNING: int = 2
+    DONE: int = 3
+    FAILED: int = 4
+
+
+class Job:
+    """Один запуск парсера: свое состояние, время постановки, начала и окончания, результат или ошибка
+
+    template - парсер формы или слепка, parser - его копия, которая выполняет этот запуск.
+    """
+
+    def __init__(self, template: Parser):
+        self.id = uuid4().hex
+        self.template = template
+        self.parser = template.copy_for_run()
+        self.state = JobState.QUEUED
+        self.created_at = time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.progress: Dict[str, Any] = dict()
+        self._done = asyncio.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in (JobState.DONE, JobState.FAILED)
+
+    async def wait(self):
+        """возвращает результат запуска, ошибку запуска пробрасывает"""
+
+        await self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def get_result_info(self) -> Optional[Dict[str, str]]:
+        if isinstance(self.result, FileResponse):
+            return {'path': str(self.result.path), 'filename': self.result.filename}
+        if isinstance(self.result, PlainTextResponse):
+            return {'text': self.result.body.decode()}
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """метаданные запуска для GET /jobs/{id} и коллекции Jobs"""
+
+        progress = self.parser.get_progress() if self.state == JobState.RUNNING else self.progress
+        return {
+            'id': self.id,
+            'parser': self.parser.name,
+            'state': self.state.name,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': progress,
+            'error': str(self.error) if self.error is not None else None,
+            'result': self.get_result_info(),
+        }
+
+
+class JobScheduler:
+    """Очередь запусков парсеров вместо одного общего флага is_running
+
+    Парсер выполняет не больше одного запуска за раз, следующие ждут в очереди по порядку.
+    Парсеры, которым браузер нужен всегда, занимают один из max_browser_jobs слотов профиля
+    browser/, остальные - один из max_http_jobs слотов: запуск xlite не ждет запуска fhbstat.
+    Ленивому браузеру очередь к Chrome обеспечивает BrowserService.
+
+    С persist=True метаданные запусков сохраняются в коллекцию Jobs, а файлы результатов
+    переносятся в files/jobs, где их не удалит следующий запуск парсера: результат можно
+    скачивать повторно и после перезапуска сервера, пока не истек JOB_RESULT_TTL.
+    """
+
+    max_finished_jobs: int = 100
+    collection_name: str = 'Jobs'
+    results_dir: Path = Path('files') / Path('jobs')
+
+    def __init__(
+        self,
+        service: Optional[BrowserService] = None,
+        max_http_jobs: int = 4,
+        max_browser_jobs: int = 1,
+        persist: bool = False,
+    ):
+        self.service = service
+        self.max_http_jobs = max_http_jobs
+        self.max_browser_jobs = max_browser_jobs
+        self.jobs: Dict[str, Job] = dict()
+        self._parser_locks: Dict[str, asyncio.Lock] = dict()
+        self._http_semaphore: Optional[asyncio.Semaphore] = None
+        self._browser_semaphore: Optional[asyncio.Semaphore] = None
+        self._persist = persist
+        self._collection = None
+
+    def get_resource(self, parser: Parser) -> asyncio.Semaphore:
+        if self._http_semaphore is None:
+            self._http_semaphore = asyncio.Semaphore(self.max_http_jobs)
+            self._browser_semaphore = asyncio.Semaphore(self.max_browser_jobs)
+        if parser.browser_need == BrowserNeed.REQUIRED:
+            return self._browser_semaphore
+        return self._http_semaphore
+
+    def get_jobs(self, parser: Parser) -> List[Job]:
+        return [job for job in self.jobs.values() if job.template is parser and not job.is_finished]
+
+    def get_last_job(self, parser: Parser) -> Optional[Job]:
+        """последний начатый запуск парсера: идущий, а если его нет - последний завершенный"""
+
+        for job in reversed(self.jobs.values()):
+            if job.template is parser and job.state != JobState.QUEUED:
+                return job
+        return None
+
+    def is_busy(self, parser: Parser) -> bool:
+        return bool(self.get_jobs(parser))
+
+    def _get_collection(self):
+        if self._collection is None:
+            db = _get_db_instance(settings.MONGO_URL.encoded_string())
+            collection = db[self.collection_name]
+            collection.create_index('finished_at')
+            self._collection = collection
+        return self._collection
+
+    def _save(self, job_data: Dict[str, Any]):
+        self._get_collection().replace_one({'_id': job_data['id']}, {'_id': job_data['id'], **job_data}, upsert=True)
+
+    def _load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._get_collection().find_one({'_id': job_id}, {'_id': False})
+
+    def _remove_expired(self):
+        finished_before = time() - settings.JOB_RESULT_TTL
+        collection = self._get_collection()
+        query = {'finished_at': {'$lt': finished_before}}
+        for job_data in collection.find(query, {'result': True}):
+            self.remove_result(job_data.get('result'))
+        collection.delete_many(query)
+
+    async def persist(self, func: Callable, *args):
+        if not self._persist:
+            return None
+        try:
+            return await asyncio.to_thread(func, *args)
+        except PyMongoError:
+            logger.exception('Mongo недоступна, запуски парсеров не сохраняются')
+            self._persist = False
+        return None
+
+    @staticmethod
+    def remove_result(result: Optional[Dict[str, str]]):
+        if result and result.get('path'):
+            Path(result['path']).unlink(missing_ok=True)
+
+    def keep_result(self, job: Job):
+        """переносит файл результата из files/, где его удалит следующий запуск парсера, в files/jobs"""
+
+        if isinstance(job.result, FileResponse) and Path(job.result.path).exists():
+            self.results_dir.mkdir(parents=True, exist_ok=True)
+            path = Path(job.result.path).rename(self.results_dir / Path(f'{job.id}{Path(job.result.path).suffix}'))
+            job.result = FileResponse(path, filename=job.result.filename)
+
+    def submit(self, parser: Parser) -> Job:
+        """Ставит запуск парсера в очередь и сразу возвращает его Job, запуск выполняет копия парсера"""
+
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            job = self.jobs.pop(job_id)
+            if not self._persist:
+                self.remove_result(job.get_result_info())
+        job = Job(parser)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    async def run(self, parser: Parser):
+        """Запускает парсер через очередь и дожидается результата"""
+
+        return await self.submit(parser).wait()
+
+    async def get_job_data(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """метаданные запуска из памяти, а запусков прошлых процессов - из Mongo"""
+
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        job_data = await self.persist(self._load, job_id)
+        if job_data and job_data['state'] not in (JobState.DONE.name, JobState.FAILED.name):
+            job_data['state'] = JobState.FAILED.name
+            job_data['error'] = 'Запуск прерван перезапуском сервера'
+        return job_data
+
+    async def get_result_response(self, job_id: str) -> (FileResponse | PlainTextResponse):
+        job_data = await self.get_job_data(job_id)
+        if job_data is None:
+            raise HTTPException(status_code=404, detail='Запуск не найден')
+        if job_data['state'] != JobState.DONE.name:
+            raise HTTPException(status_code=409, detail=f'Запуск не завершен: {job_data["state"]}')
+        result = job_data['result'] or {'text': 'Нет данных'}
+        if 'path' in result:
+            if not Path(result['path']).exists():
+                raise HTTPException(status_code=404, detail='Файл результата удален')
+            return FileResponse(result['path'], filename=result['filename'])
+        return PlainTextResponse(result['text'])
+
+    async def _run(self, job: Job):
+        parser = job.parser
+        parser_lock = self._parser_locks.setdefault(parser.name, asyncio.Lock())
+        await self.persist(self._remove_expired)
+        await self.persist(self._save, job.to_dict())
+        try:
+            async with parser_lock, self.get_resource(parser):
+                job.state = JobState.RUNNING
+                job.started_at = time()
+                await self.persist(self._save, job.to_dict())
+                b_manager = BrowserManager(is_running=parser._is_running, parser=parser, service=self.service)
+                async with b_manager as browser:
+                    job.result = await b_manager.parse(browser)
+                    job.progress = parser.get_progress()
+                self.keep_result(job)
+        except BaseException as exc:
+            job.state = JobState.FAILED
+            job.error = exc
+            job.progress = parser.get_progress()
+            if not isinstance(exc, asyncio.CancelledError):
+                parser.logger.exception('Ошибка запуска')
+        else:
+            job.state = JobState.DONE
+        finally:
+            job.finished_at = time()
+            job._done.set()
+            await self.persist(self._save, job.to_dict())
+
+
+class ParserView:
+    """Парсер формы для привязок интерфейса: состояние запуска читается у последнего запуска
+
+    Настройки формы по-прежнему привязываются к самому парсеру, а метки прогресса - к ParserView.
+    """
+
+    def __init__(self, scheduler: JobScheduler, parser: Parser):
+        self.scheduler = scheduler
+        self.template = parser
+
+    @property
+    def parser(self) -> Parser:
+        job = self.scheduler.get_last_job(self.template)
+        return self.template if job is None else job.parser
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+
+class CronSpec:
+    """Расписание cron из пяти полей: минута, час, день месяца, месяц, день недели (0 и 7 - воскресенье)
+
+    Поле - *, число, диапазон a-b или список через запятую, у каждого может быть шаг: */15, 8-20/2.
+    """
+
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != len(self.ranges):
+            raise ValueError(f'В расписании "{spec}" должно быть 5 полей')
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, self.ranges)
+        )
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, stop = low, high
+            elif '-' in part:
+                start, stop = map(int, part.split('-'))
+            else:
+                start = stop = int(part)
+                if step:
+                    stop = high
+            if not low <= start <= stop <= high:
+                raise ValueError(f'Значение "{field}" вне диапазона {low}-{high}')
+            values.update(range(start, stop + 1, int(step) if step else 1))
+        return values
+
+    def match_day(self, dt: datetime) -> bool:
+        day_matched = dt.day in self.days
+        weekday_matched = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_matched and weekday_matched
+        return day_matched or weekday_matched
+
+    def get_next(self, after: datetime) -> datetime:
+        """ближайшее время запуска строго после after, с точностью до минуты"""
+
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months or not self.match_day(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f'По расписанию "{self.spec}" нет ни одного запуска')
+
+
+class Snapshot:
+    """Периодический слепок парсера в History по расписанию cron"""
+
+    def __init__(self, parser: Parser, cron: str, radio_period: str):
+        parser.history_only = True
+        parser.radio_period = radio_period
+        self.parser = parser
+        self.cron = CronSpec(cron)
+        self.next_run: Optional[datetime] = None
+        self.job: Optional[Job] = None
+        self.last_duration: Optional[float] = None
+        self.last_state: Optional[JobState] = None
+
+    @property
+    def is_active(self) -> bool:
+        return self.job is not None and not self.job.is_finished
+
+    def update_last_run(self):
+        if self.job is not None and self.job.is_finished and self.job.started_at:
+            self.last_duration = self.job.finished_at - self.job.started_at
+            self.last_state = self.job.state
+
+    @property
+    def info(self):
+        next_run = self.next_run.strftime('%d.%m.%Y %H:%M') if self.next_run else '--'
+        if self.is_active:
+            last_run = 'выполняется'
+        elif self.last_duration is not None:
+            last_run = f'{round(self.last_duration)} сек. ({self.last_state.name})'
+        else:
+            last_run = '--'
+        return (
+            f'Слепок History за "{self.parser.radio_period}" ({self.cron.spec}): '
+            f'следующий {next_run}, прошлый {last_run}'
+        )
+
+
+class SnapshotScheduler:
+    """Запуск слепков парсеров в History по расписанию, без excel
+
+    Слепки идут через JobScheduler вместе с запусками из интерфейса и занимают те же слоты.
+    Пока слепок не закончился, следующие срабатывания его расписания не ставят новый запуск,
+    а одновременно в очереди и в работе не больше max_jobs слепков: срабатывание, которому
+    не хватило бюджета, выполняется, когда слот освободится.
+    """
+
+    check_interval: int = 30
+
+    def __init__(self, scheduler: JobScheduler, max_jobs: int = 1):
+        self.scheduler = scheduler
+        self.max_jobs = max_jobs
+        self.snapshots: List[Snapshot] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def now() -> datetime:
+        return datetime.now(tz=pytz.timezone('Europe/Moscow'))
+
+    def add(self, parser: Parser, cron: str, radio_period: str) -> Snapshot:
+        snapshot = Snapshot(parser, cron, radio_period)
+        snapshot.next_run = snapshot.cron.get_next(self.now())
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    def get_snapshots(self, parser: Parser) -> List[Snapshot]:
+        return [snapshot for snapshot in self.snapshots if snapshot.parser.name == parser.name]
+
+    def tick(self, now: Optional[datetime] = None) -> List[Job]:
+        """ставит в очередь слепки, время которых подошло, и возвращает их запуски"""
+
+        now = now or self.now()
+        for snapshot in self.snapshots:
+            snapshot.update_last_run()
+        jobs = []
+        count_active = sum(snapshot.is_active for snapshot in self.snapshots)
+        # дольше всех ждущий слепок первым, чтобы частое расписание не занимало весь бюджет
+        for snapshot in sorted(self.snapshots, key=lambda snapshot: snapshot.next_run):
+            if snapshot.is_active or now < snapshot.next_run:
+                continue
+            if count_active >= self.max_jobs:
+                break
+            snapshot.job = self.scheduler.submit(snapshot.parser)
+            snapshot.next_run = snapshot.cron.get_next(now)
+            count_active += 1
+            jobs.append(snapshot.job)
+        return jobs
+
+    async def _loop(self):
+        while True:
+            self.tick()
+            await asyncio.sleep(self.check_interval)
+
+    async def start(self):
+        if self.snapshots and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,74 @@
+"""Замер заполнения шаблона excel fhbstat на 10 000 строк результата
+
+Запуск из корня проекта: python -m benchmarks.fhbstat_excel
+"""
+import random
+from pathlib import Path
+from threading import Event
+from time import time
+
+import numpy as np
+from xlsxtpl.writerx import BookWriter
+
+from parsers.fhbstat import FHBBookWriter, FHBParser
+
+TEMPLATE_PATH = Path(__file__).parent.parent / Path('excel_templates') / Path('templates.xlsx')
+FILTERS_PATH = Path(__file__).parent.parent / Path('tests') / Path('data') / Path('П1 (футбол)  новый парсер.json')
+
+
+def get_rows(fhbstat_parser: FHBParser, count_rows: int):
+    """Строки результата блоками матчей, как их собирает FHBParser.parse_matches"""
+
+    rows = []
+    index = 0
+    while len(rows) < count_rows:
+        index += 1
+        for _ in fhbstat_parser.user_filters.root:
+            rows.append({
+                'index': index,
+                '1': 19,
+                '2': 12,
+                '3': 2025,
+                '4': '23:45',
+                '9': 'asdfasdf',
+                '10': 'zxcvzxcv',
+                'url': 'https://fhbstat.com/football?1=19&2=12&3=2025',
+                'Количество матчей': random.randint(1, 10),
+                **{
+                    str(column): random.choice((np.nan, random.uniform(0.2, 10.0)))
+                    for column in range(11, fhbstat_parser.count_columns)
+                }
+            })
+        for sym in ('%', 'кф', 'мо'):
+            rows.append({'index': index, 'Количество матчей': sym})
+    return rows
+
+
+def render(writer_cls, rows, tpl_idx, sheet_name):
+    writer = writer_cls(TEMPLATE_PATH)
+    writer.render_book2([{'tpl_idx': tpl_idx, 'sheet_name': sheet_name, 'ctx': {'rows': rows}}])
+
+
+def main(count_rows: int = 10000):
+    fhbstat_parser = FHBParser(is_running=Event())
+    fhbstat_parser.upload_filters_from_json(FILTERS_PATH)
+    rows = get_rows(fhbstat_parser, count_rows)
+    _, sheet_name, tpl_idx = FHBParser.get_excel_template('/football')
+    print(f'{len(rows)} строк, лист {sheet_name}')
+    for name, writer_cls in (('xlsxtpl BookWriter', BookWriter), ('FHBBookWriter', FHBBookWriter)):
+        started_at = time()
+        render(writer_cls, rows, tpl_idx, sheet_name)
+        print(f'    render_book2 {name}: {time() - started_at:.2f} сек.')
+    fhbstat_parser.start()
+    for fast_excel in (False, True):
+        fhbstat_parser.fast_excel = fast_excel
+        fhbstat_parser.file_name = f'benchmark_fast_excel_{fast_excel}'
+        started_at = time()
+        response = fhbstat_parser.get_file_response(rows, '/football')
+        print(f'    get_file_response fast_excel={fast_excel}: {time() - started_at:.2f} сек.')
+        Path(response.path).unlink()
+    fhbstat_parser.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""Замер разбора страниц fhbstat на html из tests/data
+
+Запуск из корня проекта: python -m benchmarks.fhbstat_parse
+"""
+from pathlib import Path
+from timeit import repeat
+
+from parsers.fhbstat import FHBParser
+
+DATA_PATH = Path(__file__).parent.parent / Path('tests') / Path('data')
+
+
+def two_pass(content):
+    table_rows, first_data_index, names = FHBParser.get_head_data(content)
+    FHBParser._get_content_df(table_rows, first_data_index, names)
+    table_rows, first_data_index, names = FHBParser.get_head_data(content)
+    FHBParser._get_head_df(table_rows, first_data_index, names)
+
+
+def single_pass(content):
+    FHBParser.parse_page(content, fast=False)
+
+
+def columnar(content):
+    FHBParser.parse_page(content)
+
+
+def columnar_subset(content):
+    FHBParser.parse_page(content, columns=FHBParser.get_columns_by_target('/football'))
+
+
+def main(number: int = 5):
+    for file_path in sorted(DATA_PATH.glob('FHB_*.html')):
+        content = file_path.read_text()
+        print(file_path.name)
+        for name, func in (
+            ('parse_content + parse_head_table (bs4)', two_pass),
+            ('parse_page (bs4)', single_pass),
+            ('parse_page (lxml)', columnar),
+            ('parse_page (lxml, колонки цели)', columnar_subset),
+        ):
+            timings = repeat(lambda: func(content), number=1, repeat=number)
+            print(f'    {name}: min {min(timings):.3f} сек., avg {sum(timings) / len(timings):.3f} сек.')
+
+
+if __name__ == '__main__':
+    main()
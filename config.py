@@ -11,6 +11,18 @@ class Settings(BaseSettings):
     ADMIN_USERNAME: str
     ADMIN_PASSWORD: str
     PORT: int = 8080
+    BROWSER_MAX_PAGES: int = 200
+    MAX_HTTP_JOBS: int = 4
+    JOB_RESULT_TTL: int = 604800
+
+    MARATHONBET_SNAPSHOT_CRON: Optional[str] = None
+    MARATHONBET_SNAPSHOT_PERIOD: str = '24 часа'
+    XLITE_SNAPSHOT_CRON: Optional[str] = None
+    XLITE_SNAPSHOT_PERIOD: str = 'Ближайшие 24 часа'
+    SNAPSHOT_MAX_JOBS: int = 1
+
+    FHBSTAT_QUERY_CACHE_TTL: Optional[int] = None
+    BET_BAZA_CACHE_TTL: Optional[int] = None
 
     TEST_FHBSTAT_USERNAME: Optional[str] = None
     TEST_FHBSTAT_PASSWORD: Optional[str] = None
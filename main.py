@@ -1,51 +1,129 @@
 from threading import Event
 from typing import Optional
 
+from fastapi import HTTPException
 from fastapi.responses import RedirectResponse
 from nicegui import app, ui
 
-from base import BrowserManager
-from beta_baza import parse_bet_baza  # noqa:F401
+from base import (BrowserService, JobScheduler, Parser, ParserView,
+                  SnapshotScheduler)
 from config import settings
-from parsers.fhbstat import FHBParser, FieldType
+from parsers.betbaza import BetBazaParser
+from parsers.fhbstat import ExcelValues, FHBParser, FieldType
 from parsers.marathonbet import MarathonbetParser
 from parsers.xlite import XLiteParser
 from utils import AuthMiddleware
 
 app.add_middleware(AuthMiddleware)
 
-is_running = Event()
-
-
-marathonbet_parser = MarathonbetParser(is_running=is_running)
-xlite_parser = XLiteParser(is_running=is_running)
-fhbstat_parser = FHBParser(is_running=is_running)
+browser_service = BrowserService(max_pages=settings.BROWSER_MAX_PAGES)
+app.on_startup(browser_service.start)
+app.on_shutdown(browser_service.stop)
+scheduler = JobScheduler(service=browser_service, max_http_jobs=settings.MAX_HTTP_JOBS, persist=True)
+
+marathonbet_parser = MarathonbetParser(is_running=Event())
+xlite_parser = XLiteParser(is_running=Event())
+fhbstat_parser = FHBParser(is_running=Event())
+bet_baza_parser = BetBazaParser(is_running=Event())
+# каждый запуск выполняет копия парсера, метки прогресса читают состояние последнего запуска
+marathonbet_view = ParserView(scheduler, marathonbet_parser)
+xlite_view = ParserView(scheduler, xlite_parser)
+fhbstat_view = ParserView(scheduler, fhbstat_parser)
+bet_baza_view = ParserView(scheduler, bet_baza_parser)
+app.on_startup(fhbstat_parser.preload_templates)
+app.on_shutdown(fhbstat_parser.close_sessions)
+
+snapshots = SnapshotScheduler(scheduler, max_jobs=settings.SNAPSHOT_MAX_JOBS)
+if settings.MARATHONBET_SNAPSHOT_CRON:
+    snapshots.add(
+        MarathonbetParser(is_running=Event()),
+        settings.MARATHONBET_SNAPSHOT_CRON,
+        settings.MARATHONBET_SNAPSHOT_PERIOD
+    )
+if settings.XLITE_SNAPSHOT_CRON:
+    snapshots.add(XLiteParser(is_running=Event()), settings.XLITE_SNAPSHOT_CRON, settings.XLITE_SNAPSHOT_PERIOD)
+app.on_startup(snapshots.start)
+app.on_shutdown(snapshots.stop)
 
 
 @app.get('/parse')
 async def parse():
-    b_manager = BrowserManager(is_running=is_running, parser=marathonbet_parser)
-    async with b_manager as browser:
-        if browser:
-            response = await b_manager.parse(browser)
-            return response
+    response = await scheduler.run(marathonbet_parser)
+    return response
 
 
 @app.get('/parse_xlite')
 async def parse_xlite():
-    b_manager = BrowserManager(is_running=is_running, parser=xlite_parser)
-    async with b_manager as browser:
-        if browser:
-            response = await b_manager.parse(browser)
-            return response
+    response = await scheduler.run(xlite_parser)
+    return response
+
+
+@app.get('/parse_bet_baza')
+async def parse_bet_baza():
+    response = await scheduler.run(bet_baza_parser)
+    return response
+
+
+def submit_job(parser: Parser):
+    job = scheduler.submit(parser)
+    return {'id': job.id}
+
+
+@app.post('/parse')
+async def submit_parse():
+    return submit_job(marathonbet_parser)
+
+
+@app.post('/parse_xlite')
+async def submit_parse_xlite():
+    return submit_job(xlite_parser)
+
+
+@app.post('/parse_bet_baza')
+async def submit_parse_bet_baza():
+    return submit_job(bet_baza_parser)
+
+
+@app.post('/parse_fhbstat')
+async def submit_parse_fhbstat():
+    return submit_job(fhbstat_parser)
+
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str):
+    job_data = await scheduler.get_job_data(job_id)
+    if job_data is None:
+        raise HTTPException(status_code=404, detail='Запуск не найден')
+    return job_data
+
+
+@app.get('/jobs/{job_id}/result')
+async def get_job_result(job_id: str):
+    response = await scheduler.get_result_response(job_id)
+    return response
 
 
 def download(url):
     def wrapper():
-        if not is_running.is_set():
-            ui.download.from_url(url)
+        ui.download.from_url(url)
+    return wrapper
+
+
+def run_job(parser: Parser):
+    """Ставит запуск в очередь и скачивает результат по готовности: закрытая вкладка не теряет файл,
+    его можно скачать по /jobs/{id}/result"""
+
+    async def wrapper():
+        if scheduler.is_busy(parser):
+            ui.notify('Парсер уже запущен. Новый запуск поставлен в очередь и начнется после окончания текущего')
+        job = scheduler.submit(parser)
+        ui.notify(f'Запуск {job.id} поставлен в очередь')
+        try:
+            await job.wait()
+        except Exception as exc:
+            ui.notify(f'Запуск {job.id} завершился ошибкой: {exc}', type='negative')
         else:
-            ui.notify('В данный момент уже запущен процесс парсинга. Дождитесь его окончания, чтобы запустить новый')
+            ui.download.from_url(f'/jobs/{job.id}/result')
     return wrapper
 
 
@@ -58,12 +136,14 @@ async def parse_page():
         ['Всё время', '24 часа', 'Сегодня', '12 часов', '6 часов', '2 часа', '1 час'],
         value='24 часа'
     ).props('inline').bind_value(marathonbet_parser, 'radio_period')
-    ui.label('Количество ссылок: Вычисляем').bind_text(marathonbet_parser, 'count_links')
-    ui.label('Обработано ссылок: Вычисляем').bind_text(marathonbet_parser, 'count_processed_links')
-    ui.label('Прошло секунд: Вычисляем').bind_text_from(marathonbet_parser, 'elapsed_time')
-    ui.label('Осталось секунд: Вычисляем').bind_text_from(marathonbet_parser, 'eta')
-    ui.label('Статус: Вычисляем').bind_text_from(marathonbet_parser, 'status')
-    ui.button('Скачать excel', on_click=download('/parse'))
+    ui.label('Количество ссылок: Вычисляем').bind_text_from(marathonbet_view, 'count_links')
+    ui.label('Обработано ссылок: Вычисляем').bind_text_from(marathonbet_view, 'count_processed_links')
+    ui.label('Прошло секунд: Вычисляем').bind_text_from(marathonbet_view, 'elapsed_time')
+    ui.label('Осталось секунд: Вычисляем').bind_text_from(marathonbet_view, 'eta')
+    ui.label('Статус: Вычисляем').bind_text_from(marathonbet_view, 'status')
+    ui.button('Скачать excel', on_click=run_job(marathonbet_parser))
+    for snapshot in snapshots.get_snapshots(marathonbet_parser):
+        ui.label().bind_text_from(snapshot, 'info')
 
 
 @ui.page('/xlite_page')
@@ -82,23 +162,38 @@ async def xlite_page():
         ],
         value='Ближайшие 24 часа'
     ).props('inline').bind_value(xlite_parser, 'radio_period')
-    ui.label('Количество ссылок: Вычисляем').bind_text(xlite_parser, 'count_links')
-    ui.label('Обработано ссылок: Вычисляем').bind_text(xlite_parser, 'count_processed_links')
-    ui.label('Прошло секунд: Вычисляем').bind_text_from(xlite_parser, 'elapsed_time')
-    ui.label('Осталось секунд: Вычисляем').bind_text_from(xlite_parser, 'eta')
-    ui.label('Статус: Вычисляем').bind_text_from(xlite_parser, 'status')
-    ui.button('Скачать excel', on_click=download('/parse_xlite'))
+    ui.label('Количество ссылок: Вычисляем').bind_text_from(xlite_view, 'count_links')
+    ui.label('Обработано ссылок: Вычисляем').bind_text_from(xlite_view, 'count_processed_links')
+    ui.label('Прошло секунд: Вычисляем').bind_text_from(xlite_view, 'elapsed_time')
+    ui.label('Осталось секунд: Вычисляем').bind_text_from(xlite_view, 'eta')
+    ui.label('Статус: Вычисляем').bind_text_from(xlite_view, 'status')
+    ui.button('Скачать excel', on_click=run_job(xlite_parser))
+    for snapshot in snapshots.get_snapshots(xlite_parser):
+        ui.label().bind_text_from(snapshot, 'info')
+
+
+@ui.page('/bet_baza_page')
+async def bet_baza_page():
+    ui.page_title('Бет-База')
+    ui.label('Количество целей: Вычисляем').bind_text_from(bet_baza_view, 'count_links')
+    ui.label('Обработано целей: Вычисляем').bind_text_from(bet_baza_view, 'count_processed_links')
+    ui.label('Прошло секунд: Вычисляем').bind_text_from(bet_baza_view, 'elapsed_time')
+    ui.label('Осталось секунд: Вычисляем').bind_text_from(bet_baza_view, 'eta')
+    ui.label('Статус: Вычисляем').bind_text_from(bet_baza_view, 'status')
+    ui.button('Скачать excel', on_click=run_job(bet_baza_parser))
 
 
 @ui.page('/fhbstat_page')
 async def fhbstat_page():
     @app.get('/parse_fhbstat')
     async def _parse_fhbstat():
-        b_manager = BrowserManager(is_running=is_running, parser=fhbstat_parser)
-        async with b_manager as browser:
-            if browser:
-                response = await b_manager.parse(browser)
-                return response
+        response = await scheduler.run(fhbstat_parser)
+        return response
+
+    @app.get('/parse_fhbstat_partial')
+    async def _parse_fhbstat_partial():
+        response = await fhbstat_view.parser.get_partial_file_response()
+        return response
 
     @app.get('/download_filters')
     async def download_filters():
@@ -113,7 +208,7 @@ async def fhbstat_page():
 
     def upload():
         def wrapper():
-            if not is_running.is_set():
+            if not scheduler.is_busy(fhbstat_parser):
                 ui.upload(
                     on_upload=handle_upload
                 )
@@ -261,8 +356,28 @@ async def fhbstat_page():
         ui.number('Минимальное количество матчей', min=1, precision=0, step=1).bind_value(
             fhbstat_parser, 'min_count_matches'
         )
+        ui.number('Параллельных запросов', min=1, precision=0, step=1).bind_value(
+            fhbstat_parser, 'concurrent_queries'
+        )
+        ui.checkbox('Опережающие запросы понижений').bind_value(fhbstat_parser, 'speculative_prefetch')
+        ui.number('Лимит опережающих запросов', min=0, precision=0, step=1).bind_value(
+            fhbstat_parser, 'speculative_budget'
+        ).bind_visibility_from(fhbstat_parser, 'speculative_prefetch')
+        ui.checkbox('Локальная история матчей').bind_value(fhbstat_parser, 'history_mirror')
+        ui.checkbox('Запросы по истории, без колонок шапки').bind_value(
+            fhbstat_parser, 'history_queries'
+        ).bind_visibility_from(fhbstat_parser, 'history_mirror')
     with ui.row():
         ui.input('Название файла (без расширения)').bind_value(fhbstat_parser, 'file_name')
+        ui.select(
+            {
+                ExcelValues.FORMULAS: 'Формулы',
+                ExcelValues.VALUES: 'Значения',
+                ExcelValues.BOTH: 'Формулы и лист значений',
+            },
+            label='Итоги % и мо в excel'
+        ).bind_value(fhbstat_parser, 'excel_values')
+        ui.checkbox('Сохранять итоги в Mongo').bind_value(fhbstat_parser, 'store_aggregates')
     filters()
     ui.button('Очистить фильтр', on_click=clear_filters)
     with ui.input('Время с').bind_value(fhbstat_parser, 'from_time') as from_time:
@@ -280,13 +395,15 @@ async def fhbstat_page():
         with to_time.add_slot('append'):
             ui.icon('access_time').on('click', menu.open).classes('cursor-pointer')
     link()
-    ui.label('Обработано ссылок: Вычисляем').bind_text(fhbstat_parser, 'count_processed_links')
-    ui.label('Прошло секунд: Вычисляем').bind_text_from(fhbstat_parser, 'elapsed_time')
-    ui.label('Осталось секунд: Вычисляем').bind_text_from(fhbstat_parser, 'eta')
-    ui.label('Статус: Вычисляем').bind_text_from(fhbstat_parser, 'status')
-    ui.button('Скачать excel', on_click=download('/parse_fhbstat'))
+    ui.label('Обработано ссылок: Вычисляем').bind_text_from(fhbstat_view, 'count_processed_links')
+    ui.label('Прошло секунд: Вычисляем').bind_text_from(fhbstat_view, 'elapsed_time')
+    ui.label('Осталось секунд: Вычисляем').bind_text_from(fhbstat_view, 'eta')
+    ui.label('Статус: Вычисляем').bind_text_from(fhbstat_view, 'status')
+    ui.button('Скачать excel', on_click=run_job(fhbstat_parser))
+    ui.button('Скачать обработанные матчи', on_click=lambda: ui.download.from_url('/parse_fhbstat_partial'))
     ui.button('Скачать json-фильтров', on_click=download('/download_filters'))
     ui.button('Загрузить фильтры из файла', on_click=upload())
+    ui.button('Выйти с сайта', on_click=fhbstat_parser.close_sessions)
 
 
 @ui.page('/login')
@@ -310,7 +427,7 @@ def login(redirect_to: str = '/') -> Optional[RedirectResponse]:
 if __name__ in {"__main__", "__mp_main__"}:
     ui.page_title('Parser bet')
     ui.link('Получить excel', '/parse_page', new_tab=True)
-    ui.link('Получить данные Бет-База', '/parse_bet_baza', new_tab=True)
+    ui.link('Получить данные Бет-База', '/bet_baza_page', new_tab=True)
     ui.link('Получить 1xlite', '/xlite_page', new_tab=True)
     ui.link('fhbstat', '/fhbstat_page', new_tab=True)
     ui.run(
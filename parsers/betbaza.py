@@ -0,0 +1,269 @@
+import hashlib
+import json
+from asyncio import to_thread
+from datetime import datetime, timedelta
+from time import time
+from typing import Dict, List, Optional
+from urllib.parse import urljoin
+
+import numpy as np
+import pandas as pd
+import pytz
+from fastapi.responses import FileResponse, PlainTextResponse
+from playwright.async_api import Error as PlaywrightError
+from pymongo.errors import PyMongoError
+
+from base import Parser
+from config import settings
+from utils import _get_db_instance
+
+# Переход на страницу таблицы через DataTables API, промис завершается после перерисовки таблицы
+GO_TO_PAGE_JS = '''(pageIndex) => new Promise((resolve) => {
+    const node = document.querySelector('table[role="grid"]');
+    const table = window.jQuery ? window.jQuery(node).DataTable() : new DataTable(node);
+    if (table.page() === pageIndex) {
+        resolve(pageIndex);
+        return;
+    }
+    table.one('draw', () => resolve(table.page()));
+    table.page(pageIndex).draw('page');
+})'''
+# Таблица целиком за один вызов: имена колонок, innerText ячеек, текст ячеек без span (как get_text('\n', True)
+# в BeautifulSoup), зеленые ячейки (class="g") и цели - span с data-full >= 1 с номером строки и текстом ячейки
+EXTRACT_TABLE_JS = '''() => {
+    const table = document.querySelector('table[role="grid"]');
+    const getValue = (td) => {
+        const walker = document.createTreeWalker(td, NodeFilter.SHOW_TEXT);
+        const texts = [];
+        while (walker.nextNode()) {
+            const text = walker.currentNode.nodeValue.trim();
+            if (text) {
+                texts.push(text);
+            }
+        }
+        const value = texts.join('\\n');
+        const span = td.querySelector('span');
+        return span ? value.split(span.textContent).join('') : value;
+    };
+    const rows = Array.from(table.querySelectorAll('tbody > tr'));
+    return {
+        names: Array.from(table.querySelectorAll('thead > tr > th'), (th) => th.innerText),
+        rows: rows.map((tr) => {
+            const tds = Array.from(tr.querySelectorAll('td'));
+            return {
+                texts: tds.map((td) => td.innerText),
+                values: tds.map(getValue),
+                green: tds.map((td) => td.classList.length === 1 && td.classList.contains('g')),
+            };
+        }),
+        targets: Array.from(table.querySelectorAll('span[data-full]'))
+            .filter((span) => Number(span.dataset.full) >= 1)
+            .map((span) => ({row: rows.indexOf(span.closest('tr')), text: span.parentElement.innerText}))
+            .filter((target) => target.row >= 0),
+    };
+}'''
+
+
+class BetBazaParser(Parser):
+    """Двойники матчей bet-baza.pro: для каждого будущего матча с отметкой data-full отбираются
+    прошедшие матчи с теми же кф и считается доля зеленых исходов
+
+    Посчитанные строки сохраняются в Mongo и, если задан BET_BAZA_CACHE_TTL, переиспользуются
+    следующими запусками без повторного отбора на сайте.
+    """
+
+    login_name: str = 'omsk-forex'
+    password: str = '123456'
+    timeout: int = 180000
+    collection_name: str = 'BetBaza'
+    empty_info_text: str = 'Записи с 0 до 0 из 0 записей'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._url = 'https://bet-baza.pro/main'
+        self._collection = None
+        self._persist: bool = True
+
+    def parser_log_filter(self, record):
+        return __name__ == record['name']
+
+    def _get_collection(self):
+        if self._collection is None:
+            db = _get_db_instance(settings.MONGO_URL.encoded_string())
+            collection = db[self.collection_name]
+            collection.create_index('updated_at')
+            self._collection = collection
+        return self._collection
+
+    @staticmethod
+    def get_target_id(row_texts: List[str]) -> str:
+        """возвращает ключ строки цели по текстам всех ее ячеек, включая кф"""
+
+        return hashlib.sha256(json.dumps(row_texts, ensure_ascii=False).encode()).hexdigest()
+
+    def _load_row(self, target_id: str) -> Optional[Dict]:
+        updated_after = datetime.now(tz=pytz.UTC) - timedelta(seconds=settings.BET_BAZA_CACHE_TTL)
+        document = self._get_collection().find_one({'_id': target_id, 'updated_at': {'$gt': updated_after}})
+        if document:
+            return document['row']
+        return None
+
+    def _save_row(self, target_id: str, row: Dict):
+        self._get_collection().replace_one(
+            {'_id': target_id},
+            {'_id': target_id, 'row': row, 'updated_at': datetime.now(tz=pytz.UTC)},
+            upsert=True
+        )
+
+    async def load_row(self, target_id: str) -> Optional[Dict]:
+        if not self._persist or not settings.BET_BAZA_CACHE_TTL:
+            return None
+        try:
+            return await to_thread(self._load_row, target_id)
+        except PyMongoError:
+            self.logger.exception('Mongo недоступна, строки двойников не сохраняются')
+            self._persist = False
+        return None
+
+    async def save_row(self, target_id: str, row: Dict):
+        if not self._persist:
+            return
+        try:
+            await to_thread(self._save_row, target_id, row)
+        except PyMongoError:
+            self.logger.exception('Mongo недоступна, строки двойников не сохраняются')
+            self._persist = False
+
+    @staticmethod
+    async def get_table(page) -> Dict:
+        """Таблица страницы одним вызовом page.evaluate вместо запросов к каждой ячейке"""
+
+        return await page.evaluate(EXTRACT_TABLE_JS)
+
+    async def go_to_page(self, page, page_number, next_page):
+        """Открывает страницу таблицы page_number сразу, без перебора кнопки 'Следующая' с первой страницы"""
+
+        try:
+            await page.evaluate(GO_TO_PAGE_JS, page_number - 1)
+        except PlaywrightError:
+            self.logger.exception('DataTables API недоступен, листаем кнопкой "Следующая"')
+            for _ in range(page_number - 1):
+                await next_page.click()
+                await page.wait_for_load_state()
+        else:
+            await page.wait_for_load_state()
+
+    @staticmethod
+    def get_twins_row(names: List[str], target_table: Dict) -> Optional[Dict]:
+        """Строка результата по таблице, отобранной кф цели: первая строка - сам матч, остальные - двойники
+
+        None, если двойников нет.
+        """
+
+        tdata_rows = [row['green'] for row in target_table['rows']]
+        tdata_values = [
+            [_v.strip().replace('toto\nT\n', '') for _v in row['values']]
+            for row in target_table['rows']
+        ]
+        if len(tdata_values) <= 1:
+            return None
+        avg = np.array(tdata_rows)[1:, 6:9].mean(axis=0) * 100
+        return {
+            **dict(zip(names[:6], tdata_values[0][:6])),
+            'Количество двойников': len(tdata_values) - 1,
+            **dict(zip(names[6:9], avg.round(2).tolist())),
+        }
+
+    async def parse_target(self, page, names: List[str], target: Dict, page_number, clear_filter_btn, next_page):
+        """Отбирает двойники цели кликами по трем кф и возвращает таблицу на страницу page_number"""
+
+        _text = target['text']
+        if _text.startswith(' T '):
+            _text = _text.replace(' T', '')
+        _text = _text.split('\n')
+        for i in range(3):
+            await page.locator(
+                f'//td[text()="{_text[0]}" and text()="{_text[1]}"]/following-sibling::td[{i + 1}]'
+            ).first.click()
+        row = self.get_twins_row(names, await self.get_table(page))
+        await clear_filter_btn.click()
+        await self.go_to_page(page, page_number, next_page)
+        return row
+
+    async def login(self, page):
+        self.status = 'Логинимся'
+        await page.locator('//input[@name="login"]').fill(self.login_name)
+        await page.locator('//input[@name="password"]').fill(self.password)
+        await page.get_by_role('button', name='Войти', exact=True).first.click()
+        await page.wait_for_load_state()
+
+    async def parse(self, browser):
+        self._persist = True
+        self.status = f'Открываем {self.url}'
+        page = await browser.new_page()
+        page.set_default_timeout(self.timeout)
+        await page.goto(urljoin(self.url, '/'))
+        await page.wait_for_load_state()
+        clear_filter_btn = page.get_by_text('Очистить кф')
+        next_page = page.get_by_text('Следующая')
+        if not await clear_filter_btn.count():
+            await self.login(page)
+        await clear_filter_btn.click()
+        await page.wait_for_selector(f'//div[@class="dataTables_info" and text()!="{self.empty_info_text}"]')
+        await page.screenshot(path='screenshots/bet_baza.png')
+        rows = []
+        count_targets = 0
+        count_processed = 0
+        started_at = time()
+        process_next_page = True
+        page_number = 1
+        while process_next_page:
+            self.status = f'Обрабатываем страницу {page_number}'
+            table = await self.get_table(page)
+            names = table['names']
+            score_index = names.index('Счёт')
+            process_next_page = not any(row['texts'][score_index] != '' for row in table['rows'])
+            targets = [
+                target for target in table['targets']
+                if table['rows'][target['row']]['texts'][score_index] == ''
+            ]
+            count_targets += len(targets)
+            self.count_links = count_targets
+            for target in targets:
+                target_id = self.get_target_id(table['rows'][target['row']]['texts'])
+                row = await self.load_row(target_id)
+                if row is None:
+                    row = await self.parse_target(page, names, target, page_number, clear_filter_btn, next_page)
+                    if row is not None:
+                        await self.save_row(target_id, row)
+                if row is not None:
+                    rows.append(row)
+                count_processed += 1
+                self.update_progress(count_processed, started_at)
+            if process_next_page:
+                page_number += 1
+                await next_page.click()
+                await page.wait_for_load_state()
+        await page.close()
+        return await self.async_get_file_response(rows)
+
+    def get_file_response(self, df_data, *args, **kwargs) -> (FileResponse | PlainTextResponse):
+        """Excel будущих матчей с долями зеленых исходов двойников, по возрастанию даты"""
+
+        if not df_data:
+            self.status = 'Нет данных'
+            return PlainTextResponse('Нет данных')
+        self.status = f'Собрано данных: {len(df_data)}'
+        df = pd.DataFrame.from_records(df_data)
+        df['Дата'] = pd.to_datetime(df['Дата'], format='%d.%m.%y %H:%M').dt.tz_localize('Europe/Moscow')
+        df = df[df['Дата'] > self.now_msk]
+        df = df.sort_values(['Дата'])
+        df['Дата'] = df['Дата'].dt.tz_localize(None)
+        file_name = f'bet_baza_{self.now_msk.isoformat()}.xlsx'
+        self.path = f'files/{file_name}'
+        with pd.ExcelWriter(self.path, datetime_format='%d.%m.%y %H:%M') as writer:
+            df.to_excel(writer, index=False)
+        return FileResponse(self.path, filename=file_name)
+
+    async def async_get_file_response(self, *args, **kwargs):
+        return await to_thread(self.get_file_response, *args, **kwargs)
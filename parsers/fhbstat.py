@@ -1,32 +1,48 @@
+import asyncio
+import hashlib
 import json
 import operator
 import re
 from asyncio import to_thread
 from collections import defaultdict
-from contextlib import asynccontextmanager
-from copy import copy
-from datetime import datetime
+from contextlib import asynccontextmanager, nullcontext
+from copy import copy, deepcopy
+from datetime import datetime, timedelta
 from decimal import ROUND_DOWN, Decimal
 from enum import IntEnum
-from itertools import count
+from itertools import islice
 from pathlib import Path
-from typing import Annotated, Dict, List, Literal, Optional, Union
+from threading import Lock
+from time import time
+from typing import (Annotated, Awaitable, Callable, Dict, Iterable, List,
+                    Literal, NamedTuple, Optional, Set, Tuple, Union)
 from urllib.parse import parse_qs, unquote, urlencode, urlparse, urlunparse
 
 import httpx
 import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
+import pytz
+from bs4 import BeautifulSoup, UnicodeDammit
 from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from loguru import logger
+from lxml import html as lxml_html
 from nicegui.events import UploadEventArguments
+from openpyxl import load_workbook
 from openpyxl.styles import Border, Side
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.indexed_list import IndexedList
 from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.worksheet.merge import MergedCellRange
 from pydantic import (BaseModel, Discriminator, Field, PositiveInt, RootModel,
                       Tag, TypeAdapter)
+from pymongo import ReplaceOne
+from pymongo.errors import PyMongoError
 from xlsxtpl.writerx import BookWriter
 
-from base import Parser
+from base import BrowserNeed, Parser
 from config import settings
+from utils import _get_db_instance, gather_tasks
 
 
 class FieldType(IntEnum):
@@ -36,6 +52,14 @@ class FieldType(IntEnum):
     STR: int = 4
 
 
+class ExcelValues(IntEnum):
+    """Что писать в строки % и мо: формулы excel, посчитанные значения или оба листа"""
+
+    FORMULAS: int = 1
+    VALUES: int = 2
+    BOTH: int = 3
+
+
 def filter_type_discriminator(v):
     result = None
     if isinstance(v, dict):
@@ -59,6 +83,17 @@ class BaseFilterField(BaseModel):
             yield self.get_value(value, _filter_value)
             _filter_value = _filter_value[:-1]
 
+    def get_values(self, values: pd.Series, filter_value: Optional[str] = None) -> pd.Series:
+        """get_value для колонки матчей целиком, пропуски остаются NaN"""
+
+        return values
+
+    def next_values(self, values: pd.Series):
+        _filter_value = self.filter_value
+        for _ in range(2):
+            yield self.get_values(values, _filter_value)
+            _filter_value = _filter_value[:-1]
+
     class Config:
         validate_assignment = True
 
@@ -72,16 +107,52 @@ class FloatField(BaseFilterField):
         exp = Decimal(_filter_value).as_tuple().exponent * -1
         adjust_value = 10 ** (-1 * (exp + 2))
         _value = Decimal(value + adjust_value).quantize(Decimal(_filter_value), rounding=ROUND_DOWN)
-        _value = float(_value)
-        if _value.is_integer() and re.match(r'^\d+.$', _filter_value):
-            _value = str(int(_value)) + '.'
-        elif _value.is_integer() and re.match(r'^\d+$', _filter_value):
-            _value = str(int(_value))
-        elif _value.is_integer() and re.match(r'^\d+.\d+$', _filter_value):
-            _value = str(int(_value)) + '.0'
-        else:
-            _value = str(_value)
-        return _value
+        return self._format_value(float(_value), self._get_integer_suffix(_filter_value))
+
+    def get_values(self, values: pd.Series, filter_value: Optional[str] = None) -> pd.Series:
+        """Векторный get_value: отсечение знаков через numpy вместо Decimal
+
+        Значения, у которых после масштабирования до целого остается меньше 1e-6, могли бы
+        округлиться иначе из-за погрешности умножения, их считаем через Decimal как раньше.
+        """
+
+        _filter_value = filter_value or self.filter_value
+        exp = Decimal(_filter_value).as_tuple().exponent * -1
+        adjust_value = 10 ** (-1 * (exp + 2))
+        scale = 10.0 ** exp
+        numbers = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float) + adjust_value
+        scaled = numbers * scale
+        _values = np.trunc(scaled) / scale
+        ambiguous = np.abs(scaled - np.round(scaled)) < 1e-6
+        for i in np.flatnonzero(ambiguous):
+            _values[i] = float(Decimal(numbers[i]).quantize(Decimal(_filter_value), rounding=ROUND_DOWN))
+        integer_suffix = self._get_integer_suffix(_filter_value)
+        return pd.Series(
+            [
+                self._format_value(_value, integer_suffix) if not np.isnan(_value) else np.nan
+                for _value in _values.tolist()
+            ],
+            index=values.index,
+            dtype=object
+        )
+
+    @staticmethod
+    def _get_integer_suffix(filter_value: str) -> Optional[str]:
+        """возвращает окончание для целых значений по виду значения фильтра ('1.', '1', '0.1')"""
+
+        if re.match(r'^\d+.$', filter_value):
+            return '.'
+        elif re.match(r'^\d+$', filter_value):
+            return ''
+        elif re.match(r'^\d+.\d+$', filter_value):
+            return '.0'
+        return None
+
+    @staticmethod
+    def _format_value(value: float, integer_suffix: Optional[str]) -> str:
+        if value.is_integer() and integer_suffix is not None:
+            return str(int(value)) + integer_suffix
+        return str(value)
 
 
 class TimeField(BaseFilterField):
@@ -99,6 +170,15 @@ class TimeField(BaseFilterField):
             result = value
         return result
 
+    def get_values(self, values: pd.Series, filter_value: Optional[str] = None) -> pd.Series:
+        _filter_value = filter_value or self.filter_value
+        values = values.astype(object)
+        if ':' not in _filter_value:
+            return values.str.split(':').str[0]
+        elif _filter_value.endswith(':'):
+            return values.str.split(':').str[0] + ':'
+        return values
+
 
 class StrField(BaseFilterField):
     type: Literal[FieldType.STR]
@@ -131,6 +211,711 @@ class Filters(RootModel):
     root: Optional[List[FHBStatFilter]] = Field(default_factory=list)
 
 
+class FHBPage(NamedTuple):
+    data: pd.DataFrame
+    head: pd.DataFrame
+    names: List[str]
+
+
+class FHBQueryPlan(NamedTuple):
+    """Запросы фильтров, посчитанные заранее для всех матчей
+
+    Списки индексируются [номер фильтра][номер матча]. candidates - значения фильтра в порядке
+    перебора приоритетов, пустой список, если у матча нет значения какой-то колонки фильтра.
+    """
+
+    filters_data: List[List[Dict]]
+    candidates: List[List[List[Dict]]]
+    has_priority: List[bool]
+    count_queries: int
+    top_priority_levels: List[int]
+
+
+class FHBLayoutPlan(NamedTuple):
+    """Разметка листа результата, посчитанная один раз по размеру блока матча
+
+    blocks - пары (первая, последняя строка) блоков, percent_rows и mo_rows - строки формул % и мо.
+    """
+
+    start_row: int
+    max_rows: int
+    blocks: List[Tuple[int, int]]
+    percent_rows: List[int]
+    mo_rows: List[int]
+
+
+class FHBTemplateLayout(NamedTuple):
+    """Разметка листа шаблона по шапке: откуда начинаются данные и колонки объединений, ссылок и формул"""
+
+    start_row: int
+    start_column: int
+    split_column: int
+    link_column: Optional[int]
+    columns_by_number: List[int]
+    column_10: int
+
+
+class FHBQueryCache:
+    """Кэш результатов запросов фильтров fhbstat
+
+    В памяти хранится всё, что запрошено за текущий запуск, одновременные одинаковые запросы
+    ждут одну загрузку. Если задан ttl (в секундах), результаты дополнительно сохраняются
+    в коллекцию Mongo и переиспользуются следующими запусками, пока не истечет срок.
+    """
+
+    collection_name: str = 'FHBQueryCache'
+
+    def __init__(self, ttl: Optional[int] = None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memo: Dict[str, asyncio.Future] = dict()
+        self._collection = None
+
+    def __len__(self):
+        return len(self._memo)
+
+    @property
+    def status(self):
+        return f'Кэш запросов: попаданий {self.hits}, промахов {self.misses}'
+
+    def _get_collection(self):
+        if self._collection is None:
+            db = _get_db_instance(settings.MONGO_URL.encoded_string())
+            collection = db[self.collection_name]
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._collection = collection
+        return self._collection
+
+    def _load(self, key: str) -> Optional[Dict]:
+        document = self._get_collection().find_one({'_id': key, 'expires_at': {'$gt': datetime.now(tz=pytz.UTC)}})
+        if document:
+            return document['result']
+        return None
+
+    def _save(self, key: str, result: Dict):
+        self._get_collection().replace_one(
+            {'_id': key},
+            {
+                '_id': key,
+                'result': result,
+                'expires_at': datetime.now(tz=pytz.UTC) + timedelta(seconds=self.ttl),
+            },
+            upsert=True
+        )
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Dict]]) -> Dict:
+        future = self._memo.get(key)
+        while future is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # отменили загружавшую задачу, а не эту: загрузку продолжает первая из ждавших
+                if asyncio.current_task().cancelling():
+                    raise
+            future = self._memo.get(key)
+        future = asyncio.get_running_loop().create_future()
+        self._memo[key] = future
+        try:
+            result = None
+            if self.ttl:
+                try:
+                    result = await to_thread(self._load, key)
+                except PyMongoError:
+                    logger.exception('Кэш запросов в Mongo недоступен, используем только кэш в памяти')
+                    self.ttl = None
+            if result is None:
+                self.misses += 1
+                result = await fetch()
+                if self.ttl:
+                    try:
+                        await to_thread(self._save, key, result)
+                    except PyMongoError:
+                        logger.exception('Не удалось сохранить запрос в кэш Mongo')
+            else:
+                self.hits += 1
+        except BaseException as exc:
+            del self._memo[key]
+            if isinstance(exc, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(exc)
+                future.exception()
+            raise
+        future.set_result(result)
+        return result
+
+
+class FHBPrefetchStats:
+    """Учет опережающих запросов понижений приоритета
+
+    budget - сколько опережающих запросов можно сделать за запуск, wasted - сколько из них
+    не понадобились, saved - сколько секунд ожидания сэкономили использованные.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.requests = 0
+        self.wasted = 0
+        self.saved = 0.0
+
+    def take(self) -> bool:
+        if self.requests >= self.budget:
+            return False
+        self.requests += 1
+        return True
+
+    @property
+    def status(self):
+        return (
+            f'Опережающих запросов: {self.requests} из {self.budget}, '
+            f'лишних {self.wasted}, сэкономлено {self.saved:.1f} сек.'
+        )
+
+
+class FHBHistoryMirror:
+    """Локальная история прошедших матчей целевых путей
+
+    Матчи хранятся в коллекции Mongo по документу на матч и держатся в памяти таблицей на путь.
+    Запрос фильтра считается по таблице так же, как его отбирает сайт: вещественные колонки
+    сравниваются после отсечения знаков как в FloatField.get_values, время как в TimeField.get_values,
+    остальные колонки на равенство. Значения шапки (формулы сайта) по истории не считаются.
+    """
+
+    collection_name: str = 'FHBHistory'
+
+    def __init__(self, get_field_type: Callable[[int], FieldType]):
+        self.get_field_type = get_field_type
+        self.hits = 0
+        self._frames: Dict[str, pd.DataFrame] = dict()
+        self._values: Dict[Tuple[str, str, str], np.ndarray] = dict()
+        self._collection = None
+
+    def __contains__(self, path):
+        return path in self._frames
+
+    @property
+    def status(self):
+        count_matches = sum(len(df) for df in self._frames.values())
+        return f'Локальная история: матчей {count_matches}, запросов без сайта {self.hits}'
+
+    def _get_collection(self):
+        if self._collection is None:
+            db = _get_db_instance(settings.MONGO_URL.encoded_string())
+            collection = db[self.collection_name]
+            collection.create_index('target_path')
+            self._collection = collection
+        return self._collection
+
+    @staticmethod
+    def get_match_id(path, record: Dict) -> str:
+        return f'{path}|{record["dt"].isoformat()}|{record.get("9")}|{record.get("10")}'
+
+    def load(self, path):
+        """Загружает в память историю пути из Mongo"""
+
+        documents = self._get_collection().find({'target_path': path}, {'target_path': 0})
+        df = pd.DataFrame.from_records(list(documents))
+        if not df.empty:
+            self.set_frame(path, df.set_index('_id'))
+
+    def get_match_ids(self, path, df: pd.DataFrame) -> pd.Index:
+        return pd.Index([
+            self.get_match_id(path, record) for record in df.reindex(columns=['dt', '9', '10']).to_dict('records')
+        ])
+
+    def is_synced_page(self, path, df: pd.DataFrame, until: datetime) -> bool:
+        """все прошедшие матчи страницы списка уже в истории или старше последнего сохраненного:
+        следующие страницы листать не нужно"""
+
+        if path not in self._frames or df.empty:
+            return False
+        df = df.loc[df['dt'].dt.tz_localize('Europe/Moscow') <= until]
+        if df.empty:
+            return False
+        is_known = self.get_match_ids(path, df).isin(self._frames[path].index)
+        is_older = (df['dt'] < self._frames[path]['dt'].max()).to_numpy()
+        return bool((is_known | is_older).all())
+
+    def save(self, path, df: pd.DataFrame):
+        """Добавляет в историю пути и в Mongo только новые матчи, уже известные не перезаписываются"""
+
+        if df.empty:
+            return
+        match_ids = self.get_match_ids(path, df)
+        is_new = ~match_ids.duplicated()
+        if path in self._frames:
+            is_new &= ~match_ids.isin(self._frames[path].index)
+        df = df.loc[is_new].set_axis(match_ids[is_new])
+        if df.empty:
+            return
+        records = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+        self._get_collection().bulk_write(
+            [
+                ReplaceOne({'_id': match_id}, {'_id': match_id, 'target_path': path, **record}, upsert=True)
+                for match_id, record in zip(df.index, records)
+            ],
+            ordered=False
+        )
+        if path in self._frames:
+            df = pd.concat([self._frames[path], df])
+        self.set_frame(path, df)
+
+    def set_frame(self, path, df: pd.DataFrame):
+        self._frames[path] = df
+        for key in [key for key in self._values if key[0] == path]:
+            del self._values[key]
+
+    @staticmethod
+    def _normalize(value) -> Optional[str]:
+        """строковый вид значения: целые числа без дробной части, пропуски None"""
+
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return str(value)
+        if number.is_integer():
+            return str(int(number))
+        return str(value)
+
+    def get_column_values(self, path, column: str, filter_value: str) -> np.ndarray:
+        """Значения колонки истории в том виде, в каком их сравнивает фильтр с таким значением"""
+
+        field_type = self.get_field_type(int(column))
+        # отсечение зависит только от вида значения фильтра ('0.1', '1.', '12:'), не от цифр
+        key = re.sub(r'\d', '0', filter_value) if field_type in (FieldType.FLOAT, FieldType.TIME) else ''
+        values = self._values.get((path, column, key))
+        if values is None:
+            series = self._frames[path][column]
+            if field_type == FieldType.FLOAT:
+                _field = FloatField(type=FieldType.FLOAT, column=int(column), filter_value=key)
+                series = _field.get_values(series)
+            elif field_type == FieldType.TIME:
+                _field = TimeField(type=FieldType.TIME, column=int(column), filter_value=key)
+                series = _field.get_values(series)
+            else:
+                series = series.map(self._normalize)
+            values = series.to_numpy(dtype=object)
+            self._values[(path, column, key)] = values
+        return values
+
+    def get_mask(self, path, filters_data: Dict, until: Optional[datetime] = None) -> np.ndarray:
+        """Векторный отбор матчей истории запросом фильтра, until - последнее время матча с часовым поясом"""
+
+        df = self._frames[path]
+        mask = np.ones(len(df), dtype=bool)
+        for column, filter_value in filters_data.items():
+            column = str(column)
+            if column not in df.columns:
+                return np.zeros(len(df), dtype=bool)
+            filter_value = str(filter_value)
+            if self.get_field_type(int(column)) not in (FieldType.FLOAT, FieldType.TIME):
+                filter_value = self._normalize(filter_value)
+            mask &= self.get_column_values(path, column, filter_value) == filter_value
+        if until is not None:
+            dt = self._values.get((path, 'dt', ''))
+            if dt is None:
+                dt = df['dt'].dt.tz_localize('Europe/Moscow').dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+                self._values[(path, 'dt', '')] = dt
+            mask &= dt <= pd.Timestamp(until).tz_convert('UTC').tz_localize(None).to_datetime64()
+        return mask
+
+    def query(self, path, filters_data: Dict, until: Optional[datetime] = None) -> pd.DataFrame:
+        return self._frames[path].loc[self.get_mask(path, filters_data, until)]
+
+    def count(self, path, filters_data: Dict, until: Optional[datetime] = None) -> int:
+        return int(self.get_mask(path, filters_data, until).sum())
+
+
+class FHBCheckpoint:
+    """Контрольная точка запуска FHBParser в файле JSON Lines
+
+    Первая строка - матчи целевых ссылок, дальше по строке на каждый обработанный матч.
+    Файл только дополняется, после падения теряется не больше одной недописанной строки.
+    В памяти хранятся только номера обработанных матчей, строки блоков читаются из файла.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.targets: Optional[List[Dict]] = None
+        self.matches: Set[int] = set()
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, datetime):
+            return {'__datetime__': value.isoformat()}
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    @staticmethod
+    def _object_hook(value: Dict):
+        if len(value) == 1 and '__datetime__' in value:
+            return pd.Timestamp(value['__datetime__'])
+        return value
+
+    def _write(self, record: Dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=self._default, ensure_ascii=False) + '\n')
+
+    def _read(self) -> Iterable[Tuple[int, Dict]]:
+        """возвращает записи файла с длиной их строки, до первой недописанной строки"""
+
+        if not self.path.exists():
+            return
+        with self.path.open('rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line, object_hook=self._object_hook)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                yield len(line), record
+
+    def load(self, truncate: bool = True):
+        """читает файл, truncate=False для чтения файла, который еще дописывает идущий запуск"""
+
+        valid_size = 0
+        for size, record in self._read():
+            valid_size += size
+            if 'targets' in record:
+                self.targets = record['targets']
+            else:
+                self.matches.add(record['index'])
+        # обрезаем недописанную строку, чтобы следующие записи начинались с новой строки
+        if truncate and self.path.exists() and valid_size < self.path.stat().st_size:
+            with self.path.open('r+b') as f:
+                f.truncate(valid_size)
+
+    def save_targets(self, targets: List[Dict]):
+        self.targets = targets
+        self._write({'targets': targets})
+
+    def save_match(self, index: int, rows: List[Dict]):
+        self.matches.add(index)
+        self._write({'index': index, 'rows': rows})
+
+    @property
+    def count_matches(self) -> int:
+        if self.targets is None:
+            return 0
+        return sum(len(target['records']) for target in self.targets)
+
+    @property
+    def is_complete(self) -> bool:
+        return self.targets is not None and len(self.matches) == self.count_matches
+
+    def read_matches(self) -> Dict[int, List[Dict]]:
+        """возвращает строки блоков обработанных матчей из файла"""
+
+        return {record['index']: record['rows'] for _, record in self._read() if 'targets' not in record}
+
+    @property
+    def rows(self) -> List[Dict]:
+        matches = self.read_matches()
+        return [row for index in sorted(matches) for row in matches[index]]
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+
+class FHBBookWriter:
+    """Заполнение листов шаблона FHB без Jinja, замена xlsxtpl BookWriter
+
+    Результат тот же, что у BookWriter.render_book2 для листов с одним циклом
+    beforerow{% for row in rows %} на одну строку, где шаблонные ячейки только
+    {{ row.get('<ключ>') }}: строки до цикла копируются как есть, строка цикла
+    повторяется для каждой строки данных, строки после цикла сдвигаются вниз.
+    Для других листов get_loop_row возвращает None.
+    """
+
+    tag_pattern: re.Pattern = re.compile(r'\{%.+%\}|\{\{.+\}\}')
+    value_pattern: re.Pattern = re.compile(r"^\{\{\s*row\.get\('([^']*)'\)\s*\}\}$")
+    loop_start_pattern: re.Pattern = re.compile(r'^\s*beforerow\s*\{%\s*for\s+row\s+in\s+rows\s*%\}\s*$')
+    loop_end_pattern: re.Pattern = re.compile(r'^\s*beforerow\s*\{%\s*endfor\s*%\}\s*$')
+    sheet_settings: tuple = (
+        'sheet_format', 'sheet_properties', 'page_setup', 'print_options', '_print_rows', '_print_cols',
+        '_print_area', 'page_margins', 'protection', 'HeaderFooter', 'views', '_images',
+    )
+
+    def __init__(self, fname):
+        self.workbook = load_workbook(fname, rich_text=True)
+        self.template_sheets = list(self.workbook.worksheets)
+        for sheet in self.template_sheets:
+            self.workbook.remove(sheet)
+        self._loop_rows = dict()
+        self.layouts = dict()
+
+    def copy(self) -> 'FHBBookWriter':
+        """возвращает писатель на копии книги в памяти, листы шаблона общие и только читаются"""
+
+        writer = copy(self)
+        # deepcopy теряет элементы IndexedList: _dict попадает в копию раньше элементов и append их пропускает
+        memo = {
+            id(value): self._copy_indexed_list(value)
+            for value in vars(self.workbook).values()
+            if isinstance(value, IndexedList)
+        }
+        writer.workbook = deepcopy(self.workbook, memo)
+        return writer
+
+    @staticmethod
+    def _copy_indexed_list(value: IndexedList) -> IndexedList:
+        result = IndexedList()
+        list.extend(result, value)
+        result._dict = dict(value._dict)
+        result.clean = value.clean
+        return result
+
+    def get_loop_row(self, tpl_idx: int) -> Optional[tuple]:
+        """возвращает строку цикла листа и ключи row.get по колонкам, None если лист не поддерживается"""
+
+        if tpl_idx not in self._loop_rows:
+            self._loop_rows[tpl_idx] = self._find_loop_row(self.template_sheets[tpl_idx])
+        return self._loop_rows[tpl_idx]
+
+    def get_header_values(self, tpl_idx: int) -> List[tuple]:
+        """возвращает значения строк листа шаблона до строки цикла, не создавая пустых ячеек"""
+
+        loop_row, _ = self.get_loop_row(tpl_idx)
+        rdsheet = self.template_sheets[tpl_idx]
+        return [
+            tuple(getattr(rdsheet._cells.get((rowx, colx)), 'value', None) for colx in range(1, rdsheet.max_column + 1))
+            for rowx in range(1, loop_row)
+        ]
+
+    @classmethod
+    def _find_loop_row(cls, rdsheet) -> Optional[tuple]:
+        if rdsheet._images or rdsheet.data_validations.dataValidation or rdsheet.auto_filter.ref:
+            return None
+        loop_row = None
+        loop_end_row = None
+        keys = dict()
+        for (rowx, colx), cell in rdsheet._cells.items():
+            if cell.comment and cls.tag_pattern.search(cell.comment.text):
+                if colx == 1 and loop_row is None and cls.loop_start_pattern.match(cell.comment.text):
+                    loop_row = rowx
+                elif colx == 1 and loop_end_row is None and cls.loop_end_pattern.match(cell.comment.text):
+                    loop_end_row = rowx
+                else:
+                    return None
+            if cell.data_type == 's' and cls.tag_pattern.search(str(cell._value)):
+                match = cls.value_pattern.match(cell._value) if isinstance(cell._value, str) else None
+                if match is None:
+                    return None
+                keys[(rowx, colx)] = match.group(1)
+        if loop_row is None or loop_end_row != loop_row + 1:
+            return None
+        if any(rowx != loop_row for rowx, _ in keys):
+            return None
+        if any(merged.min_row <= loop_row <= merged.max_row for merged in rdsheet.merged_cells.ranges):
+            return None
+        return loop_row, {colx: key for (_, colx), key in keys.items()}
+
+    def render_book2(self, payloads):
+        for payload in payloads:
+            sheet_name = payload.get('sheet_name') or f'XLSheet{len(self.workbook._sheets)}'
+            self.render_sheet(payload.get('tpl_idx') or 0, sheet_name, payload['ctx']['rows'])
+
+    def render_sheet(self, tpl_idx: int, sheet_name: str, rows: List[Dict]):
+        loop_row, keys = self.get_loop_row(tpl_idx)
+        rdsheet = self.template_sheets[tpl_idx]
+        wtsheet = self.workbook.create_sheet(title=sheet_name)
+        for name in self.sheet_settings:
+            setattr(wtsheet, name, copy(getattr(rdsheet, name)))
+        count_rows = len(rows)
+        max_row = rdsheet.max_row
+        max_col = rdsheet.max_column
+        for colx in range(1, max_col + 1):
+            column_letter = get_column_letter(colx)
+            dimension = rdsheet.column_dimensions.get(column_letter)
+            if dimension:
+                wtsheet.column_dimensions[column_letter] = copy(dimension)
+                wtsheet.column_dimensions[column_letter].worksheet = wtsheet
+
+        def copy_cell(source, target, value=None, is_value=False):
+            if is_value:
+                target.value = '' if value is None else value
+            else:
+                target._value = source._value
+                target.data_type = source.data_type
+            if source.has_style:
+                target._style = copy(source._style)
+            if source.hyperlink:
+                target.hyperlink = copy(source.hyperlink)
+
+        def copy_row(rdrowx, wtrowx, row=None):
+            dimension = rdsheet.row_dimensions.get(rdrowx)
+            if dimension:
+                wtsheet.row_dimensions[wtrowx] = copy(dimension)
+                wtsheet.row_dimensions[wtrowx].worksheet = wtsheet
+            for colx in range(1, max_col + 1):
+                source = rdsheet._cells.get((rdrowx, colx))
+                if source is None:
+                    continue
+                target = wtsheet.cell(row=wtrowx, column=colx)
+                key = keys.get(colx) if row is not None else None
+                copy_cell(source, target, row.get(key) if key is not None else None, key is not None)
+
+        for rowx in range(1, max_row + 1):
+            if rowx < loop_row:
+                copy_row(rowx, rowx)
+            elif rowx == loop_row:
+                for number, row in enumerate(rows):
+                    copy_row(rowx, rowx + number, row)
+            else:
+                copy_row(rowx, rowx + count_rows - 1)
+
+        for merged in rdsheet.merged_cells.ranges:
+            if merged.min_row == merged.max_row and merged.min_col == merged.max_col:
+                continue
+            shift = 0 if merged.max_row < loop_row else count_rows - 1
+            wtsheet.merged_cells.add(
+                CellRange(None, merged.min_col, merged.min_row + shift, merged.max_col, merged.max_row + shift)
+            )
+        return wtsheet
+
+    def save(self, fname):
+        if not self.workbook.active:
+            self.workbook.active = 0
+        self.workbook.custom_doc_props = ()
+        count_sheets = len(self.workbook.worksheets)
+        self.workbook.defined_names = {
+            key: value
+            for key, value in self.workbook.defined_names.items()
+            if not value.localSheetId or int(value.localSheetId) < count_sheets
+        }
+        self.workbook.save(fname)
+
+
+class FHBTemplateRegistry:
+    """Шаблоны excel, загруженные в память один раз и перечитываемые при изменении файла"""
+
+    def __init__(self):
+        self._templates: Dict[Path, Tuple[int, FHBBookWriter]] = dict()
+        self._lock = Lock()
+
+    def get_template(self, fname: Path) -> FHBBookWriter:
+        """возвращает загруженный шаблон, новые выгрузки начинаются с его копии FHBBookWriter.copy"""
+
+        mtime = fname.stat().st_mtime_ns
+        with self._lock:
+            cached = self._templates.get(fname)
+            if cached is None or cached[0] != mtime:
+                template = FHBBookWriter(fname)
+                for tpl_idx in range(len(template.template_sheets)):
+                    template.get_loop_row(tpl_idx)
+                cached = (mtime, template)
+                self._templates[fname] = cached
+        return cached[1]
+
+
+class FHBSession:
+    """Сессия fhbstat одного пользователя, общая для запусков и одновременных задач
+
+    Cookies сессии хранятся в файле и подставляются в клиент каждого запуска. Живость сессии
+    проверяется одним запросом не чаще раза в check_interval секунд, вход выполняется
+    только если сессия истекла.
+    """
+
+    check_interval: int = 60
+    domain: str = 'fhbstat.com'
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.cookies: Optional[Dict[str, str]] = None
+        self.checked_at: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    def load(self):
+        self.cookies = dict()
+        if self.path.exists():
+            try:
+                self.cookies = json.loads(self.path.read_text())
+            except ValueError:
+                logger.exception(f'Не удалось прочитать сессию {self.path}')
+
+    def save(self, cookies: Dict[str, str]):
+        if cookies != self.cookies:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(cookies))
+        self.cookies = dict(cookies)
+
+    @staticmethod
+    def get_cookies(client: httpx.AsyncClient) -> Dict[str, str]:
+        return {cookie.name: cookie.value for cookie in client.cookies.jar}
+
+    def set_cookies(self, client: httpx.AsyncClient):
+        for name, value in self.cookies.items():
+            client.cookies.set(name, value, domain=self.domain)
+
+    def clear(self):
+        self.cookies = dict()
+        self.checked_at = None
+        self.path.unlink(missing_ok=True)
+
+    async def open(
+        self,
+        client: httpx.AsyncClient,
+        login: Callable[[httpx.AsyncClient], Awaitable[bool]],
+        is_alive: Callable[[httpx.AsyncClient], Awaitable[bool]]
+    ) -> bool:
+        """Подставляет cookies сессии в client, если сессия истекла - входит заново через login"""
+
+        async with self._get_lock():
+            if self.cookies is None:
+                self.load()
+            if self.cookies:
+                self.set_cookies(client)
+                if self.checked_at is not None and time() - self.checked_at < self.check_interval:
+                    return True
+                if await is_alive(client):
+                    self.checked_at = time()
+                    return True
+                client.cookies.clear()
+            if await login(client):
+                self.save(self.get_cookies(client))
+                self.checked_at = time()
+                return True
+            self.clear()
+            return False
+
+
+class FHBSessionRegistry:
+    """Сессии fhbstat по email, общие для всех экземпляров парсера"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._sessions: Dict[str, FHBSession] = dict()
+        self._lock = Lock()
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._sessions.values()))
+
+    def get_session(self, email) -> FHBSession:
+        with self._lock:
+            session = self._sessions.get(email)
+            if session is None:
+                session_id = hashlib.sha256(str(email).encode()).hexdigest()
+                session = FHBSession(self.path / Path(f'{session_id}.json'))
+                self._sessions[email] = session
+        return session
+
+
 class FHBParser(Parser):
     count_columns: int = 256
     max_time_sleep_sec: int = 1
@@ -138,6 +923,19 @@ class FHBParser(Parser):
     datetime_round: str = '00:00'
     count_empty_rows: int = 4
     digits_columns_start: int = 25
+    use_http_client: bool = True
+    browser_need: BrowserNeed = BrowserNeed.LAZY
+    fast_excel: bool = True
+    templates: FHBTemplateRegistry = FHBTemplateRegistry()
+    sessions: FHBSessionRegistry = FHBSessionRegistry(Path('storage') / Path('fhbstat_sessions'))
+    logged_in_pattern: re.Pattern = re.compile(r'выход\(this\)')
+    excel_values: ExcelValues = ExcelValues.FORMULAS
+    store_aggregates: bool = False
+    aggregates_collection_name: str = 'FHBAggregates'
+    data_row_pattern: re.Pattern = re.compile(r'<tr\s[^>]*\bdata-status\b')
+    # таблица результатов есть и у запроса без матчей, без нее страница не догрузилась
+    results_table_pattern: re.Pattern = re.compile(r'<table\s[^>]*\bdata-closest=')
+    checkpoints_path: Path = Path('storage') / Path('fhbstat_checkpoints')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -151,6 +949,19 @@ class FHBParser(Parser):
         self.to_time: str = ''
         self.user_filters: Optional[Filters] = Filters()
         self._min_count_matches: int = 1
+        self._concurrent_queries: int = 1
+        self._columns: Optional[List[int]] = None
+        self._queries_semaphore: Optional[asyncio.Semaphore] = None
+        self._checkpoint: Optional[FHBCheckpoint] = None
+        self._last_run_msk: Optional[datetime] = None
+        self.query_cache: FHBQueryCache = FHBQueryCache()
+        self.speculative_prefetch: bool = False
+        self._speculative_budget: int = 200
+        self.prefetch_stats: FHBPrefetchStats = FHBPrefetchStats(self._speculative_budget)
+        self.history_mirror: bool = False
+        # запросы фильтров считаются по локальной истории без сайта, колонки шапки остаются пустыми
+        self.history_queries: bool = False
+        self.history: FHBHistoryMirror = FHBHistoryMirror(self.get_field_type)
 
     @property
     def min_count_matches(self):
@@ -161,6 +972,24 @@ class FHBParser(Parser):
         if value >= 1:
             self._min_count_matches = int(value)
 
+    @property
+    def concurrent_queries(self):
+        return int(self._concurrent_queries)
+
+    @concurrent_queries.setter
+    def concurrent_queries(self, value):
+        if value >= 1:
+            self._concurrent_queries = int(value)
+
+    @property
+    def speculative_budget(self):
+        return int(self._speculative_budget)
+
+    @speculative_budget.setter
+    def speculative_budget(self, value):
+        if value >= 0:
+            self._speculative_budget = int(value)
+
     @property
     def email(self):
         email = None
@@ -182,17 +1011,41 @@ class FHBParser(Parser):
         if value:
             self._password = value
 
+    def start(self):
+        super().start()
+        self._last_run_msk = self.now_msk
+
     def stop(self):
         super().stop()
         self._email = None
         self._password = None
 
+    def copy_for_run(self) -> 'FHBParser':
+        parser = super().copy_for_run()
+        # фильтры и ссылки формы можно менять, пока запуск ждет в очереди или идет
+        parser.user_filters = self.user_filters.model_copy(deep=True)
+        parser.target_urls = copy(self.target_urls)
+        parser._queries_semaphore = None
+        parser._checkpoint = None
+        parser._last_run_msk = None
+        # учетные данные уходят в запуск и, как и раньше, после него в форме не остаются
+        self._email = None
+        self._password = None
+        return parser
+
+    def get_export_msk(self) -> datetime:
+        """время запуска для выгрузки: идущего, последнего в этом процессе или текущее после перезапуска"""
+
+        return self.now_msk or self._last_run_msk or datetime.now(tz=pytz.timezone('Europe/Moscow'))
+
     def parser_log_filter(self, record):
         return __name__ == record['name']
 
     @property
     def columns(self):
-        return list(range(1, self.count_columns))
+        if self._columns is None or len(self._columns) != self.count_columns - 1:
+            self._columns = list(range(1, self.count_columns))
+        return self._columns
 
     def get_filter_id(self):
         result = 1
@@ -268,11 +1121,6 @@ class FHBParser(Parser):
 
     async def login(self, client: httpx.AsyncClient):
         self.status = 'Логинимся'
-        cookies_file = Path('cookies.json')
-        cookies = {}
-        if cookies_file.exists():
-            with cookies_file.open() as f:
-                cookies = json.load(f)
         response = await client.post(
             'https://fhbstat.com/авторизация',
             data={
@@ -281,7 +1129,6 @@ class FHBParser(Parser):
                 'posts[value][пароль]': self.password,
                 'posts[location]': 'https://fhbstat.com/авторизация',
             },
-            cookies=cookies,
         )
         assert response.status_code == 200, 'Не удалось авторизоваться на сайте fhbstat.com'
         try:
@@ -292,11 +1139,18 @@ class FHBParser(Parser):
             if 'success' in json_data and 'error' in json_data['success']:
                 self.status = json_data['success']['error']
                 return False
-            else:
-                with cookies_file.open('w') as f:
-                    json.dump(dict(client.cookies), f)
         return True
 
+    async def is_logged_in(self, client: httpx.AsyncClient) -> bool:
+        """Проверяет сессию клиента одним запросом: на страницах для вошедших есть кнопка выхода"""
+
+        try:
+            response = await client.get(self._url)
+        except httpx.HTTPError:
+            self.logger.exception('Не удалось проверить сессию')
+            return False
+        return response.status_code == 200 and bool(self.logged_in_pattern.search(response.text))
+
     async def logout(self, client: httpx.AsyncClient):
         self.status = 'Выходим'
         response = await client.post(
@@ -312,8 +1166,15 @@ class FHBParser(Parser):
 
     @asynccontextmanager
     async def page_client(self, client: httpx.AsyncClient):
+        """Клиент с сессией fhbstat: живая сессия прошлых запусков переиспользуется, вход только при истекшей
+
+        Выход с сайта выполняет только close_sessions.
+        """
+
+        session = self.sessions.get_session(self.email)
+        is_logged = False
         try:
-            is_logged = await self.login(client=client)
+            is_logged = await session.open(client, self.login, self.is_logged_in)
             if is_logged:
                 yield client
             else:
@@ -321,7 +1182,27 @@ class FHBParser(Parser):
         except Exception:
             self.logger.exception('Ошибка')
         finally:
-            await self.logout(client=client)
+            if is_logged:
+                session.save(session.get_cookies(client))
+
+    async def close_sessions(self, client: Optional[httpx.AsyncClient] = None):
+        """Выходит с сайта во всех сессиях процесса, вызывается по запросу или при остановке приложения"""
+
+        if client is None:
+            async with httpx.AsyncClient(follow_redirects=True, headers={'User-Agent': self._user_agent}) as client:
+                return await self.close_sessions(client)
+        for session in self.sessions:
+            if session.cookies is None:
+                session.load()
+            if not session.cookies:
+                continue
+            client.cookies.clear()
+            session.set_cookies(client)
+            try:
+                await self.logout(client=client)
+            except (httpx.HTTPError, AssertionError):
+                self.logger.exception('Не удалось выйти с сайта')
+            session.clear()
 
     @classmethod
     def get_excel_template(cls, path):
@@ -347,13 +1228,173 @@ class FHBParser(Parser):
         }
         return columns.get(path)
 
-    def get_file_response(self, df_data, target_path) -> (FileResponse | PlainTextResponse):
+    @staticmethod
+    def round_down(values, digits: int):
+        """ROUNDDOWN excel для Series и DataFrame: отсечение к нулю
+
+        Значения, которые после масштабирования отличаются от целого меньше чем на 1e-9, считаются
+        этим целым, иначе погрешность умножения (0.29 * 100 = 28.999...) теряла бы разряд.
+        """
+
+        scale = 10.0 ** digits
+        scaled = values * scale
+        nearest = np.round(scaled)
+        return np.trunc(scaled).mask((scaled - nearest).abs() < 1e-9, nearest) / scale
+
+    @classmethod
+    def get_block_means(cls, df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+        """возвращает средние колонок по строкам фильтров каждого матча (index), взвешенные по количеству матчей
+
+        Как формула строки %: пропуски считаются нулем, строки %, кф, мо и пустые строки не участвуют.
+        """
+
+        counts = pd.to_numeric(df['Количество матчей'], errors='coerce')
+        is_filter_row = counts.notna()
+        counts = counts[is_filter_row]
+        groups = df.loc[is_filter_row, 'index']
+        values = df.loc[is_filter_row, columns].apply(pd.to_numeric, errors='coerce').fillna(0)
+        sums = values.mul(counts, axis=0).groupby(groups).sum()
+        total_counts = counts.groupby(groups).sum()
+        return sums.div(total_counts.replace(0, np.nan), axis=0)
+
+    @classmethod
+    def get_expectations(cls, means, odds):
+        """возвращает математическое ожидание, как формула строки мо: ROUNDDOWN(% / 100 * кф - 1, 2)"""
+
+        return cls.round_down(means / 100 * odds - 1, 2)
+
+    @classmethod
+    def get_means(cls, data: List[Dict]) -> Dict[str, float]:
+        """возвращает средние колонок от digits_columns_start по строкам фильтров, взвешенные по количеству матчей"""
+
+        df = pd.DataFrame.from_records(data)
+        if df.empty:
+            return {}
+        columns = [
+            column
+            for column in df.columns
+            if str(column).isdigit() and int(column) >= cls.digits_columns_start
+        ]
+        means = cls.get_block_means(df.assign(index=0), columns)
+        return means.iloc[0].round(4).to_dict()
+
+    @classmethod
+    def get_mathematical_expectation(cls, data_means: Dict[str, float], data_match: Dict) -> Dict[str, float]:
+        """возвращает математическое ожидание по средним и коэффициентам матча, без колонок без коэффициента"""
+
+        means = pd.Series(data_means, dtype=float)
+        odds = pd.to_numeric(pd.Series(data_match, dtype=object).reindex(means.index), errors='coerce')
+        return cls.get_expectations(means, odds).dropna().to_dict()
+
+    def get_aggregates_columns(self, df: pd.DataFrame, target_path) -> Tuple[List[str], List[str]]:
+        """возвращает колонки с формулами: от digits_columns_start (% и мо, 2 знака) и колонки цели (%, 1 знак)"""
+
+        digits_columns = [
+            column
+            for column in map(str, self.columns)
+            if column in df.columns and int(column) >= self.digits_columns_start
+        ]
+        number_columns = [str(column) for column in self.get_columns_by_target(target_path) or ()]
+        return digits_columns, number_columns
+
+    def fill_aggregates(self, df: pd.DataFrame, target_path) -> pd.DataFrame:
+        """возвращает копию результата, где строки % и мо заполнены значениями формул excel"""
+
+        df = df.copy()
+        digits_columns, number_columns = self.get_aggregates_columns(df, target_path)
+        means = self.get_block_means(df, digits_columns + number_columns)
+        percents = pd.concat(
+            (self.round_down(means[digits_columns], 2), self.round_down(means[number_columns], 1)),
+            axis=1
+        )
+        count_matches = df['Количество матчей']
+        is_percent = count_matches == '%'
+        is_mo = count_matches == 'мо'
+        odds = df.loc[count_matches == 'кф', ['index'] + digits_columns].set_index('index')
+        odds = odds.apply(pd.to_numeric, errors='coerce')
+        expectations = self.get_expectations(percents[digits_columns], odds)
+        df.loc[is_percent, percents.columns] = percents.reindex(df.loc[is_percent, 'index']).to_numpy()
+        df.loc[is_mo, digits_columns] = expectations.reindex(df.loc[is_mo, 'index']).to_numpy()
+        return df
+
+    def add_empty_rows(self, df: pd.DataFrame) -> pd.DataFrame:
+        """возвращает результат, где после блока каждого матча идут count_empty_rows пустых строк разметки"""
+
+        if df.empty or not self.count_empty_rows:
+            return df
+        block_numbers, indexes = pd.factorize(df['index'])
+        empty_numbers = np.repeat(np.arange(len(indexes)), self.count_empty_rows)
+        df = pd.concat(
+            (df, pd.DataFrame({'index': indexes.take(empty_numbers)})),
+            ignore_index=True
+        )
+        order = np.argsort(np.concatenate((block_numbers, empty_numbers)), kind='stable')
+        return df.iloc[order].reset_index(drop=True)
+
+    def get_aggregates_documents(
+        self,
+        df: pd.DataFrame,
+        target_path,
+        now_msk: Optional[datetime] = None
+    ) -> List[Dict]:
+        """возвращает документы Mongo по матчам: колонки матча, средние (%), коэффициенты (кф) и мо"""
+
+        def get_values(row: pd.Series) -> Dict:
+            return {
+                column: value.item() if isinstance(value, np.generic) else value
+                for column, value in row.dropna().items()
+            }
+
+        digits_columns, number_columns = self.get_aggregates_columns(df, target_path)
+        match_columns = [str(column) for column in range(1, 11) if str(column) in df.columns]
+        count_matches = df['Количество матчей']
+        matches = df[pd.to_numeric(count_matches, errors='coerce').notna()].groupby('index')[match_columns].first()
+        rows = {
+            name: df.loc[count_matches == sym].set_index('index')
+            for name, sym in (('means', '%'), ('odds', 'кф'), ('expectations', 'мо'))
+        }
+        snapshot_dt = now_msk or self.now_msk
+        documents = []
+        for index, match in matches.iterrows():
+            documents.append({
+                'target_path': target_path,
+                'snapshot_dt': snapshot_dt,
+                'index': int(index),
+                'match': get_values(match),
+                'means': get_values(rows['means'].loc[index, digits_columns + number_columns]),
+                'odds': get_values(rows['odds'].loc[index, digits_columns]),
+                'expectations': get_values(rows['expectations'].loc[index, digits_columns]),
+            })
+        return documents
+
+    def save_aggregates(self, df: pd.DataFrame, target_path, now_msk: Optional[datetime] = None):
+        """сохраняет посчитанные % и мо в Mongo, ошибка Mongo не мешает выгрузке excel"""
+
+        documents = self.get_aggregates_documents(df, target_path, now_msk)
+        if not documents:
+            return
+        try:
+            db = _get_db_instance(settings.MONGO_URL.encoded_string())
+            collection = db[self.aggregates_collection_name]
+            collection.create_index([('target_path', 1), ('snapshot_dt', -1)])
+            collection.insert_many(documents)
+        except PyMongoError:
+            logger.exception('Не удалось сохранить итоги в Mongo')
+
+    def get_file_response(
+        self,
+        df_data,
+        target_path,
+        suffix: str = '',
+        now_msk: Optional[datetime] = None
+    ) -> (FileResponse | PlainTextResponse):
         result = None
+        now_msk = now_msk or self.now_msk
         if df_data:
             msg = f'Собрано данных: {len(df_data)}'
             self.status = msg
-            df = pd.DataFrame.from_records(df_data)
-            df['Дата слепка, МСК'] = self.now_msk
+            df = self.add_empty_rows(pd.DataFrame.from_records(df_data))
+            df['Дата слепка, МСК'] = now_msk
             columns = list(
                 map(str, self.columns)
             ) + ['index', 'dt', 'Количество матчей', 'Дата слепка, МСК', 'url']
@@ -361,11 +1402,12 @@ class FHBParser(Parser):
             df['Дата слепка, МСК'] = df['Дата слепка, МСК'].dt.tz_localize(None)
             older_df = pd.DataFrame(columns=columns)
             if self.file_name:
-                self.path = f'files/{self.file_name}.xlsx'
-                filename = f'{self.file_name}.xlsx'
+                filename = f'{self.file_name}{suffix}.xlsx'
             else:
-                self.path = f'files/{self.name}_{self.now_msk.isoformat()}.xlsx'
-                filename = f'{self.name}_{self.now_msk.isoformat()}.xlsx'
+                filename = f'{self.name}_{now_msk.isoformat()}{suffix}.xlsx'
+            # промежуточная выгрузка может идти одновременно с итоговой, поэтому путь локальный
+            path = f'files/{filename}'
+            self.path = path
             if older_df.empty:
                 full_df = df
             else:
@@ -376,145 +1418,52 @@ class FHBParser(Parser):
 
             template_name, sheet_name, tpl_id = self.get_excel_template(target_path)
             if all((template_name, sheet_name, tpl_id is not None)):
-                fname = Path(__file__).parent.parent / Path('excel_templates') / Path(template_name)
-                writer = BookWriter(fname)
-                writer.jinja_env.globals.update(dir=dir, getattr=getattr)
-
-                data = dict()
-                data['rows'] = df.to_dict('records')
-                payload0 = {'tpl_idx': tpl_id, 'sheet_name': sheet_name,  'ctx': data}
-
-                payloads = [payload0]
+                fname = self.get_template_path(template_name)
+                writer = None
+                layout = None
+                if self.fast_excel:
+                    template = self.templates.get_template(fname)
+                    if template.get_loop_row(tpl_id) is not None:
+                        writer = template.copy()
+                        layout = self.get_template_layout(template, tpl_id, template_name, target_path)
+                if writer is None:
+                    writer = BookWriter(fname)
+                    writer.jinja_env.globals.update(dir=dir, getattr=getattr)
+
+                values_df = None
+                if self.excel_values != ExcelValues.FORMULAS or self.store_aggregates:
+                    values_df = self.fill_aggregates(df, target_path)
+                if self.store_aggregates:
+                    self.save_aggregates(values_df, target_path, now_msk)
+
+                # лист с формулами и/или лист со значениями, второй лист называется по первому
+                sheets = []
+                if self.excel_values != ExcelValues.VALUES:
+                    sheets.append((sheet_name, df, True))
+                if self.excel_values != ExcelValues.FORMULAS:
+                    values_sheet_name = sheet_name
+                    if self.excel_values == ExcelValues.BOTH:
+                        values_sheet_name = f'{sheet_name} (значения)'
+                    sheets.append((values_sheet_name, values_df, False))
+                payloads = [
+                    {'tpl_idx': tpl_id, 'sheet_name': name,  'ctx': {'rows': sheet_df.to_dict('records')}}
+                    for name, sheet_df, _ in sheets
+                ]
                 writer.render_book2(payloads=payloads)
 
                 workbook = writer.workbook
-                sheet = workbook[sheet_name]
-                start_row = None
-                start_column = None
-                split_column = None
-                link_column = None
-                for i, value in enumerate(sheet.values):
-                    if all(map(lambda x: x is None, value)):
-                        continue
-                    link_name = 'ссылка'.upper()
-                    if link_name in value:
-                        link_column = value.index(link_name) + 1
-                    count_matches_name = 'Количество матчей'
-                    if '№' in value and count_matches_name in value:
-                        start_row = i + 4
-                        start_column = value.index('№') + 1
-                        split_column = value.index(count_matches_name) + 1
-                        break
+                for name, _, formulas in sheets:
+                    sheet = workbook[name]
+                    if layout is None:
+                        layout = self.get_sheet_layout(sheet.values, template_name, target_path)
 
-                delta = 1
-                if template_name == 'templates.xlsx':
-                    delta = 2
-                columns_by_number = list(
-                    filter(
-                        lambda x: sheet.cell(start_row-delta, x).value in self.get_columns_by_target(target_path),
-                        range(1, link_column)
-                    )
-                )
-                _10 = start_column
-                for i in filter(lambda x: sheet.cell(start_row-delta, x).value in (10,), range(1, link_column)):
-                    _10 = i
-
-                max_rows = start_row
-                for row in range(start_row + 1, sheet.max_row + 1):
-                    if sheet.cell(row=row, column=start_column).value is None:
-                        max_rows = row
-                        break
+                    plan = self.plan_layout(sheet, layout.start_row, layout.start_column, layout.split_column)
+                    self.layout_sheet(sheet, plan, layout, formulas=formulas)
 
-                for col in range(start_column, _10 + 1):
-                    first_row = start_row
-                    end_row = first_row + len(self.user_filters.root) + 3 + self.count_empty_rows - 1
-                    while end_row <= max_rows:
-                        if col == start_column:
-                            sheet.merge_cells(
-                                start_column=col,
-                                end_column=col,
-                                start_row=first_row,
-                                end_row=end_row
-                            )
-                            max_column = sheet.max_column
-                            if link_column:
-                                max_column -= 1
-                            cell_range = CellRange(
-                                min_col=col,
-                                max_col=max_column,
-                                min_row=first_row,
-                                max_row=end_row
-                            )
-                            sides = ('left', 'right', 'top', 'bottom')
-                            for side in sides:
-                                for cell in getattr(cell_range, side, []):
-                                    _cell = sheet.cell(cell[0], cell[1])
-                                    other_sides = filter(lambda _side: _side != side, sides)
-                                    old_border = copy(_cell.border)
-                                    _cell.border = Border(
-                                        **{side: Side(border_style='thick')},
-                                        **{
-                                            other_side: getattr(old_border, other_side)
-                                            for other_side in other_sides
-                                        }
-                                    )
-                        else:
-                            sheet.merge_cells(
-                                start_column=col,
-                                end_column=col,
-                                start_row=first_row,
-                                end_row=first_row + len(self.user_filters.root) - 1
-                            )
-                        first_row = end_row + 1
-                        end_row = first_row + len(self.user_filters.root) + 3 + self.count_empty_rows - 1
-
-                if link_column:
-                    for row in range(start_row, max_rows + 1):
-                        value = sheet.cell(row, link_column).value
-                        if value and isinstance(value, str):
-                            sheet.cell(row, link_column).hyperlink = value
-                            sheet.cell(row, link_column).style = "Hyperlink"
-
-                # заполнение формул
-                for fn_col in range(split_column + 1, link_column):
-                    for row in range(start_row, max_rows + 1):
-                        if sheet.cell(row, split_column).value == '%':
-                            average_columns = ','.join([
-                                f'{sheet.cell(_row, fn_col).coordinate}*{sheet.cell(_row, split_column).coordinate}'
-                                for _row in range(row - len(self.user_filters.root), row)
-                            ])
-                            sum_count_matches = (
-                                f'{sheet.cell(row - len(self.user_filters.root), split_column).coordinate}:'
-                                f'{sheet.cell(row-1, split_column).coordinate}'
-                            )
-                            sheet.cell(row, fn_col).value = (
-                                f'=ROUNDDOWN(SUM({average_columns})/SUM({sum_count_matches}),2)'
-                            )
-                        elif sheet.cell(row, split_column).value == 'мо':
-                            sheet.cell(row, fn_col).value = (
-                                f'=ROUNDDOWN(({sheet.cell(row - 2, fn_col).coordinate}/100*'
-                                f'{sheet.cell(row - 1, fn_col).coordinate})-1,2)'
-                            )
-
-                for fn_col in columns_by_number:
-                    for row in range(start_row, max_rows + 1):
-                        if sheet.cell(row, split_column).value == '%':
-                            average_columns = ','.join([
-                                f'{sheet.cell(_row, fn_col).coordinate}*{sheet.cell(_row, split_column).coordinate}'
-                                for _row in range(row - len(self.user_filters.root), row)
-                            ])
-                            sum_count_matches = (
-                                f'{sheet.cell(row - len(self.user_filters.root), split_column).coordinate}:'
-                                f'{sheet.cell(row-1, split_column).coordinate}'
-                            )
-                            sheet.cell(row, fn_col).value = (
-                                f'=ROUNDDOWN(SUM({average_columns})/SUM({sum_count_matches}),1)'
-                            )
-
-                writer.save(self.path)
+                writer.save(path)
 
                 result = FileResponse(
-                    self.path,
+                    path,
                     filename=filename
                 )
             else:
@@ -523,6 +1472,172 @@ class FHBParser(Parser):
             result = PlainTextResponse('Не собрали данных.')
         return result
 
+    @classmethod
+    def get_template_path(cls, template_name) -> Path:
+        return Path(__file__).parent.parent / Path('excel_templates') / Path(template_name)
+
+    @classmethod
+    def get_sheet_layout(cls, rows_values: Iterable[tuple], template_name, target_path) -> Optional[FHBTemplateLayout]:
+        """возвращает разметку листа по значениям его строк, None если шапка не найдена"""
+
+        rows_values = iter(rows_values)
+        link_column = None
+        for i, value in enumerate(rows_values):
+            if all(map(lambda x: x is None, value)):
+                continue
+            link_name = 'ссылка'.upper()
+            if link_name in value:
+                link_column = value.index(link_name) + 1
+            count_matches_name = 'Количество матчей'
+            if '№' in value and count_matches_name in value:
+                start_row = i + 4
+                start_column = value.index('№') + 1
+                split_column = value.index(count_matches_name) + 1
+                break
+        else:
+            return None
+
+        delta = 1
+        if template_name == 'templates.xlsx':
+            delta = 2
+        # строка с номерами колонок fhbstat - через delta строк до начала данных
+        numbers = next(islice(rows_values, 2 - delta, None), None)
+        if numbers is None:
+            return None
+        columns_by_number = list(
+            filter(
+                lambda x: numbers[x - 1] in cls.get_columns_by_target(target_path),
+                range(1, link_column)
+            )
+        )
+        _10 = start_column
+        for i in filter(lambda x: numbers[x - 1] in (10,), range(1, link_column)):
+            _10 = i
+        return FHBTemplateLayout(start_row, start_column, split_column, link_column, columns_by_number, _10)
+
+    def get_template_layout(self, template: FHBBookWriter, tpl_idx, template_name, target_path):
+        """возвращает разметку листа шаблона, посчитанную один раз на загрузку шаблона"""
+
+        key = (tpl_idx, target_path)
+        if key not in template.layouts:
+            template.layouts[key] = self.get_sheet_layout(
+                template.get_header_values(tpl_idx), template_name, target_path
+            )
+        return template.layouts[key]
+
+    def preload_templates(self):
+        """загружает шаблоны excel и разметку их листов заранее, чтобы первая выгрузка не читала файл"""
+
+        for target_path in ('/football', '/football_24', '/hockey', '/hockey_24', '/football_total', '/hockey_total'):
+            template_name, _, tpl_id = self.get_excel_template(target_path)
+            template = self.templates.get_template(self.get_template_path(template_name))
+            if template.get_loop_row(tpl_id) is not None:
+                self.get_template_layout(template, tpl_id, template_name, target_path)
+
+    def plan_layout(self, sheet, start_row, start_column, split_column) -> FHBLayoutPlan:
+        """возвращает разметку листа: границы блоков матчей и строки формул"""
+
+        max_rows = start_row
+        for row in range(start_row + 1, sheet.max_row + 1):
+            if sheet.cell(row=row, column=start_column).value is None:
+                max_rows = row
+                break
+        count_filters = len(self.user_filters.root)
+        block_size = count_filters + 3 + self.count_empty_rows
+        blocks = [
+            (first_row, first_row + block_size - 1)
+            for first_row in range(start_row, max_rows - block_size + 2, block_size)
+        ]
+        percent_rows = []
+        mo_rows = []
+        for first_row, _ in blocks:
+            if sheet.cell(row=first_row + count_filters, column=split_column).value == '%':
+                percent_rows.append(first_row + count_filters)
+            if sheet.cell(row=first_row + count_filters + 2, column=split_column).value == 'мо':
+                mo_rows.append(first_row + count_filters + 2)
+        return FHBLayoutPlan(start_row, max_rows, blocks, percent_rows, mo_rows)
+
+    @staticmethod
+    def _merge_column(sheet, column, start_row, end_row):
+        """объединяет ячейки колонки, блоки не пересекаются, поэтому без перебора merged_cells в merge_cells"""
+
+        column_letter = get_column_letter(column)
+        merged_range = MergedCellRange(sheet, f'{column_letter}{start_row}:{column_letter}{end_row}')
+        sheet.merged_cells.ranges.add(merged_range)
+        sheet._clean_merge_range(merged_range)
+
+    def layout_sheet(self, sheet, plan: FHBLayoutPlan, layout: FHBTemplateLayout, formulas: bool = True):
+        """объединяет и обводит блоки матчей, проставляет ссылки и формулы за один проход по плану
+
+        С formulas=False строки % и мо остаются со значениями из fill_aggregates.
+        """
+
+        start_column = layout.start_column
+        split_column = layout.split_column
+        link_column = layout.link_column
+        count_filters = len(self.user_filters.root)
+        max_column = sheet.max_column
+        if link_column:
+            max_column -= 1
+        borders = sheet.parent._borders
+        # рамки блоков одинаковые, поэтому граница с толстой стороной считается один раз на исходную границу
+        border_ids = dict()
+        sides = ('left', 'right', 'top', 'bottom')
+        for first_row, end_row in plan.blocks:
+            self._merge_column(sheet, start_column, first_row, end_row)
+            cell_range = CellRange(min_col=start_column, max_col=max_column, min_row=first_row, max_row=end_row)
+            for side in sides:
+                for row, col in getattr(cell_range, side):
+                    cell = sheet.cell(row, col)
+                    if not cell._style:
+                        cell._style = StyleArray()
+                    key = (cell._style.borderId, side)
+                    if key not in border_ids:
+                        old_border = borders[cell._style.borderId]
+                        border_ids[key] = borders.add(
+                            Border(
+                                **{side: Side(border_style='thick')},
+                                **{
+                                    other_side: getattr(old_border, other_side)
+                                    for other_side in sides
+                                    if other_side != side
+                                }
+                            )
+                        )
+                    cell._style.borderId = border_ids[key]
+        # без фильтров в блоке нет строк фильтров, объединять нечего
+        if count_filters:
+            for col in range(start_column + 1, layout.column_10 + 1):
+                for first_row, _ in plan.blocks:
+                    self._merge_column(sheet, col, first_row, first_row + count_filters - 1)
+
+        if link_column:
+            for row in range(plan.start_row, plan.max_rows + 1):
+                cell = sheet.cell(row, link_column)
+                if cell.value and isinstance(cell.value, str):
+                    cell.hyperlink = cell.value
+                    cell.style = "Hyperlink"
+
+        if not formulas:
+            return
+        # заполнение формул
+        split_letter = get_column_letter(split_column)
+        for precision, fn_columns in ((2, range(split_column + 1, link_column)), (1, layout.columns_by_number)):
+            for fn_col in fn_columns:
+                letter = get_column_letter(fn_col)
+                for row in plan.percent_rows:
+                    average_columns = ','.join(
+                        f'{letter}{_row}*{split_letter}{_row}' for _row in range(row - count_filters, row)
+                    )
+                    sheet.cell(row, fn_col).value = (
+                        f'=ROUNDDOWN(SUM({average_columns})/SUM({split_letter}{row - count_filters}:'
+                        f'{split_letter}{row - 1}),{precision})'
+                    )
+        for fn_col in range(split_column + 1, link_column):
+            letter = get_column_letter(fn_col)
+            for row in plan.mo_rows:
+                sheet.cell(row, fn_col).value = f'=ROUNDDOWN(({letter}{row - 2}/100*{letter}{row - 1})-1,2)'
+
     async def async_get_file_response(self, *args, **kwargs):
         return await to_thread(self.get_file_response, *args, **kwargs)
 
@@ -547,8 +1662,7 @@ class FHBParser(Parser):
         return table_rows, first_data_index, names
 
     @classmethod
-    def parse_head_table(cls, content):
-        table_rows, first_data_index, names = cls.get_head_data(content)
+    def _get_head_df(cls, table_rows, first_data_index, names) -> pd.DataFrame:
         if first_data_index:
             data_rows = table_rows[3:4]
             data_list = list()
@@ -570,8 +1684,7 @@ class FHBParser(Parser):
         return df
 
     @classmethod
-    def parse_content(cls, content):
-        table_rows, first_data_index, names = cls.get_head_data(content)
+    def _get_content_df(cls, table_rows, first_data_index, names) -> pd.DataFrame:
         if first_data_index:
             data_rows = table_rows[first_data_index:]
             data_list = list()
@@ -607,6 +1720,103 @@ class FHBParser(Parser):
             df = pd.DataFrame()
         return df
 
+    @classmethod
+    def _get_columns_df(cls, values: Dict[str, List[Optional[str]]], names) -> pd.DataFrame:
+        """Собирает DataFrame из текстов ячеек, разложенных по колонкам
+
+        Числа приводятся векторно через pd.to_numeric, нечисловые значения остаются строками,
+        dt собирается одним вызовом pd.to_datetime из колонок 1-4.
+        """
+        raw_df = pd.DataFrame(values, dtype=object)
+        _dt_str = raw_df['3'].str.cat(raw_df['2'], sep='-').str.cat(raw_df['1'], sep='-').str.cat(raw_df['4'], sep=' ')
+        _dt = pd.to_datetime(_dt_str, format='%Y-%m-%d %H:%M', errors='coerce')
+        raw_df = raw_df.loc[_dt.notna()].reset_index(drop=True)
+        data = dict()
+        for name in names:
+            raw_column = raw_df[name]
+            column = pd.to_numeric(raw_column, errors='coerce')
+            not_numeric = column.isna() & raw_column.notna()
+            if not_numeric.any():
+                column = column.astype(object).where(~not_numeric, raw_column)
+            data[name] = column
+        df = pd.DataFrame(data, columns=list(data) + ['dt'])
+        df['dt'] = _dt.loc[_dt.notna()].reset_index(drop=True)
+        return df
+
+    @classmethod
+    def _parse_page_lxml(cls, content, columns: Optional[Iterable] = None) -> FHBPage:
+        if isinstance(content, bytes):
+            content = UnicodeDammit(content, is_html=True).unicode_markup
+        tree = lxml_html.document_fromstring(content)
+        table = tree.find('.//table')
+        tbody = table.find('tbody')
+        table_rows = [tr for tr in tbody if tr.tag == 'tr']
+        first_data_index = next(
+            (i for i, tr in enumerate(table_rows) if 'data-status' in tr.attrib),
+            None
+        )
+        if not first_data_index:
+            return FHBPage(data=pd.DataFrame(), head=pd.DataFrame(), names=[])
+        names = [
+            text
+            for text in (td.text_content() for td in table_rows[first_data_index - 1] if td.tag == 'td')
+            if text != ''
+        ]
+
+        head_row = dict()
+        for td in table_rows[3]:
+            key = td.get('data-formula')
+            if key is not None:
+                value = td.text_content()
+                head_row[key] = float(value) if value else np.nan
+        head_df = pd.DataFrame.from_records([head_row] if head_row else [], columns=names + ['dt'])
+        head_df = head_df.replace({None: np.nan, '': np.nan})
+
+        data_names = names
+        if columns is not None:
+            used_columns = set(map(str, columns)) | {'1', '2', '3', '4'}
+            data_names = [name for name in names if name in used_columns]
+        data_rows = table_rows[first_data_index:]
+        values = {name: [None] * len(data_rows) for name in set(data_names) | {'1', '2', '3', '4'}}
+        for i, tr in enumerate(data_rows):
+            for td in tr:
+                key = td.get('data-td')
+                if key in values:
+                    value = td.text_content()
+                    if value:
+                        values[key][i] = value
+        data_df = cls._get_columns_df(values, data_names)
+        return FHBPage(data=data_df, head=head_df, names=names)
+
+    @classmethod
+    def parse_page(cls, content, columns: Optional[Iterable] = None, fast: bool = True) -> FHBPage:
+        """Разбирает страницу fhbstat за один проход: строки матчей, строку формул шапки и имена колонок
+
+        columns ограничивает набор колонок в строках матчей (dt собирается всегда),
+        fast=False разбирает страницу через BeautifulSoup построчно.
+        """
+
+        if fast:
+            return cls._parse_page_lxml(content, columns=columns)
+        table_rows, first_data_index, names = cls.get_head_data(content)
+        data = cls._get_content_df(table_rows, first_data_index, names)
+        if columns is not None and not data.empty:
+            used_columns = set(map(str, columns)) | {'1', '2', '3', '4'}
+            data = data.loc[:, [name for name in names if name in used_columns] + ['dt']]
+        return FHBPage(
+            data=data,
+            head=cls._get_head_df(table_rows, first_data_index, names),
+            names=names,
+        )
+
+    @classmethod
+    def parse_head_table(cls, content):
+        return cls.parse_page(content).head
+
+    @classmethod
+    def parse_content(cls, content, columns: Optional[Iterable] = None):
+        return cls.parse_page(content, columns=columns).data
+
     @classmethod
     def get_formula(cls):
         formulas = {
@@ -661,23 +1871,7 @@ class FHBParser(Parser):
         target_url = urlunparse((scheme, domain, path, params, None, fragment))
         return target_url, query_params, path
 
-    async def _parse_page_by_filter(
-        self,
-        logged_client,
-        browser,
-        index,
-        data_match,
-        filters_data,
-        scheme,
-        domain,
-        path,
-        params,
-        fragment,
-        target_path
-    ) -> Dict:
-        page_url = urlunparse((
-            scheme, domain, path, params, urlencode(filters_data), fragment
-        ))
+    async def get_browser_page_content(self, logged_client, browser, page_url) -> str:
         cookies = [
             {
                 'name': key,
@@ -695,219 +1889,677 @@ class FHBParser(Parser):
         await page.goto(page_url)
         await page.wait_for_load_state()
         page_content = await page.content()
-        df_match = self.parse_content(page_content)
+        await page.close()
+        return page_content
+
+    async def get_filter_page_content(self, logged_client, browser, page_url) -> str:
+        """Загружает страницу фильтра через logged_client
+
+        Браузер открывается, только если в ответе нет таблицы результатов: пустая таблица -
+        это запрос без матчей, а не недогруженная страница.
+        """
+
+        async with self._queries_semaphore or nullcontext():
+            if self.use_http_client:
+                response = await logged_client.get(page_url)
+                if response.status_code == 200 and (
+                    self.data_row_pattern.search(response.text) or self.results_table_pattern.search(response.text)
+                ):
+                    return response.text
+                self.logger.info(f'В ответе нет таблицы результатов, открываем в браузере {unquote(page_url)}')
+            return await self.get_browser_page_content(logged_client, browser, page_url)
+
+    async def _parse_page_by_filter(
+        self,
+        logged_client,
+        browser,
+        index,
+        data_match,
+        filters_data,
+        scheme,
+        domain,
+        path,
+        params,
+        fragment,
+        target_path
+    ) -> Dict:
+        page_url = urlunparse((
+            scheme, domain, path, params, urlencode(filters_data), fragment
+        ))
+        if self.history_mirror and self.history_queries and target_path in self.history:
+            query_result = self.query_history(filters_data, target_path)
+        else:
+            query_result = await self.query_cache.get_or_fetch(
+                self.get_query_key(path, filters_data),
+                lambda: self.query_filter(logged_client, browser, page_url, target_path)
+            )
+        copy_data_match = data_match.copy()
+        copy_data_match.update(query_result['head'])
+        copy_data_match.update(query_result['means'])
+        copy_data_match['Количество матчей'] = query_result['count']
+        copy_data_match['index'] = index
+        copy_data_match['url'] = unquote(page_url)
+
+        return copy_data_match
+
+    @classmethod
+    def get_query_key(cls, path, filters_data: Dict) -> str:
+        """Канонический вид запроса фильтра: одинаковые наборы значений дают один ключ независимо от порядка"""
+
+        return f'{path}?{urlencode(sorted((str(key), str(value)) for key, value in filters_data.items()))}'
+
+    async def query_filter(self, logged_client, browser, page_url, target_path) -> Dict:
+        """Значения шапки, средние по колонкам цели и количество матчей для одного запроса фильтра"""
+
+        page_content = await self.get_filter_page_content(logged_client, browser, page_url)
+        fhb_page = self.parse_page(page_content, columns=self.get_columns_by_target(target_path))
+        df_match = fhb_page.data
         if not df_match.empty:
             df_match = df_match.loc[
                 df_match['dt'].dt.tz_localize('Europe/Moscow') <= self.now_msk
             ]
-        head_df = self.parse_head_table(page_content)
-        await page.close()
         columns = list(
             filter(
                 lambda x: int(x) >= self.digits_columns_start,
-                head_df.columns[:-1]
+                fhb_page.names
             )
         )
-        head_df_records = head_df.to_dict(orient='records')
-        copy_data_match = data_match.copy()
-        for h_d_r in head_df_records:
+        head = dict()
+        for h_d_r in fhb_page.head.to_dict(orient='records'):
             for column_name, column_value in h_d_r.items():
                 if column_name in columns:
-                    copy_data_match[column_name] = column_value
-        for _column in list(map(str, self.get_columns_by_target(target_path))):
+                    head[column_name] = float(column_value)
+        count_rows, _ = df_match.shape
+        return {'head': head, 'means': self.get_filter_means(df_match, target_path), 'count': count_rows}
+
+    @classmethod
+    def get_filter_means(cls, df_match: pd.DataFrame, target_path) -> Dict[str, float]:
+        """возвращает средние матчей запроса по колонкам цели с отсечением до одного знака"""
+
+        means = dict()
+        for _column in list(map(str, cls.get_columns_by_target(target_path))):
             if _column in df_match.columns:
                 _v = df_match[_column].mean()
                 _v *= 10
-                copy_data_match[_column] = (_v - _v % 1) / 10
-        count_rows, _ = df_match.shape
-        copy_data_match['Количество матчей'] = count_rows
-        copy_data_match['index'] = index
-        copy_data_match['url'] = unquote(page_url)
+                means[_column] = float((_v - _v % 1) / 10)
+        return means
+
+    def query_history(self, filters_data: Dict, target_path) -> Dict:
+        """Результат запроса фильтра как у query_filter, но по локальной истории
+
+        Шапка - формулы сайта - по истории не считается и остается пустой.
+        """
+
+        df_match = self.history.query(target_path, filters_data, self.now_msk)
+        self.history.hits += 1
+        return {'head': {}, 'means': self.get_filter_means(df_match, target_path), 'count': len(df_match)}
+
+    def select_candidates(self, candidates: List[Dict], target_path) -> List[Dict]:
+        """Оставляет из понижений приоритета только то, которое примет проверка количества матчей
+
+        Количество матчей каждого понижения считается по локальной истории, у сайта запрашивается
+        первое понижение, у которого матчей не меньше min_count_matches. Если таких нет - последнее,
+        если у него есть матчи, иначе ничего.
+        """
+
+        counts = [self.history.count(target_path, _filters_data, self.now_msk) for _filters_data in candidates]
+        selected = candidates[-1:] if counts and counts[-1] else []
+        for _filters_data, count in zip(candidates, counts):
+            if count >= self.min_count_matches:
+                selected = [_filters_data]
+                break
+        self.history.hits += len(candidates) - len(selected)
+        return selected
+
+    def get_filters_data(self, user_filter: FHBStatFilter, data_match: Dict) -> Dict[str, str]:
+        filters_data = {}
+        for _filter in user_filter.filters:
+            value_match = data_match.get(str(_filter.column))
+            filters_data[str(_filter.column)] = _filter.get_value(value_match)
+        return filters_data
+
+    def plan_queries(self, data: pd.DataFrame, path: str) -> FHBQueryPlan:
+        """Считает значения всех фильтров и понижений приоритета сразу по колонкам future_data"""
+
+        filters_data = []
+        candidates = []
+        has_priority = []
+        top_priority_levels = []
+        query_keys = set()
+        for user_filter in self.user_filters.root:
+            values = dict()
+            base_values = dict()
+            for _filter in user_filter.filters:
+                column = str(_filter.column)
+                if column in data.columns:
+                    values[column] = data[column]
+                else:
+                    values[column] = pd.Series(np.nan, index=data.index, dtype=object)
+                base_values[column] = _filter.get_values(values[column])
+            base_df = pd.DataFrame(base_values, index=data.index)
+            valid = base_df.notna().all(axis=1).tolist()
+            priority_queues = sorted(
+                filter(
+                    lambda x: x.priority is not None,
+                    user_filter.filters
+                ),
+                key=lambda x: x.priority
+            )
+            steps = []
+            if not priority_queues:
+                steps.append(base_df.to_dict(orient='records'))
+            _filters_df = base_df.copy()
+            for priority_filter in priority_queues:
+                for next_values in priority_filter.next_values(values[str(priority_filter.column)]):
+                    _filters_df[str(priority_filter.column)] = next_values
+                    steps.append(_filters_df.to_dict(orient='records'))
+                if priority_filter is priority_queues[0]:
+                    top_priority_levels.append(len(steps))
+            if not priority_queues:
+                top_priority_levels.append(0)
+            filter_candidates = [
+                list(match_candidates) if is_valid else []
+                for match_candidates, is_valid in zip(zip(*steps), valid)
+            ]
+            for match_candidates in filter_candidates:
+                query_keys.update(self.get_query_key(path, _filters_data) for _filters_data in match_candidates)
+            filters_data.append(base_df.to_dict(orient='records'))
+            candidates.append(filter_candidates)
+            has_priority.append(bool(priority_queues))
+        return FHBQueryPlan(filters_data, candidates, has_priority, len(query_keys), top_priority_levels)
+
+    async def _parse_user_filter(
+        self,
+        logged_client,
+        browser,
+        index,
+        data_match,
+        filters_data: Dict,
+        candidates: List[Dict],
+        has_priority: bool,
+        url_parts,
+        target_path,
+        top_priority_levels: int = 0
+    ) -> Dict:
+        scheme, domain, path, params, _, fragment = url_parts
+        if has_priority and self.history_mirror and path in self.history:
+            candidates = self.select_candidates(candidates, path)
+
+        async def parse_page_by_filter(_filters_data):
+            started_at = time()
+            result = await self._parse_page_by_filter(
+                logged_client,
+                browser,
+                index,
+                data_match,
+                _filters_data,
+                scheme,
+                domain,
+                path,
+                params,
+                fragment,
+                target_path
+            )
+            return result, started_at, time()
+
+        # Понижения приоритетного фильтра запрашиваем сразу, не дожидаясь проверки более точного значения
+        prefetched = dict()
+        if self.speculative_prefetch and has_priority:
+            for level in range(1, min(top_priority_levels, len(candidates))):
+                if not self.prefetch_stats.take():
+                    break
+                prefetched[level] = asyncio.create_task(parse_page_by_filter(candidates[level]))
+        copy_data_match = dict()
+        try:
+            for level, _filters_data in enumerate(candidates):
+                if level in prefetched:
+                    waited_from = time()
+                    copy_data_match, started_at, finished_at = await prefetched.pop(level)
+                    self.prefetch_stats.saved += max(0.0, min(waited_from, finished_at) - started_at)
+                else:
+                    copy_data_match, _, _ = await parse_page_by_filter(_filters_data)
+                if not has_priority or copy_data_match['Количество матчей'] >= self.min_count_matches:
+                    return copy_data_match
+        except BaseException:
+            for task in prefetched.values():
+                task.cancel()
+            raise
+        finally:
+            # ненужные понижения дожидаемся: они заполняют кэш запросов для других матчей
+            # и не должны идти на сайт после окончания запуска
+            self.prefetch_stats.wasted += len(prefetched)
+            if prefetched:
+                await asyncio.gather(*prefetched.values(), return_exceptions=True)
+        if copy_data_match.get('Количество матчей'):
+            return copy_data_match
+        return {
+            **{
+                'index': index,
+                'Количество матчей': 0,
+                'url': unquote(
+                    urlunparse((
+                        scheme,
+                        domain,
+                        path,
+                        params,
+                        urlencode(filters_data),
+                        fragment
+                    ))
+                )
+            },
+            **{str(i): data_match.get(str(i), np.nan) for i in range(11)}
+        }
 
-        return copy_data_match
+    async def _parse_match(
+        self,
+        logged_client,
+        browser,
+        index,
+        data_match,
+        plan: FHBQueryPlan,
+        match_number: int,
+        url_parts,
+        target_path
+    ) -> List[Dict]:
+        """Строки блока матча: по строке на фильтр в порядке фильтров, затем %, кф и мо
+
+        Пустые строки между блоками добавляет add_empty_rows при выгрузке в excel.
+        """
+
+        local_match_result_df = list(
+            await gather_tasks(*(
+                self._parse_user_filter(
+                    logged_client,
+                    browser,
+                    index,
+                    data_match,
+                    plan.filters_data[filter_number][match_number],
+                    plan.candidates[filter_number][match_number],
+                    plan.has_priority[filter_number],
+                    url_parts,
+                    target_path,
+                    plan.top_priority_levels[filter_number]
+                )
+                for filter_number in range(len(self.user_filters.root))
+            ))
+        )
+        # Строки хранят только заполненные колонки, недостающие добавит reindex в get_file_response
+        local_match_result_df.append({
+            'index': index,
+            'Количество матчей': '%'
+        })
+        local_match_result_df.append({
+            **{
+                column: value
+                for column, value in data_match.items()
+                if column.isdigit() and self.digits_columns_start <= int(column) < self.count_columns
+            },
+            **{
+                'index': index,
+                'Количество матчей': 'кф'
+            }
+        })
+        local_match_result_df.append({
+            'index': index,
+            'Количество матчей': 'мо'
+        })
+        return local_match_result_df
+
+    def get_run_id(self, now_msk: Optional[datetime] = None) -> str:
+        """возвращает идентификатор запуска по фильтрам, целевым ссылкам, интервалу времени и дате"""
+
+        run_data = json.dumps(
+            {
+                'filters': self.user_filters.model_dump(mode='json'),
+                'target_urls': list(self.target_urls.values()),
+                'from_time': self.from_time,
+                'to_time': self.to_time,
+                'min_count_matches': self.min_count_matches,
+                'date': (now_msk or self.now_msk).date().isoformat(),
+            },
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(run_data.encode()).hexdigest()
+
+    def get_checkpoint(self) -> FHBCheckpoint:
+        """контрольная точка запуска, точка без матчей удаляется: из нее нечего продолжать"""
+
+        checkpoint = FHBCheckpoint(self.checkpoints_path / Path(f'{self.get_run_id()}.jsonl'))
+        checkpoint.load()
+        if checkpoint.targets is not None and not checkpoint.count_matches:
+            checkpoint.remove()
+            checkpoint = FHBCheckpoint(checkpoint.path)
+        return checkpoint
+
+    async def get_checkpoint_file_response(
+        self,
+        checkpoint: FHBCheckpoint,
+        partial: bool = False,
+        now_msk: Optional[datetime] = None
+    ) -> (FileResponse | PlainTextResponse):
+        """Генерирует excel файл из результатов контрольной точки, после успеха удаляет ее
+
+        С partial=True excel строится из уже обработанных матчей, а контрольная точка остается.
+        """
+
+        if not partial:
+            self.status = 'Генерируем excel файл'
+        target_path = None
+        if checkpoint.targets:
+            _, _, target_path = self.get_url_params(checkpoint.targets[-1]['target_url'])
+        result = await self.async_get_file_response(
+            df_data=checkpoint.rows,
+            target_path=target_path,
+            suffix='_partial' if partial else '',
+            now_msk=now_msk
+        )
+        if isinstance(result, FileResponse) and not partial:
+            checkpoint.remove()
+        return result
+
+    async def get_partial_file_response(self) -> (FileResponse | PlainTextResponse):
+        """Генерирует excel из матчей, которые идущий или прерванный запуск уже сохранил в контрольную точку"""
+
+        now_msk = self.get_export_msk()
+        path = self.checkpoints_path / Path(f'{self.get_run_id(now_msk)}.jsonl')
+        if self._checkpoint is not None:
+            path = self._checkpoint.path
+        checkpoint = FHBCheckpoint(path)
+        checkpoint.load(truncate=False)
+        return await self.get_checkpoint_file_response(checkpoint, partial=True, now_msk=now_msk)
+
+    @asynccontextmanager
+    async def queries_limit(self):
+        """Ограничивает число одновременных запросов к сайту значением concurrent_queries
+
+        Вложенные вызовы используют уже созданный семафор.
+        """
+
+        if self._queries_semaphore is not None:
+            yield self._queries_semaphore
+            return
+        self._queries_semaphore = asyncio.Semaphore(self.concurrent_queries)
+        try:
+            yield self._queries_semaphore
+        finally:
+            self._queries_semaphore = None
+
+    async def parse_matches(self, logged_client, browser, data_records, url_parts, target_path) -> List[Dict]:
+        """Обрабатывает матчи параллельно, не более concurrent_queries запросов к сайту одновременно
+
+        Порядок строк в результате не зависит от порядка завершения запросов: по index,
+        внутри матча в порядке фильтров.
+        """
+
+        return await self.parse_targets_matches(logged_client, browser, [(data_records, url_parts, target_path)])
+
+    async def parse_targets_matches(
+        self,
+        logged_client,
+        browser,
+        targets,
+        checkpoint: Optional[FHBCheckpoint] = None
+    ) -> Optional[List[Dict]]:
+        """parse_matches для нескольких целевых ссылок сразу
+
+        targets - список (data_records, url_parts, target_path). Нумерация index сквозная,
+        матчи следующей ссылки идут после матчей предыдущей. Матчи, уже сохраненные
+        в checkpoint, повторно не запрашиваются, новые сохраняются в него по мере готовности.
+        С checkpoint строки блоков в памяти не копятся и возвращается None, результат - checkpoint.rows.
+        """
+
+        plans = [
+            self.plan_queries(pd.DataFrame.from_records(data_records), url_parts.path)
+            for data_records, url_parts, _ in targets
+        ]
+        self.status = f'Уникальных запросов фильтров: не более {sum(plan.count_queries for plan in plans)}'
+        started_at = time()
+        count_processed = 0
+
+        async def parse_match(index, data_match, plan, match_number, url_parts, target_path):
+            nonlocal count_processed
+            rows = None
+            if checkpoint is None or index not in checkpoint.matches:
+                rows = await self._parse_match(
+                    logged_client,
+                    browser,
+                    index,
+                    data_match,
+                    plan,
+                    match_number,
+                    url_parts,
+                    target_path
+                )
+                if checkpoint is not None:
+                    checkpoint.save_match(index, rows)
+                    rows = None
+            count_processed += 1
+            self.update_progress(count_processed, started_at)
+            return rows
+
+        async with self.queries_limit():
+            matches_rows = await gather_tasks(*(
+                parse_match(index, data_match, plan, match_number, url_parts, target_path)
+                for index, (data_match, plan, match_number, url_parts, target_path) in enumerate(
+                    (
+                        (data_match, plan, match_number, url_parts, target_path)
+                        for (data_records, url_parts, target_path), plan in zip(targets, plans)
+                        for match_number, data_match in enumerate(data_records)
+                    ),
+                    1
+                )
+            ))
+        if checkpoint is not None:
+            return None
+        return [row for rows in matches_rows for row in rows]
+
+    @staticmethod
+    def get_last_page_number(content: Union[str, bytes]) -> Optional[int]:
+        """возвращает номер последней страницы списка по ссылкам пагинации"""
+
+        if isinstance(content, bytes):
+            content = content.decode(errors='ignore')
+        page_numbers = [int(page_number) for page_number in re.findall(r'data-pagination="(\d+)"', content)]
+        if page_numbers:
+            return max(page_numbers)
+        return None
+
+    async def get_listing_page(self, logged_client, target_url, query_params, page_number) -> httpx.Response:
+        async with self._queries_semaphore or nullcontext():
+            if page_number == 1:
+                return await logged_client.get(
+                    target_url,
+                    params=query_params
+                )
+            return await logged_client.get(
+                target_url,
+                params={'page': page_number, **query_params}
+            )
+
+    def get_listing_df(self, response: httpx.Response, history: bool = False) -> Optional[pd.DataFrame]:
+        """возвращает матчи страницы списка в интервале времени (с history=True все), None при ошибке разбора"""
+
+        try:
+            df = self.parse_page(response.content).data
+            if not history:
+                df = self.filter_df_by_time(df, self.from_time, self.to_time)
+        except Exception:
+            self.logger.exception('Ошибка сбора данных. Возможно не оплачен тариф.')
+            self.status = 'Ошибка сбора данных. Возможно не оплачен тариф.'
+            return None
+        return df
+
+    async def get_listing_records(
+        self,
+        logged_client,
+        target_url,
+        history: bool = False,
+        is_last_page: Optional[Callable[[pd.DataFrame], bool]] = None
+    ) -> Optional[List[Dict]]:
+        """Матчи целевой ссылки со всех страниц списка
+
+        Без параметра page после первой страницы остальные запрашиваются окнами по concurrent_queries
+        штук до первой пустой страницы, последней страницы из ссылок пагинации или страницы,
+        для которой is_last_page вернул True.
+        С history=True вместо интервала времени возвращаются уже прошедшие матчи.
+        None, если страницу списка не удалось разобрать: собранное до нее неполно.
+        """
+
+        self.status = f'Обрабатываем ссылку {target_url}'
+        _target_url, query_params, _ = self.get_url_params(target_url)
+        for key, value in query_params.items():
+            if isinstance(value, (list, tuple)) and len(value) == 1:
+                query_params[key] = value[0]
+        dfs = []
+        is_failed = False
+        if 'page' not in query_params:
+            last_page_number = None
+            page_number = 1
+            is_finished = False
+            while not is_finished:
+                # первая страница отдельно: по ней узнаем номер последней
+                page_numbers = range(page_number, page_number + (self.concurrent_queries if page_number > 1 else 1))
+                if last_page_number is not None:
+                    page_numbers = range(page_number, min(page_numbers.stop, last_page_number + 1))
+                if not page_numbers:
+                    break
+                responses = await gather_tasks(*(
+                    self.get_listing_page(logged_client, _target_url, query_params, _page_number)
+                    for _page_number in page_numbers
+                ))
+                for _page_number, response in zip(page_numbers, responses):
+                    if response.status_code != 200:
+                        continue
+                    if _page_number == 1:
+                        last_page_number = self.get_last_page_number(response.content)
+                    df = self.get_listing_df(response, history=history)
+                    if df is None or df.empty:
+                        is_failed = df is None
+                        is_finished = True
+                        break
+                    dfs.append(df)
+                    if is_last_page is not None and is_last_page(df):
+                        is_finished = True
+                        break
+                page_number = page_numbers.stop
+        else:
+            response = await self.get_listing_page(logged_client, _target_url, query_params, 1)
+            if response.status_code == 200:
+                df = self.get_listing_df(response, history=history)
+                is_failed = df is None
+                if df is not None and not df.empty:
+                    dfs.append(df)
+        if is_failed:
+            return None
+        future_data = pd.DataFrame()
+        if dfs:
+            future_data = pd.concat(dfs)
+        if history and not future_data.empty:
+            future_data = future_data.loc[future_data['dt'].dt.tz_localize('Europe/Moscow') <= self.now_msk]
+        return future_data.to_dict(orient='records')
+
+    async def update_history(self, logged_client, target_url):
+        """Дозагружает в локальную историю новые прошедшие матчи пути целевой ссылки
+
+        Список листается до первой страницы, матчи которой уже есть в истории,
+        полностью только при первой синхронизации пути.
+        """
+
+        scheme, domain, path, params, _, fragment = urlparse(target_url)
+        if path not in self.history:
+            await to_thread(self.history.load, path)
+        records = await self.get_listing_records(
+            logged_client,
+            urlunparse((scheme, domain, path, params, None, fragment)),
+            history=True,
+            is_last_page=lambda df: self.history.is_synced_page(path, df, self.now_msk)
+        )
+        if records is not None:
+            await to_thread(self.history.save, path, pd.DataFrame.from_records(records))
 
     async def parse(self, browser):
         result = None
-        msg = f'Открываем {self.url}'
-        self.status = msg
-
-        transport = httpx.AsyncHTTPTransport(retries=5)
-        async with httpx.AsyncClient(
-            follow_redirects=True,
-            headers={
-                'User-Agent': self._user_agent
-            },
-            transport=transport,
-        ) as client:
-            async with self.page_client(client=client) as logged_client:
-                if logged_client is not None:
-                    dfs = []
-                    result_df_list = []
-                    copy_target_urls = self.target_urls.copy()
-                    target_path = None
-                    for target_url in copy_target_urls.values():
-                        self.status = f'Обрабатываем ссылку {target_url}'
-                        _target_url, query_params, target_path = self.get_url_params(target_url)
-                        for key, value in query_params.items():
-                            if isinstance(value, (list, tuple)) and len(value) == 1:
-                                query_params[key] = value[0]
-                        if 'page' not in query_params:
-                            for page_number in count(1):
-                                if page_number == 1:
-                                    response = await logged_client.get(
-                                        _target_url,
-                                        params=query_params
-                                    )
-                                else:
-                                    response = await logged_client.get(
-                                        _target_url,
-                                        params={'page': page_number, **query_params}
-                                    )
-                                if response.status_code == 200:
-                                    try:
-                                        df = self.parse_content(response.content)
-                                        df = self.filter_df_by_time(df, self.from_time, self.to_time)
-                                    except Exception:
-                                        self.logger.exception('Ошибка сбора данных. Возможно не оплачен тариф.')
-                                        self.status = 'Ошибка сбора данных. Возможно не оплачен тариф.'
-                                        break
-                                    else:
-                                        if not df.empty:
-                                            dfs.append(df)
-                                        else:
-                                            break
-                        else:
-                            response = await logged_client.get(
-                                _target_url,
-                                params=query_params
-                            )
-                            if response.status_code == 200:
+        checkpoint = self.get_checkpoint()
+        if checkpoint.is_complete:
+            self.status = 'Все матчи уже обработаны в прошлом запуске'
+            return await self.get_checkpoint_file_response(checkpoint)
+        # промежуточная выгрузка читает контрольную точку идущего запуска
+        self._checkpoint = checkpoint
+        try:
+            msg = f'Открываем {self.url}'
+            self.status = msg
+
+            transport = httpx.AsyncHTTPTransport(retries=5)
+            async with httpx.AsyncClient(
+                follow_redirects=True,
+                headers={
+                    'User-Agent': self._user_agent
+                },
+                transport=transport,
+            ) as client:
+                async with self.page_client(client=client) as logged_client:
+                    if logged_client is not None:
+                        self.query_cache = FHBQueryCache(ttl=settings.FHBSTAT_QUERY_CACHE_TTL)
+                        self.prefetch_stats = FHBPrefetchStats(self.speculative_budget)
+                        async with self.queries_limit():
+                            if self.history_mirror:
+                                self.status = 'Обновляем локальную историю матчей'
                                 try:
-                                    df = self.parse_content(response.content)
-                                    df = self.filter_df_by_time(df, self.from_time, self.to_time)
-                                except Exception:
-                                    self.logger.exception('Ошибка сбора данных. Возможно не оплачен тариф.')
-                                    self.status = 'Ошибка сбора данных. Возможно не оплачен тариф.'
+                                    await gather_tasks(*(
+                                        self.update_history(logged_client, target_url)
+                                        for target_url in {
+                                            urlparse(target_url).path: target_url
+                                            for target_url in self.target_urls.values()
+                                        }.values()
+                                    ))
+                                except PyMongoError:
+                                    self.logger.exception('Локальная история недоступна, запросы идут на сайт')
+                            run_checkpoint = checkpoint
+                            if checkpoint.targets is None:
+                                copy_target_urls = list(self.target_urls.values())
+                                targets_records = await gather_tasks(*(
+                                    self.get_listing_records(logged_client, target_url)
+                                    for target_url in copy_target_urls
+                                ))
+                                targets_data = [
+                                    {'target_url': target_url, 'records': data_records or []}
+                                    for target_url, data_records in zip(copy_target_urls, targets_records)
+                                ]
+                                if any(data_records is None for data_records in targets_records) or not any(
+                                    targets_records
+                                ):
+                                    # неполный или пустой список не сохраняем, следующий запуск соберет его заново
+                                    run_checkpoint = None
                                 else:
-                                    if not df.empty:
-                                        dfs.append(df)
-                        future_data = pd.DataFrame()
-                        if dfs:
-                            future_data = pd.concat(dfs)
-                        data_records = future_data.to_dict(orient='records')
-                        self.count_links = len(data_records)
-                        for index, data_match in enumerate(self.tqdm(data_records), 1):
-                            local_match_result_df = []
-                            for user_filter in self.user_filters.root:
-                                filters_data = {}
-                                for _filter in user_filter.filters:
-                                    value_match = data_match.get(str(_filter.column))
-                                    filters_data[str(_filter.column)] = _filter.get_value(value_match)
-                                scheme, domain, path, params, _, fragment = urlparse(_target_url)
-                                priority_queues = sorted(
-                                    filter(
-                                        lambda x: x.priority is not None,
-                                        user_filter.filters
-                                    ),
-                                    key=lambda x: x.priority
+                                    checkpoint.save_targets(targets_data)
+                            else:
+                                targets_data = checkpoint.targets
+                                self.status = (
+                                    f'Продолжаем прерванный запуск, обработано матчей: {len(checkpoint.matches)}'
                                 )
-                                if priority_queues:
-                                    _filters_data = filters_data.copy()
-                                    copy_data_match = dict()
-                                    for priority_filter in priority_queues:
-                                        value_match = data_match.get(str(priority_filter.column))
-                                        data_exist = False
-                                        for next_value in priority_filter.next_value(value_match):
-                                            _filters_data[str(priority_filter.column)] = next_value
-                                            copy_data_match = await self._parse_page_by_filter(
-                                                logged_client,
-                                                browser,
-                                                index,
-                                                data_match,
-                                                _filters_data,
-                                                scheme,
-                                                domain,
-                                                path,
-                                                params,
-                                                fragment,
-                                                target_path
-                                            )
-                                            if copy_data_match['Количество матчей'] >= self.min_count_matches:
-                                                local_match_result_df.append(copy_data_match)
-                                                data_exist = True
-                                                break
-                                        if data_exist:
-                                            break
-                                    if not data_exist:
-                                        if copy_data_match.get('Количество матчей'):
-                                            local_match_result_df.append(copy_data_match)
-                                        else:
-                                            local_match_result_df.append(
-                                                {
-                                                    **{str(i): np.nan for i in self.columns},
-                                                    **{
-                                                        'index': index,
-                                                        'Количество матчей': 0,
-                                                        'url': unquote(
-                                                            urlunparse((
-                                                                scheme,
-                                                                domain,
-                                                                path,
-                                                                params,
-                                                                urlencode(filters_data),
-                                                                fragment
-                                                            ))
-                                                        )
-                                                    },
-                                                    **{str(i): data_match.get(str(i), np.nan) for i in range(11)}
-                                                }
-                                            )
-                                else:
-                                    copy_data_match = await self._parse_page_by_filter(
-                                        logged_client,
-                                        browser,
-                                        index,
-                                        data_match,
-                                        filters_data,
-                                        scheme,
-                                        domain,
-                                        path,
-                                        params,
-                                        fragment,
-                                        target_path
-                                    )
-                                    local_match_result_df.append(copy_data_match)
-                            result_df_list += local_match_result_df
-                            result_df_list.append({
-                                **{str(i): np.nan for i in self.columns},
-                                **{
-                                    'index': index,
-                                    'Количество матчей': '%'
-                                }
-                            })
-                            result_df_list.append({
-                                **{
-                                    str(i): data_match.get(str(i))
-                                    for i in self.columns if i >= self.digits_columns_start
-                                },
-                                **{
-                                    'index': index,
-                                    'Количество матчей': 'кф'
-                                }
-                            })
-                            result_df_list.append({
-                                **{str(i): np.nan for i in self.columns},
-                                **{
-                                    'index': index,
-                                    'Количество матчей': 'мо'
-                                }
-                            })
-                            # Добавляем пустые строки
-                            for _ in range(self.count_empty_rows):
-                                result_df_list.append({
-                                    **{str(i): np.nan for i in self.columns},
-                                    **{'index': index}
-                                })
-                    self.status = 'Генерируем excel файл'
-                    result = await self.async_get_file_response(df_data=result_df_list, target_path=target_path)
-                    return result
+                            targets = []
+                            target_path = None
+                            for target in targets_data:
+                                _target_url, _, target_path = self.get_url_params(target['target_url'])
+                                targets.append((target['records'], urlparse(_target_url), target_path))
+                            self.count_links = sum(len(target['records']) for target in targets_data)
+                            rows = await self.parse_targets_matches(
+                                logged_client,
+                                browser,
+                                targets,
+                                checkpoint=run_checkpoint
+                            )
+                        self.status = self.query_cache.status
+                        if self.history_mirror:
+                            self.status = self.history.status
+                        if self.speculative_prefetch:
+                            self.status = self.prefetch_stats.status
+                        if run_checkpoint is None:
+                            self.status = 'Генерируем excel файл'
+                            result = await self.async_get_file_response(df_data=rows, target_path=target_path)
+                        else:
+                            result = await self.get_checkpoint_file_response(run_checkpoint)
+                        return result
+        finally:
+            self._checkpoint = None
@@ -1,6 +1,6 @@
 import asyncio
 from collections import defaultdict
-from urllib.parse import urlparse
+from urllib.parse import urljoin, urlparse
 
 from bs4 import BeautifulSoup
 from fastapi.responses import PlainTextResponse
@@ -762,9 +762,9 @@ class MarathonbetParser(Parser):
         self.status = msg
         page = await browser.new_page()
         page.set_default_timeout(180000)
-        await page.goto('/')
+        await page.goto(urljoin(self.url, '/'))
         await page.wait_for_load_state()
-        await page.goto('su')
+        await page.goto(urljoin(self.url, 'su'))
         await page.wait_for_load_state()
         msg = 'Ждем окончания проверки браузера'
         self.status = msg
@@ -777,7 +777,7 @@ class MarathonbetParser(Parser):
             return PlainTextResponse('Во время обработки произошла ошибка. Попробуйте позже.')
         else:
             if urlparse(page.url).path != '/su/':
-                await page.goto('su')
+                await page.goto(urljoin(self.url, 'su'))
                 await page.wait_for_load_state()
             try:
                 await page.wait_for_selector(
@@ -817,7 +817,7 @@ class MarathonbetParser(Parser):
                     while attempt < 3:
                         try:
                             player_page = await browser.new_page()
-                            await player_page.goto(player_link)
+                            await player_page.goto(urljoin(self.url, player_link))
                             await player_page.wait_for_load_state()
                             await player_page.wait_for_selector(
                                 '//div[@class="block-market-wrapper"]',
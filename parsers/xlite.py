@@ -7,10 +7,12 @@ from urllib.parse import urljoin, urlparse, urlunparse
 
 import httpx
 
-from base import Parser
+from base import BrowserNeed, Parser
 
 
 class XLiteParser(Parser):
+    browser_need: BrowserNeed = BrowserNeed.NONE
+
     def parser_log_filter(self, record):
         return __name__ == record['name']
 
@@ -424,7 +426,6 @@ class XLiteParser(Parser):
         return result
 
     async def parse(self, browser):
-        await browser.close()
         result = None
         msg = f'Открываем {self.url}'
         self.status = msg
@@ -0,0 +1,65 @@
+from datetime import timedelta
+from pathlib import Path
+from threading import Event
+
+import pandas as pd
+from fastapi.responses import FileResponse
+
+from parsers.betbaza import BetBazaParser
+
+NAMES = ['Дата', 'Страна', 'Лига', 'Команда 1', 'Команда 2', 'Счёт', 'П1', 'Х', 'П2']
+
+
+def get_table_row(values, green):
+    return {'texts': values, 'values': values, 'green': green}
+
+
+def test_get_twins_row():
+    target_table = {
+        'names': NAMES,
+        'rows': [
+            get_table_row(['01.01.30 12:00', 'Англия', 'АПЛ', 'A', 'B', '', '2.1', '3.4', '3.5'], [False] * 9),
+            get_table_row(['01.01.20 12:00', 'Англия', 'АПЛ', 'C', 'D', '1:0', '2.1', '3.4', '3.5'], (
+                [False] * 6 + [True, False, False]
+            )),
+            get_table_row(['02.01.20 12:00', 'Англия', 'АПЛ', 'E', 'F', '1:1', '2.1', '3.4', '3.5'], (
+                [False] * 6 + [False, True, False]
+            )),
+            get_table_row(['03.01.20 12:00', 'Англия', 'АПЛ', 'G', 'H', '2:0', '2.1', '3.4', '3.5'], (
+                [False] * 6 + [True, False, False]
+            )),
+        ]
+    }
+    assert BetBazaParser.get_twins_row(NAMES, target_table) == {
+        'Дата': '01.01.30 12:00',
+        'Страна': 'Англия',
+        'Лига': 'АПЛ',
+        'Команда 1': 'A',
+        'Команда 2': 'B',
+        'Счёт': '',
+        'Количество двойников': 3,
+        'П1': 66.67,
+        'Х': 33.33,
+        'П2': 0.0,
+    }
+    assert BetBazaParser.get_twins_row(NAMES, {'names': NAMES, 'rows': target_table['rows'][:1]}) is None
+    assert BetBazaParser.get_target_id(target_table['rows'][0]['texts']) != (
+        BetBazaParser.get_target_id(target_table['rows'][1]['texts'])
+    )
+
+
+def test_get_file_response():
+    bet_baza_parser = BetBazaParser(is_running=Event())
+    assert bet_baza_parser.get_file_response([]).body.decode() == 'Нет данных'
+    bet_baza_parser.start()
+    now = bet_baza_parser.now_msk.replace(tzinfo=None)
+    rows = [
+        {'Дата': (now + timedelta(days=days)).strftime('%d.%m.%y %H:%M'), 'Количество двойников': days}
+        for days in (2, -1, 1)
+    ]
+    response = bet_baza_parser.get_file_response(rows)
+    bet_baza_parser.stop()
+    assert isinstance(response, FileResponse)
+    df = pd.read_excel(response.path)
+    assert df['Количество двойников'].tolist() == [1, 2]
+    Path(response.path).unlink()
@@ -0,0 +1,121 @@
+from threading import Event
+
+import pytest
+from playwright.async_api import Error as PlaywrightError
+
+from base import BrowserManager, BrowserService, LazyBrowser
+from parsers.fhbstat import FHBParser
+from parsers.marathonbet import MarathonbetParser
+from parsers.xlite import XLiteParser
+
+
+class FakePage:
+    def __init__(self):
+        self.closed = False
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeContext:
+    def __init__(self):
+        self.crashed = False
+        self.closed = False
+        self.pages = []
+
+    async def cookies(self):
+        if self.crashed:
+            raise PlaywrightError('Target closed')
+        return []
+
+    async def new_page(self):
+        page = FakePage()
+        self.pages.append(page)
+        return page
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBrowserService(BrowserService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.contexts = []
+
+    async def _launch(self):
+        self._context = FakeContext()
+        self.contexts.append(self._context)
+        self.count_pages = 0
+
+
+@pytest.mark.asyncio
+async def test_browser_service():
+    service = FakeBrowserService(max_pages=3)
+    await service.start()
+    assert len(service.contexts) == 1
+    lease = await service.acquire()
+    assert lease.pages is service.contexts[0].pages
+    pages = [await lease.new_page() for _ in range(2)]
+    await service.release(lease)
+    assert all(page.closed for page in pages)
+    assert not service.contexts[0].closed
+    # Chrome остается запущенным между запусками
+    lease = await service.acquire()
+    await lease.new_page()
+    await service.release(lease)
+    assert len(service.contexts) == 1
+    # после max_pages страниц Chrome перезапускается
+    lease = await service.acquire()
+    assert len(service.contexts) == 2
+    assert service.contexts[0].closed
+    await service.release(lease)
+    # упавший Chrome перезапускается при следующей выдаче
+    service.contexts[1].crashed = True
+    lease = await service.acquire()
+    assert len(service.contexts) == 3
+    await service.release(lease)
+    await service.stop()
+    assert service.contexts[2].closed
+
+
+@pytest.mark.asyncio
+async def test_browser_manager_service():
+    is_running = Event()
+    service = FakeBrowserService()
+    b_manager = BrowserManager(is_running=is_running, parser=MarathonbetParser(is_running=is_running), service=service)
+    async with b_manager as browser:
+        assert is_running.is_set()
+        assert len(service.contexts) == 1
+        page = await browser.new_page()
+        other_manager = BrowserManager(is_running=is_running, parser=XLiteParser(is_running=is_running))
+        async with other_manager as other_browser:
+            assert other_browser is None
+            assert not other_manager.is_started
+        assert is_running.is_set()
+    assert not is_running.is_set()
+    assert page.closed
+    assert not service.contexts[0].closed
+
+
+@pytest.mark.asyncio
+async def test_browser_manager_browser_need():
+    is_running = Event()
+    service = FakeBrowserService()
+    b_manager = BrowserManager(is_running=is_running, parser=XLiteParser(is_running=is_running), service=service)
+    async with b_manager as browser:
+        assert browser is None
+        assert b_manager.is_started
+        assert is_running.is_set()
+    assert not is_running.is_set()
+    b_manager = BrowserManager(is_running=is_running, parser=FHBParser(is_running=is_running), service=service)
+    async with b_manager as browser:
+        assert isinstance(browser, LazyBrowser)
+        assert not service.contexts
+        page = await browser.new_page()
+        await browser.new_page()
+        assert len(service.contexts) == 1
+    assert page.closed
+    assert not service._leases
@@ -1,14 +1,29 @@
+import asyncio
+import os
 import random
+import re
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from decimal import ROUND_DOWN, Decimal
 from pathlib import Path
 from threading import Event
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+from zipfile import ZipFile
 
+import httpx
 import numpy as np
+import pandas as pd
 import pytest
+from openpyxl import Workbook, load_workbook
+from pandas.testing import assert_frame_equal
 
-from base import BrowserManager
+from base import BrowserManager, LazyBrowser
 from config import settings
-from parsers.fhbstat import (FHBParser, FHBStatFilter, FieldType, FloatField,
-                             TimeField)
+from parsers.fhbstat import (ExcelValues, FHBCheckpoint, FHBHistoryMirror,
+                             FHBParser, FHBPrefetchStats, FHBQueryCache,
+                             FHBSessionRegistry, FHBStatFilter,
+                             FHBTemplateRegistry, FieldType, Filters,
+                             FloatField, TimeField)
 
 
 def test_page():
@@ -21,6 +36,36 @@ def test_page():
     assert not head_df.empty
 
 
+@pytest.mark.parametrize(
+    'source_filename',
+    [
+        'FHB_ Футбол Исход.html',
+        'FHB_ Хоккей Исход.html',
+        'FHB_ Футбол Тотал_2.html',
+    ]
+)
+def test_parse_page(source_filename):
+    file_path = Path(__file__).parent / Path('data') / Path(source_filename)
+    content = file_path.read_text()
+    fhb_page = FHBParser.parse_page(content)
+    soup_page = FHBParser.parse_page(content, fast=False)
+    assert_frame_equal(fhb_page.data, soup_page.data)
+    assert_frame_equal(fhb_page.head, soup_page.head)
+    assert fhb_page.names == soup_page.names
+    assert fhb_page.names == list(fhb_page.head.columns[:-1])
+    assert_frame_equal(FHBParser.parse_page(content.encode()).data, fhb_page.data)
+
+
+def test_parse_page_columns():
+    file_path = Path(__file__).parent / Path('data') / Path('FHB_ Футбол Исход.html')
+    content = file_path.read_text()
+    fhb_page = FHBParser.parse_page(content)
+    columns_page = FHBParser.parse_page(content, columns=(11, 12, 25))
+    assert list(columns_page.data.columns) == ['1', '2', '3', '4', '11', '12', '25', 'dt']
+    assert_frame_equal(columns_page.data, fhb_page.data.loc[:, columns_page.data.columns])
+    assert_frame_equal(columns_page.head, fhb_page.head)
+
+
 @pytest.mark.parametrize(
     'value,round_to,result',
     [
@@ -39,10 +84,19 @@ def test_round(value, round_to, result):
     float_field = FloatField(type=FieldType.FLOAT, filter_value=round_to, column=22)
     if isinstance(value, str):
         value = float(value)
+    assert float_field.get_values(pd.Series([value, np.nan])).tolist()[0] == result
     value = float_field.get_value(value)
     assert value == result
 
 
+def test_round_values():
+    values = pd.Series([round(random.uniform(-5, 60), random.choice([0, 1, 2, 3])) for _ in range(2000)])
+    for round_to in ('0.1', '0.01', '0.', '0', '1.0', '10'):
+        float_field = FloatField(type=FieldType.FLOAT, filter_value=round_to, column=22)
+        for next_values, filter_value in zip(float_field.next_values(values), (round_to, round_to[:-1])):
+            assert next_values.tolist() == [float_field.get_value(value, filter_value) for value in values]
+
+
 @pytest.mark.parametrize(
     'value,round_to,result',
     [
@@ -53,6 +107,7 @@ def test_round(value, round_to, result):
 )
 def test_round_datetime(value, round_to, result):
     time_field = TimeField(type=FieldType.TIME, filter_value=round_to, column=4)
+    assert time_field.get_values(pd.Series([value, np.nan])).tolist()[0] == result
     value = time_field.get_value(value)
     assert value == result
 
@@ -132,6 +187,115 @@ def test_mathematical_expectation(data_means, data_match, result):
         np.testing.assert_approx_equal(res[key], result[key])
 
 
+@pytest.mark.parametrize(
+    'value,digits,result',
+    [
+        (0.29, 2, 0.29),
+        (0.8 * 1.3 - 1, 2, 0.04),
+        (2.3999, 2, 2.39),
+        (2.3999, 1, 2.3),
+        (-0.456, 2, -0.45),
+        (np.nan, 2, np.nan),
+    ]
+)
+def test_round_down(value, digits, result):
+    np.testing.assert_equal(FHBParser.round_down(pd.Series([value]), digits).tolist(), [result])
+
+
+def get_round_down(value, digits):
+    return float(Decimal(value).quantize(Decimal(10) ** -digits, rounding=ROUND_DOWN))
+
+
+def get_data_content(filename):
+    return (Path(__file__).parent / Path('data') / Path(filename)).read_text()
+
+
+def get_fhbstat_parser(filter_filename='П1 (футбол)  новый парсер.json'):
+    fhbstat_parser = FHBParser(is_running=Event())
+    fhbstat_parser.upload_filters_from_json(Path(__file__).parent / Path('data') / Path(filter_filename))
+    return fhbstat_parser
+
+
+def get_mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+class PageHandler:
+    """Отдает на любой запрос одну и ту же страницу и запоминает запросы"""
+
+    def __init__(self, content):
+        self.content = content
+        self.requests = []
+
+    async def __call__(self, request):
+        self.requests.append(request)
+        return httpx.Response(200, text=self.content)
+
+
+def test_fill_aggregates():
+    fhbstat_parser = get_fhbstat_parser()
+    target = '/football'
+    data = get_result_rows(fhbstat_parser, target, count_matches=3)
+    data[0]['25'] = np.nan
+    for row in data:
+        if row.get('Количество матчей') == 'кф':
+            row.update({'25': 1.5, '26': 2.58, '27': 3.1})
+    df = fhbstat_parser.fill_aggregates(pd.DataFrame.from_records(data), target)
+    for index in range(1, 4):
+        filter_rows = [
+            row for row in data if row['index'] == index and isinstance(row.get('Количество матчей'), int)
+        ]
+        total_count = sum(row['Количество матчей'] for row in filter_rows)
+        block = df[df['index'] == index].set_index('Количество матчей', drop=False)
+        for column, digits in (('25', 2), ('26', 2), ('27', 2), ('11', 1), ('16', 1)):
+            mean = sum(
+                (0 if np.isnan(row[column]) else row[column]) * row['Количество матчей'] for row in filter_rows
+            ) / total_count
+            percent = get_round_down(mean, digits)
+            assert block.loc['%', column] == pytest.approx(percent)
+            if digits == 2:
+                odds = block.loc['кф', column]
+                assert block.loc['мо', column] == pytest.approx(get_round_down(percent / 100 * odds - 1, 2))
+        assert np.isnan(block.loc['мо', '28'])
+    documents = fhbstat_parser.get_aggregates_documents(df, target)
+    assert [document['index'] for document in documents] == [1, 2, 3]
+    assert documents[0]['target_path'] == target
+    assert documents[0]['match']['1'] == 19
+    assert documents[0]['odds'] == {'25': 1.5, '26': 2.58, '27': 3.1}
+    assert documents[0]['means']['25'] == df[df['Количество матчей'] == '%'].iloc[0]['25']
+    assert documents[0]['expectations'].keys() == {'25', '26', '27'}
+
+
+@pytest.mark.parametrize(
+    'excel_values,sheet_names',
+    [
+        (ExcelValues.FORMULAS, ['Футбол исход']),
+        (ExcelValues.VALUES, ['Футбол исход']),
+        (ExcelValues.BOTH, ['Футбол исход', 'Футбол исход (значения)']),
+    ]
+)
+def test_get_file_response_excel_values(excel_values, sheet_names):
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.excel_values = excel_values
+    fhbstat_parser.file_name = f'test_excel_values_{excel_values.name}'
+    data = get_result_rows(fhbstat_parser, '/football', count_matches=2)
+    fhbstat_parser.start()
+    response = fhbstat_parser.get_file_response(data, '/football')
+    fhbstat_parser.stop()
+    workbook = load_workbook(response.path)
+    assert workbook.sheetnames == sheet_names
+    percent_row = 8 + len(fhbstat_parser.user_filters.root)
+    for sheet in workbook.worksheets:
+        assert sheet.cell(percent_row, 25).value == '%'
+        assert len(sheet.merged_cells.ranges) == len(workbook.worksheets[0].merged_cells.ranges)
+        values = [sheet.cell(percent_row, column).value for column in (13, 26)]
+        if excel_values == ExcelValues.FORMULAS or sheet.title == 'Футбол исход' and excel_values == ExcelValues.BOTH:
+            assert all(value.startswith('=ROUNDDOWN(') for value in values)
+        else:
+            assert all(isinstance(value, (int, float)) for value in values)
+    Path(response.path).unlink()
+
+
 @pytest.mark.parametrize(
     'data,target,file_name',
     [
@@ -261,26 +425,9 @@ def test_get_file_response(data, target, file_name):
     Path(response.path).unlink()
 
 
-@pytest.mark.parametrize(
-    'target,file_name',
-    [
-        ('/hockey_24', 'test1'),
-        ('/football_24', 'test2'),
-        ('/football', 'test3'),
-        ('/hockey', 'test4'),
-        ('/football_total', 'test5'),
-        ('/hockey_total', 'test6'),
-    ]
-)
-@pytest.mark.asyncio
-async def test_get_file_response_merge_cells(target, file_name):
-    is_running = Event()
-    fhbstat_parser = FHBParser(is_running=is_running)
+def get_result_rows(fhbstat_parser, target, count_matches=10):
     data = []
-    fhbstat_parser.upload_filters_from_json(
-        Path(__file__).parent / Path('data') / Path('П1 (футбол)  новый парсер.json')
-    )
-    for i in range(1, 10 + 1):
+    for i in range(1, count_matches + 1):
         for _ in range(len(fhbstat_parser.user_filters.root)):
             data.append(
                 {
@@ -335,32 +482,48 @@ async def test_get_file_response_merge_cells(target, file_name):
                     }
                 }
             )
-        for _ in range(fhbstat_parser.count_empty_rows):
-            data.append(
-                {
-                    '1': np.nan,
-                    '2': np.nan,
-                    '3': np.nan,
-                    '4': np.nan,
-                    '7': np.nan,
-                    '8': np.nan,
-                    '9': np.nan,
-                    '10': np.nan,
-                    'index': i,
-                    'url': 'https://fhbstat.com/hockey_24?1=19&2=12&3=2025',
-                    **{
-                        str(i): np.nan
-                        for i in range(
-                            fhbstat_parser.digits_columns_start,
-                            fhbstat_parser.count_columns
-                        )
-                    },
-                    **{
-                        str(column): np.nan
-                        for column in fhbstat_parser.get_columns_by_target(target)
-                    }
-                }
-            )
+    return data
+
+
+def test_add_empty_rows():
+    fhbstat_parser = get_fhbstat_parser()
+    rows = get_result_rows(fhbstat_parser, '/football', count_matches=3)
+    block_size = len(rows) // 3
+    df = fhbstat_parser.add_empty_rows(pd.DataFrame.from_records(rows))
+    count_empty_rows = fhbstat_parser.count_empty_rows
+    assert len(df) == len(rows) + 3 * count_empty_rows
+    for number in range(3):
+        first_row = number * (block_size + count_empty_rows)
+        block = df.iloc[first_row:first_row + block_size]
+        assert_frame_equal(
+            block.reset_index(drop=True),
+            pd.DataFrame.from_records(rows[number * block_size:(number + 1) * block_size]).reindex(columns=df.columns)
+        )
+        empty_rows = df.iloc[first_row + block_size:first_row + block_size + count_empty_rows]
+        assert (empty_rows['index'] == number + 1).all()
+        assert empty_rows.drop(columns='index').isna().all(axis=None)
+    assert fhbstat_parser.add_empty_rows(pd.DataFrame()).empty
+
+
+@pytest.mark.parametrize(
+    'target,file_name',
+    [
+        ('/hockey_24', 'test1'),
+        ('/football_24', 'test2'),
+        ('/football', 'test3'),
+        ('/hockey', 'test4'),
+        ('/football_total', 'test5'),
+        ('/hockey_total', 'test6'),
+    ]
+)
+@pytest.mark.asyncio
+async def test_get_file_response_merge_cells(target, file_name):
+    is_running = Event()
+    fhbstat_parser = FHBParser(is_running=is_running)
+    fhbstat_parser.upload_filters_from_json(
+        Path(__file__).parent / Path('data') / Path('П1 (футбол)  новый парсер.json')
+    )
+    data = get_result_rows(fhbstat_parser, target)
     fhbstat_parser.start()
     if file_name:
         fhbstat_parser.file_name = file_name
@@ -375,6 +538,817 @@ async def test_get_file_response_merge_cells(target, file_name):
         assert response.filename == f'{file_name}.xlsx'
 
 
+@pytest.mark.parametrize(
+    'target',
+    ['/football', '/football_24', '/hockey', '/hockey_24', '/football_total', '/hockey_total']
+)
+def test_get_file_response_fast_excel(target):
+    fhbstat_parser = get_fhbstat_parser()
+    data = get_result_rows(fhbstat_parser, target, count_matches=3)
+    data[0]['url'] = None
+    fhbstat_parser.start()
+    contents = []
+    for fast_excel in (False, True):
+        fhbstat_parser.fast_excel = fast_excel
+        fhbstat_parser.file_name = f'test_fast_excel_{fast_excel}'
+        response = fhbstat_parser.get_file_response(data, target)
+        with ZipFile(response.path) as archive:
+            contents.append({
+                name: archive.read(name)
+                for name in archive.namelist()
+                if not name.startswith('docProps/')
+            })
+        Path(response.path).unlink()
+    fhbstat_parser.stop()
+    assert contents[0] == contents[1]
+
+
+@pytest.mark.parametrize(
+    'target',
+    ['/football', '/football_24', '/hockey', '/hockey_24', '/football_total', '/hockey_total']
+)
+def test_template_layout(target):
+    fhbstat_parser = FHBParser(is_running=Event())
+    template_name, sheet_name, tpl_id = fhbstat_parser.get_excel_template(target)
+    template = fhbstat_parser.templates.get_template(fhbstat_parser.get_template_path(template_name))
+    writer = template.copy()
+    writer.render_book2([{'tpl_idx': tpl_id, 'sheet_name': sheet_name, 'ctx': {'rows': [{'index': 1}]}}])
+    layout = fhbstat_parser.get_template_layout(template, tpl_id, template_name, target)
+    assert layout
+    assert layout == fhbstat_parser.get_sheet_layout(writer.workbook[sheet_name].values, template_name, target)
+    assert not template.workbook.worksheets
+    assert writer.workbook.sheetnames == [sheet_name]
+
+
+def test_template_registry(tmp_path):
+    fname = tmp_path / Path('templates.xlsx')
+    fname.write_bytes(FHBParser.get_template_path('templates.xlsx').read_bytes())
+    registry = FHBTemplateRegistry()
+    template = registry.get_template(fname)
+    assert registry.get_template(fname) is template
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert registry.get_template(fname) is not template
+
+
+@pytest.mark.parametrize('count_matches', [0, 1, 3])
+def test_plan_layout(count_matches):
+    fhbstat_parser = get_fhbstat_parser()
+    count_filters = len(fhbstat_parser.user_filters.root)
+    block_size = count_filters + 3 + fhbstat_parser.count_empty_rows
+    start_row, start_column, split_column = 8, 1, 12
+    sheet = Workbook().active
+    values = [''] * count_filters + ['%', 'кф', 'мо'] + [None] * fhbstat_parser.count_empty_rows
+    for i in range(count_matches * block_size):
+        sheet.cell(start_row + i, start_column).value = i // block_size + 1
+        sheet.cell(start_row + i, split_column).value = values[i % block_size]
+    # пустая строка шаблона после данных
+    sheet.cell(start_row + count_matches * block_size, start_column)
+    plan = fhbstat_parser.plan_layout(sheet, start_row, start_column, split_column)
+    first_rows = [start_row + i * block_size for i in range(count_matches)]
+    assert plan.max_rows == start_row + count_matches * block_size
+    assert plan.blocks == [(first_row, first_row + block_size - 1) for first_row in first_rows]
+    assert plan.percent_rows == [first_row + count_filters for first_row in first_rows]
+    assert plan.mo_rows == [first_row + count_filters + 2 for first_row in first_rows]
+
+
+@pytest.mark.parametrize(
+    'source_filename,use_browser',
+    [
+        ('FHB_ Футбол Исход.html', False),
+        # пустая таблица результатов - запрос без матчей, браузер не нужен
+        ('FHB_ Футбол Тотал_2.html', False),
+        # страница без таблицы результатов не догрузилась
+        (None, True),
+    ]
+)
+@pytest.mark.asyncio
+async def test_get_filter_page_content(source_filename, use_browser):
+    if source_filename is None:
+        content = '<html><body><div class="loader"></div></body></html>'
+    else:
+        content = get_data_content(source_filename)
+    fhbstat_parser = FHBParser(is_running=Event())
+    browser_urls = []
+
+    async def get_browser_page_content(logged_client, browser, page_url):
+        browser_urls.append(page_url)
+        return 'browser'
+
+    fhbstat_parser.get_browser_page_content = get_browser_page_content
+    async with get_mock_client(PageHandler(content)) as client:
+        page_content = await fhbstat_parser.get_filter_page_content(
+            client, None, 'https://fhbstat.com/football?7=1'
+        )
+    if use_browser:
+        assert page_content == 'browser'
+        assert browser_urls == ['https://fhbstat.com/football?7=1']
+    else:
+        assert page_content == content
+        assert not browser_urls
+
+
+@pytest.mark.asyncio
+async def test_get_filter_page_content_empty_table():
+    content = get_data_content('FHB_ Футбол Тотал_2.html')
+    fhbstat_parser = FHBParser(is_running=Event())
+
+    async def launch():
+        raise AssertionError('Браузер не должен запускаться')
+
+    browser = LazyBrowser(launch)
+    async with get_mock_client(PageHandler(content)) as client:
+        page_content = await fhbstat_parser.get_filter_page_content(
+            client, browser, 'https://fhbstat.com/football?7=1'
+        )
+    assert page_content == content
+    assert not browser.is_started
+    assert FHBParser.parse_page(page_content).data.empty
+
+
+@pytest.mark.parametrize('concurrent_queries', [1, 4])
+@pytest.mark.asyncio
+async def test_parse_matches_order(concurrent_queries):
+    content = get_data_content('FHB_ Футбол Исход.html')
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.concurrent_queries = concurrent_queries
+    data_records = FHBParser.parse_page(content).data.head(5).to_dict(orient='records')
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(random.uniform(0, 0.01))
+        in_flight -= 1
+        return httpx.Response(200, text=content)
+
+    fhbstat_parser.start()
+    fhbstat_parser.count_links = len(data_records)
+    async with get_mock_client(handler) as client:
+        rows = await fhbstat_parser.parse_matches(
+            client,
+            None,
+            data_records,
+            urlparse('https://fhbstat.com/football'),
+            '/football'
+        )
+    fhbstat_parser.stop()
+    assert max_in_flight == concurrent_queries
+    count_filters = len(fhbstat_parser.user_filters.root)
+    block_size = count_filters + 3
+    assert len(rows) == block_size * len(data_records)
+    for index, data_match in enumerate(data_records, 1):
+        block = rows[(index - 1) * block_size:index * block_size]
+        assert all(row['index'] == index for row in block)
+        for row, user_filter in zip(block, fhbstat_parser.user_filters.root):
+            filters_data = fhbstat_parser.get_filters_data(user_filter, data_match)
+            assert row['url'] == unquote(f'https://fhbstat.com/football?{urlencode(filters_data)}')
+        assert [row.get('Количество матчей') for row in block[count_filters:]] == ['%', 'кф', 'мо']
+        assert all(len(row) <= 2 for row in block[count_filters:] if row.get('Количество матчей') != 'кф')
+        assert all(int(column) >= fhbstat_parser.digits_columns_start for column in block[count_filters + 1] if (
+            column.isdigit()
+        ))
+    assert fhbstat_parser.columns is fhbstat_parser.columns
+
+
+@pytest.mark.parametrize(
+    'min_count_matches,speculative_budget',
+    [
+        (1, 200),
+        (10 ** 6, 200),
+        (10 ** 6, 2),
+    ]
+)
+@pytest.mark.asyncio
+async def test_parse_matches_speculative_prefetch(min_count_matches, speculative_budget):
+    content = get_data_content('FHB_ Футбол Исход.html')
+    data_records = FHBParser.parse_page(content).data.head(3).to_dict(orient='records')
+
+    async def handler(request):
+        await asyncio.sleep(random.uniform(0, 0.01))
+        return httpx.Response(200, text=content)
+
+    results = []
+    for speculative_prefetch in (False, True):
+        fhbstat_parser = get_fhbstat_parser()
+        fhbstat_parser.concurrent_queries = 4
+        fhbstat_parser.min_count_matches = min_count_matches
+        fhbstat_parser.speculative_prefetch = speculative_prefetch
+        fhbstat_parser.prefetch_stats = FHBPrefetchStats(speculative_budget)
+        fhbstat_parser.start()
+        fhbstat_parser.count_links = len(data_records)
+        async with get_mock_client(handler) as client:
+            results.append(
+                await fhbstat_parser.parse_matches(
+                    client,
+                    None,
+                    data_records,
+                    urlparse('https://fhbstat.com/football'),
+                    '/football'
+                )
+            )
+        fhbstat_parser.stop()
+    assert_frame_equal(pd.DataFrame(results[0]), pd.DataFrame(results[1]))
+    stats = fhbstat_parser.prefetch_stats
+    count_priority_filters = sum(
+        any(_filter.priority is not None for _filter in user_filter.filters)
+        for user_filter in fhbstat_parser.user_filters.root
+    )
+    assert stats.requests == min(speculative_budget, count_priority_filters * len(data_records))
+    if min_count_matches == 1:
+        assert stats.wasted == stats.requests
+    else:
+        assert stats.wasted == 0
+        assert stats.saved >= 0
+
+
+@pytest.mark.asyncio
+async def test_parse_matches_shared_prefetch():
+    content = get_data_content('FHB_ Футбол Исход.html')
+    data_records = FHBParser.parse_page(content).data.head(2).to_dict(orient='records')
+    data_records[0]['25'] = 1.55
+    data_records[1]['25'] = 1.45
+    fhbstat_parser = FHBParser(is_running=Event())
+    fhbstat_parser.user_filters = Filters.model_validate([
+        {'filter_id': 1, 'filters': [{'filter_value': '0.1', 'column': 25, 'priority': 1, 'type': FieldType.FLOAT}]}
+    ])
+    fhbstat_parser.concurrent_queries = 4
+    fhbstat_parser.min_count_matches = 5
+    fhbstat_parser.speculative_prefetch = True
+    fhbstat_parser.prefetch_stats = FHBPrefetchStats(200)
+    counts = {'1.5': 10, '1.4': 1, '1.': 20}
+    requested = []
+
+    async def query_filter(logged_client, browser, page_url, target_path):
+        value = parse_qs(urlparse(page_url).query)['25'][0]
+        requested.append(value)
+        # общий для обоих матчей запрос понижения идет дольше, чем проходящий запрос первого матча
+        await asyncio.sleep(0.05 if value == '1.' else 0.01)
+        return {'head': {}, 'means': {}, 'count': counts[value]}
+
+    fhbstat_parser.query_filter = query_filter
+    fhbstat_parser.start()
+    fhbstat_parser.count_links = len(data_records)
+    rows = await fhbstat_parser.parse_matches(
+        None,
+        None,
+        data_records,
+        urlparse('https://fhbstat.com/football'),
+        '/football'
+    )
+    fhbstat_parser.stop()
+    # понижение первого матча не нужно ему самому, но доезжает до второго матча через кэш
+    assert [row['Количество матчей'] for row in rows if row.get('url')] == [10, 20]
+    assert sorted(requested) == ['1.', '1.4', '1.5']
+    assert fhbstat_parser.prefetch_stats.wasted == 1
+
+
+@pytest.mark.asyncio
+async def test_parse_matches_cancel_on_error():
+    content = get_data_content('FHB_ Футбол Исход.html')
+    data_records = FHBParser.parse_page(content).data.head(5).to_dict(orient='records')
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.concurrent_queries = 4
+    fhbstat_parser.speculative_prefetch = True
+    fhbstat_parser.prefetch_stats = FHBPrefetchStats(200)
+    count_requests = 0
+
+    async def handler(request):
+        nonlocal count_requests
+        count_requests += 1
+        if count_requests == 3:
+            raise httpx.ConnectError('Сайт недоступен', request=request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, text=content)
+
+    fhbstat_parser.start()
+    fhbstat_parser.count_links = len(data_records)
+    async with get_mock_client(handler) as client:
+        with pytest.raises(httpx.ConnectError):
+            await fhbstat_parser.parse_matches(
+                client,
+                None,
+                data_records,
+                urlparse('https://fhbstat.com/football'),
+                '/football'
+            )
+        # после ошибки остальные запросы матчей отменены и новых не появляется
+        count_after_error = count_requests
+        await asyncio.sleep(0.1)
+        assert count_requests == count_after_error
+    fhbstat_parser.stop()
+
+
+def test_checkpoint(tmp_path):
+    content = get_data_content('FHB_ Футбол Исход.html')
+    data_records = FHBParser.parse_page(content).data.head(3).to_dict(orient='records')
+    checkpoint = FHBCheckpoint(tmp_path / Path('run.jsonl'))
+    checkpoint.load()
+    assert checkpoint.targets is None
+    assert not checkpoint.is_complete
+    checkpoint.save_targets([{'target_url': 'https://fhbstat.com/football', 'records': data_records}])
+    checkpoint.save_match(2, [{**data_records[1], 'index': 2, '25': np.nan, 'Количество матчей': np.int64(5)}])
+    checkpoint.save_match(1, [{**data_records[0], 'index': 1, 'Количество матчей': '%'}])
+    with checkpoint.path.open('a') as f:
+        f.write('{"index": 3, "rows": [{"ind')
+    size = checkpoint.path.stat().st_size
+
+    reader = FHBCheckpoint(checkpoint.path)
+    reader.load(truncate=False)
+    assert reader.matches == {1, 2}
+    assert [row['index'] for row in reader.rows] == [1, 2]
+    assert checkpoint.path.stat().st_size == size
+
+    restored = FHBCheckpoint(checkpoint.path)
+    restored.load()
+    assert restored.count_matches == 3
+    assert sorted(restored.matches) == [1, 2]
+    assert not restored.is_complete
+    assert restored.targets[0]['records'][0]['dt'] == data_records[0]['dt']
+    assert [row['index'] for row in restored.rows] == [1, 2]
+    assert restored.rows[1]['Количество матчей'] == 5
+    assert np.isnan(restored.rows[1]['25'])
+    restored.save_match(3, [{'index': 3}])
+
+    completed = FHBCheckpoint(checkpoint.path)
+    completed.load()
+    assert completed.is_complete
+    completed.remove()
+    assert not checkpoint.path.exists()
+
+
+@pytest.mark.asyncio
+async def test_parse_targets_matches_checkpoint(tmp_path):
+    content = get_data_content('FHB_ Футбол Исход.html')
+    data_records = FHBParser.parse_page(content).data.head(4).to_dict(orient='records')
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.checkpoints_path = tmp_path
+    fhbstat_parser.start()
+    checkpoint = fhbstat_parser.get_checkpoint()
+    checkpoint.save_targets([{'target_url': 'https://fhbstat.com/football', 'records': data_records}])
+    handler = PageHandler(content)
+    targets = [(data_records, urlparse('https://fhbstat.com/football'), '/football')]
+    async with get_mock_client(handler) as client:
+        assert await fhbstat_parser.parse_targets_matches(client, None, targets, checkpoint=checkpoint) is None
+        assert handler.requests
+        assert checkpoint.is_complete
+        rows = checkpoint.rows
+        assert [row['index'] for row in rows[::len(rows) // 4]] == [1, 2, 3, 4]
+
+        lines = checkpoint.path.read_text().splitlines()
+        checkpoint.path.write_text('\n'.join(lines[:3]) + '\n')
+        restored = fhbstat_parser.get_checkpoint()
+        assert sorted(restored.matches) == [1, 2]
+        handler.requests.clear()
+        fhbstat_parser.query_cache = FHBQueryCache()
+        await fhbstat_parser.parse_targets_matches(client, None, targets, checkpoint=restored)
+        assert handler.requests
+        assert restored.is_complete
+        assert_frame_equal(pd.DataFrame(restored.rows), pd.DataFrame(rows))
+
+        handler.requests.clear()
+        completed = fhbstat_parser.get_checkpoint()
+        assert completed.is_complete
+        await fhbstat_parser.parse_targets_matches(client, None, targets, checkpoint=completed)
+        assert not handler.requests
+    fhbstat_parser.stop()
+
+
+@pytest.mark.parametrize('listing_content', ['<html><body>Тариф не оплачен</body></html>', None])
+@pytest.mark.asyncio
+async def test_parse_without_matches_checkpoint(tmp_path, listing_content):
+    if listing_content is None:
+        listing_content = get_data_content('FHB_ Футбол Тотал_2.html')
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.checkpoints_path = tmp_path
+    fhbstat_parser.target_urls['1'] = 'https://fhbstat.com/football'
+    fhbstat_parser.start()
+    # точка без матчей от прошлых версий не считается законченным запуском
+    fhbstat_parser.get_checkpoint().save_targets([{'target_url': 'https://fhbstat.com/football', 'records': []}])
+    handler = PageHandler(listing_content)
+
+    @asynccontextmanager
+    async def page_client(client):
+        async with get_mock_client(handler) as logged_client:
+            yield logged_client
+
+    fhbstat_parser.page_client = page_client
+    for _ in range(2):
+        handler.requests.clear()
+        response = await fhbstat_parser.parse(None)
+        assert response.body.decode() == 'Не собрали данных.'
+        # ошибочный или пустой список не сохраняется, следующий запуск снова идет на сайт
+        assert handler.requests
+        assert not list(tmp_path.iterdir())
+    fhbstat_parser.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_partial_file_response(tmp_path):
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.checkpoints_path = tmp_path
+    fhbstat_parser.file_name = 'test_partial'
+    fhbstat_parser.start()
+    response = await fhbstat_parser.get_partial_file_response()
+    assert response.body.decode() == 'Не собрали данных.'
+
+    rows = get_result_rows(fhbstat_parser, '/football', count_matches=3)
+    block_size = len(rows) // 3
+    checkpoint = fhbstat_parser.get_checkpoint()
+    checkpoint.save_targets([{'target_url': 'https://fhbstat.com/football', 'records': [{}, {}, {}]}])
+    checkpoint.save_match(2, rows[block_size:2 * block_size])
+    with checkpoint.path.open('a') as f:
+        f.write('{"index": 1, "rows": [{"ind')
+    size = checkpoint.path.stat().st_size
+
+    response = await fhbstat_parser.get_partial_file_response()
+    assert response.filename == 'test_partial_partial.xlsx'
+    assert checkpoint.path.stat().st_size == size
+    sheet = load_workbook(response.path).active
+    assert sheet.cell(8, 2).value == 2
+    assert sheet.cell(8 + block_size + fhbstat_parser.count_empty_rows, 2).value is None
+    Path(response.path).unlink()
+    fhbstat_parser.stop()
+
+    # прерванный запуск выгружается и после stop(), и новым экземпляром после перезапуска сервера
+    restarted_parser = get_fhbstat_parser()
+    restarted_parser.checkpoints_path = tmp_path
+    for _parser in (fhbstat_parser, restarted_parser):
+        _parser.file_name = None
+        response = await _parser.get_partial_file_response()
+        assert response.filename.endswith('_partial.xlsx')
+        assert load_workbook(response.path).active.cell(8, 2).value == 2
+        Path(response.path).unlink()
+
+
+@pytest.mark.parametrize(
+    'concurrent_queries,count_pages,last_page_number',
+    [
+        (1, 3, None),
+        (4, 3, None),
+        (4, 9, None),
+        (4, 2, 2),
+        (3, 5, 5),
+    ]
+)
+@pytest.mark.asyncio
+async def test_get_listing_records(concurrent_queries, count_pages, last_page_number):
+    content = get_data_content('FHB_ Футбол Исход.html')
+    empty_content = get_data_content('FHB_ Футбол Тотал_2.html')
+    if last_page_number is not None:
+        content = re.sub(r'data-pagination="\d+"', f'data-pagination="{last_page_number}"', content)
+    fhbstat_parser = FHBParser(is_running=Event())
+    fhbstat_parser.concurrent_queries = concurrent_queries
+    requested_pages = []
+
+    async def handler(request):
+        page_number = int(request.url.params.get('page', 1))
+        requested_pages.append(page_number)
+        assert request.url.params['3'] == '2026'
+        if page_number == 2:
+            return httpx.Response(500)
+        if page_number <= count_pages:
+            return httpx.Response(200, text=content)
+        return httpx.Response(200, text=empty_content)
+
+    async with get_mock_client(handler) as client:
+        async with fhbstat_parser.queries_limit():
+            data_records = await fhbstat_parser.get_listing_records(client, 'https://fhbstat.com/football?3=2026')
+    count_rows = len(FHBParser.parse_page(content).data)
+    assert len(data_records) == count_rows * (count_pages - 1)
+    if last_page_number is None:
+        assert max(requested_pages) <= count_pages + concurrent_queries
+    else:
+        assert max(requested_pages) == last_page_number
+    assert sorted(set(requested_pages)) == list(range(1, max(requested_pages) + 1))
+
+
+@pytest.mark.parametrize(
+    'source_filename,filter_filename',
+    [
+        ('FHB_ Футбол Исход.html', 'П1 (футбол)  новый парсер.json'),
+        ('FHB_ Футбол Исход.html', 'П1 (футбол) новые пробивки.json'),
+        ('FHB_ Хоккей Исход.html', 'П1_(хоккей_чемпионат_урезанные).json'),
+        ('FHB_ Футбол Исход.html', 'download_filters.json'),
+    ]
+)
+def test_plan_queries(source_filename, filter_filename):
+    content = get_data_content(source_filename)
+    fhbstat_parser = get_fhbstat_parser(filter_filename)
+    data = FHBParser.parse_page(content).data
+    plan = fhbstat_parser.plan_queries(data, '/football')
+    query_keys = set()
+    for filter_number, user_filter in enumerate(fhbstat_parser.user_filters.root):
+        for match_number, data_match in enumerate(data.to_dict(orient='records')):
+            filters_data = fhbstat_parser.get_filters_data(user_filter, data_match)
+            assert plan.filters_data[filter_number][match_number] == filters_data
+            priority_queues = sorted(
+                filter(lambda x: x.priority is not None, user_filter.filters),
+                key=lambda x: x.priority
+            )
+            candidates = [filters_data] if not priority_queues else []
+            for priority_filter in priority_queues:
+                for next_value in priority_filter.next_value(data_match.get(str(priority_filter.column))):
+                    filters_data = {**filters_data, str(priority_filter.column): next_value}
+                    candidates.append(filters_data)
+            assert plan.candidates[filter_number][match_number] == candidates
+            query_keys.update(FHBParser.get_query_key('/football', _filters_data) for _filters_data in candidates)
+    assert plan.count_queries == len(query_keys)
+
+
+def test_get_query_key():
+    assert FHBParser.get_query_key('/football', {'1': 16, '50': '1.'}) == (
+        FHBParser.get_query_key('/football', {'50': '1.', '1': '16'})
+    )
+    assert FHBParser.get_query_key('/football', {'50': '1.'}) != FHBParser.get_query_key('/football', {'50': '1.5'})
+    assert FHBParser.get_query_key('/football', {'50': '1.'}) != FHBParser.get_query_key('/hockey_24', {'50': '1.'})
+
+
+@pytest.mark.asyncio
+async def test_query_cache():
+    query_cache = FHBQueryCache()
+    count_fetches = 0
+
+    async def fetch():
+        nonlocal count_fetches
+        count_fetches += 1
+        await asyncio.sleep(0.01)
+        return {'head': {}, 'means': {}, 'count': count_fetches}
+
+    results = await asyncio.gather(*[query_cache.get_or_fetch('a', fetch) for _ in range(5)])
+    assert results == [{'head': {}, 'means': {}, 'count': 1}] * 5
+    assert count_fetches == 1
+    assert (query_cache.hits, query_cache.misses) == (4, 1)
+
+    async def broken_fetch():
+        raise httpx.ConnectError('error')
+
+    with pytest.raises(httpx.ConnectError):
+        await query_cache.get_or_fetch('b', broken_fetch)
+    assert len(query_cache) == 1
+    assert await query_cache.get_or_fetch('b', fetch) == {'head': {}, 'means': {}, 'count': 2}
+
+
+@pytest.mark.asyncio
+async def test_parse_matches_query_cache():
+    content = get_data_content('FHB_ Футбол Исход.html')
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.concurrent_queries = 4
+    data_records = FHBParser.parse_page(content).data.head(3).to_dict(orient='records')
+    handler = PageHandler(content)
+    fhbstat_parser.start()
+    fhbstat_parser.count_links = len(data_records) * 2
+    async with get_mock_client(handler) as client:
+        rows = await fhbstat_parser.parse_matches(
+            client,
+            None,
+            data_records * 2,
+            urlparse('https://fhbstat.com/football'),
+            '/football'
+        )
+    fhbstat_parser.stop()
+    requested_urls = [str(request.url) for request in handler.requests]
+    assert len(requested_urls) == len(set(requested_urls))
+    assert fhbstat_parser.query_cache.misses == len(requested_urls)
+    assert [row['index'] for row in rows[::len(rows) // 6]] == list(range(1, 7))
+    assert fhbstat_parser.query_cache.hits >= len(requested_urls)
+    half = len(rows) // 2
+    for first, second in zip(rows[:half], rows[half:]):
+        assert {k: v for k, v in first.items() if k != 'index'} == {k: v for k, v in second.items() if k != 'index'}
+
+
+@pytest.mark.parametrize(
+    'source_filename,filter_filename',
+    [
+        ('FHB_ Футбол Исход.html', 'П1 (футбол)  новый парсер.json'),
+        ('FHB_ Хоккей Исход.html', 'П1_(хоккей_чемпионат_урезанные).json'),
+        ('FHB_ Футбол Исход.html', 'download_filters.json'),
+    ]
+)
+def test_history_mirror_query(source_filename, filter_filename):
+    content = get_data_content(source_filename)
+    fhbstat_parser = get_fhbstat_parser(filter_filename)
+    data = FHBParser.parse_page(content).data
+    fhbstat_parser.history.set_frame('/football', data)
+    records = data.to_dict(orient='records')
+    plan = fhbstat_parser.plan_queries(data.head(10), '/football')
+    for filter_number, user_filter in enumerate(fhbstat_parser.user_filters.root):
+        fields = {str(_filter.column): _filter for _filter in user_filter.filters}
+        for candidates in plan.candidates[filter_number]:
+            for filters_data in candidates:
+                matched = [
+                    record for record in records
+                    if all(
+                        pd.notna(record.get(column)) and (
+                            fields[column].get_value(record[column], str(filter_value)) == str(filter_value)
+                            if fields[column].type in (FieldType.FLOAT, FieldType.TIME)
+                            else (
+                                FHBHistoryMirror._normalize(record[column]) == FHBHistoryMirror._normalize(filter_value)
+                            )
+                        )
+                        for column, filter_value in filters_data.items()
+                    )
+                ]
+                assert fhbstat_parser.history.count('/football', filters_data) == len(matched)
+                history_result = fhbstat_parser.query_history(filters_data, '/football')
+                assert history_result['count'] == len(matched)
+                assert history_result['means'] == pytest.approx(
+                    FHBParser.get_filter_means(pd.DataFrame(matched, columns=data.columns), '/football'),
+                    nan_ok=True
+                )
+
+
+@pytest.mark.asyncio
+async def test_parse_matches_history_queries():
+    content = get_data_content('FHB_ Футбол Исход.html')
+    data = FHBParser.parse_page(content).data
+    data_records = data.head(3).to_dict(orient='records')
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.history_mirror = True
+    fhbstat_parser.history_queries = True
+    fhbstat_parser.history.set_frame('/football', data)
+
+    async def handler(request):
+        raise AssertionError('Запросы по истории не идут на сайт')
+
+    fhbstat_parser.start()
+    fhbstat_parser.count_links = len(data_records)
+    async with get_mock_client(handler) as client:
+        rows = await fhbstat_parser.parse_matches(
+            client,
+            None,
+            data_records,
+            urlparse('https://fhbstat.com/football'),
+            '/football'
+        )
+    fhbstat_parser.stop()
+    filter_rows = [row for row in rows if row.get('url')]
+    assert len(filter_rows) == len(fhbstat_parser.user_filters.root) * len(data_records)
+    for row in filter_rows:
+        filters_data = {key: values[0] for key, values in parse_qs(urlparse(row['url']).query).items()}
+        history_result = fhbstat_parser.query_history(filters_data, '/football')
+        assert row['Количество матчей'] == history_result['count']
+        for column, value in history_result['means'].items():
+            assert row[column] == pytest.approx(value, nan_ok=True)
+    assert fhbstat_parser.history.hits
+
+
+class FakeHistoryCollection:
+    def __init__(self):
+        self.documents = dict()
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def find(self, query, projection=None):
+        return [document for document in self.documents.values() if document['target_path'] == query['target_path']]
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            document = request._doc
+            self.documents[document['_id']] = document
+
+
+@pytest.mark.asyncio
+async def test_update_history():
+    content = get_data_content('FHB_ Футбол Исход.html')
+    empty_content = get_data_content('FHB_ Футбол Тотал_2.html')
+    count_rows = len(FHBParser.parse_page(content).data)
+    fhbstat_parser = FHBParser(is_running=Event())
+    fhbstat_parser.history._collection = FakeHistoryCollection()
+    pages = {1: content, 2: content, 3: content}
+    requested_pages = []
+
+    async def handler(request):
+        page_number = int(request.url.params.get('page', 1))
+        requested_pages.append(page_number)
+        return httpx.Response(200, text=pages.get(page_number, empty_content))
+
+    fhbstat_parser.start()
+    async with get_mock_client(handler) as client:
+        async with fhbstat_parser.queries_limit():
+            # первая синхронизация листает список целиком
+            await fhbstat_parser.update_history(client, 'https://fhbstat.com/football?3=2026')
+            assert requested_pages == [1, 2, 3, 4]
+            assert len(fhbstat_parser.history.query('/football', {})) == count_rows
+            assert len(fhbstat_parser.history._collection.documents) == count_rows
+
+            # следующие - до первой страницы, матчи которой уже в истории
+            requested_pages.clear()
+            await fhbstat_parser.update_history(client, 'https://fhbstat.com/football')
+            assert requested_pages == [1]
+
+            requested_pages.clear()
+            pages[1] = content.replace('Дорадос Синалоа', 'Новая команда')
+            await fhbstat_parser.update_history(client, 'https://fhbstat.com/football')
+            assert requested_pages == [1, 2]
+            assert len(fhbstat_parser.history.query('/football', {})) == count_rows + 1
+            assert len(fhbstat_parser.history._collection.documents) == count_rows + 1
+
+            # после перезапуска история читается из Mongo и тоже синхронизируется с первой страницы
+            restarted_parser = FHBParser(is_running=Event())
+            restarted_parser.history._collection = fhbstat_parser.history._collection
+            restarted_parser.start()
+            requested_pages.clear()
+            await restarted_parser.update_history(client, 'https://fhbstat.com/football')
+            assert requested_pages == [1]
+            restarted_parser.stop()
+    fhbstat_parser.stop()
+
+
+def test_select_candidates():
+    fhbstat_parser = FHBParser(is_running=Event())
+    fhbstat_parser.start()
+    now = fhbstat_parser.now_msk.replace(tzinfo=None)
+    fhbstat_parser.history.set_frame('/football', pd.DataFrame({
+        '4': ['12:30', '12:45', '13:00', '15:10', '12:05'],
+        '50': [1.55, 1.57, 1.51, 1.9, 1.55],
+        'dt': [now - timedelta(days=days) for days in (1, 2, 3, 4)] + [now + timedelta(days=1)],
+    }))
+    candidates = [{'50': '1.55'}, {'50': '1.5'}, {'50': '1.'}]
+    assert [fhbstat_parser.history.count('/football', c, fhbstat_parser.now_msk) for c in candidates] == [1, 3, 4]
+    assert fhbstat_parser.history.count('/football', {'4': '12:', '50': '1.5'}) == 3
+    assert fhbstat_parser.history.count('/football', {'4': '12:', '50': '1.5'}, fhbstat_parser.now_msk) == 2
+    assert fhbstat_parser.history.count('/football', {'51': '1.'}) == 0
+    fhbstat_parser.min_count_matches = 3
+    assert fhbstat_parser.select_candidates(candidates, '/football') == [{'50': '1.5'}]
+    fhbstat_parser.min_count_matches = 10
+    assert fhbstat_parser.select_candidates(candidates, '/football') == [{'50': '1.'}]
+    assert fhbstat_parser.select_candidates([{'50': '2.'}], '/football') == []
+    assert fhbstat_parser.history.hits == 2 + 2 + 1
+    fhbstat_parser.stop()
+
+
+@pytest.mark.asyncio
+async def test_page_client_session(tmp_path):
+    fhbstat_parser = FHBParser(is_running=Event())
+    fhbstat_parser.sessions = FHBSessionRegistry(tmp_path)
+    fhbstat_parser.email = 'user@example.com'
+    fhbstat_parser.password = 'password'
+    session_ids = []
+    requests = []
+
+    async def handler(request):
+        session_id = request.headers.get('cookie', '').removeprefix('PHPSESSID=') or None
+        if request.method == 'POST':
+            action = parse_qs(request.content.decode())['posts[className]'][0]
+            requests.append(action)
+            if action == 'вход':
+                session_ids.append(f'session{len(session_ids)}')
+                return httpx.Response(200, json={}, headers={'set-cookie': f'PHPSESSID={session_ids[-1]}; Path=/'})
+            session_ids.remove(session_id)
+            return httpx.Response(200, json={})
+        requests.append('проверка')
+        logged_in = session_id in session_ids
+        return httpx.Response(200, text='<a onclick="выход(this)">Выход</a>' if logged_in else '<form></form>')
+
+    async def run():
+        async with get_mock_client(handler) as client:
+            async with fhbstat_parser.page_client(client) as logged_client:
+                assert logged_client is client
+                await asyncio.sleep(0)
+
+    await asyncio.gather(run(), run())
+    assert requests == ['вход']
+    session = fhbstat_parser.sessions.get_session(fhbstat_parser.email)
+    assert session.path.exists()
+    # следующий запуск после check_interval проверяет сессию одним запросом
+    session.checked_at -= session.check_interval
+    await run()
+    assert requests == ['вход', 'проверка']
+    # истекшая на сайте сессия обновляется входом
+    session_ids.clear()
+    session.checked_at -= session.check_interval
+    await run()
+    assert requests == ['вход', 'проверка', 'проверка', 'вход']
+    assert session.cookies == {'PHPSESSID': session_ids[-1]}
+    async with get_mock_client(handler) as client:
+        await fhbstat_parser.close_sessions(client)
+    assert requests[-1] == 'выход'
+    assert not session_ids
+    assert not session.path.exists()
+
+
+def test_copy_for_run():
+    fhbstat_parser = get_fhbstat_parser()
+    fhbstat_parser.email = 'user@example.com'
+    fhbstat_parser.password = 'password'
+    fhbstat_parser.target_urls['1'] = 'https://fhbstat.com/football'
+    run_parser = fhbstat_parser.copy_for_run()
+    assert (run_parser.email, run_parser.password) == ('user@example.com', 'password')
+    assert fhbstat_parser.email is None and fhbstat_parser.password is None
+    # форму можно править, пока запуск идет: копия запуска этого не видит
+    fhbstat_parser.user_filters.root[0].filters.clear()
+    fhbstat_parser.target_urls['2'] = 'https://fhbstat.com/hockey'
+    assert run_parser.user_filters.root[0].filters
+    assert list(run_parser.target_urls.values()) == ['https://fhbstat.com/football']
+    run_parser.start()
+    assert run_parser.now_msk is not None and fhbstat_parser.now_msk is None
+    run_parser.stop()
+
+
 def test_fhbstat_filter():
     filter_instance = FHBStatFilter(
         filter_id=15,
@@ -0,0 +1,239 @@
+import asyncio
+from datetime import datetime, timedelta
+from pathlib import Path
+from threading import Event
+
+import pytest
+import pytz
+from fastapi import HTTPException
+from fastapi.responses import FileResponse
+
+from base import (CronSpec, JobScheduler, JobState, ParserView,
+                  SnapshotScheduler)
+from parsers.marathonbet import MarathonbetParser
+from parsers.xlite import XLiteParser
+from tests.test_browser_service import FakeBrowserService
+
+
+class GateMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # запуски выполняют копии парсера, ворота и счетчики у копий общие с шаблоном
+        self.gate = asyncio.Event()
+        self.counters = {'active': 0, 'max_active': 0}
+
+    async def parse(self, browser):
+        self.counters['active'] += 1
+        self.counters['max_active'] = max(self.counters['max_active'], self.counters['active'])
+        await self.gate.wait()
+        self.counters['active'] -= 1
+        return browser
+
+
+class FirstHTTPParser(GateMixin, XLiteParser):
+    pass
+
+
+class SecondHTTPParser(GateMixin, XLiteParser):
+    pass
+
+
+class FirstBrowserParser(GateMixin, MarathonbetParser):
+    pass
+
+
+class SecondBrowserParser(GateMixin, MarathonbetParser):
+    pass
+
+
+class FailedHTTPParser(FirstHTTPParser):
+    async def parse(self, browser):
+        raise ValueError('Ошибка парсинга')
+
+
+class ResultHTTPParser(FirstHTTPParser):
+    result_dir: Path = None
+
+    async def parse(self, browser):
+        self.count_links = 10
+        self.update_progress(4, 0)
+        await self.gate.wait()
+        self.path = str(self.result_dir / 'result.xlsx')
+        Path(self.path).write_bytes(b'result')
+        return FileResponse(self.path, filename='result.xlsx')
+
+
+@pytest.mark.asyncio
+async def test_job_scheduler_queue():
+    scheduler = JobScheduler(service=FakeBrowserService(), max_http_jobs=2)
+    http_parser = FirstHTTPParser(is_running=Event())
+    other_http_parser = SecondHTTPParser(is_running=Event())
+    first_job = scheduler.submit(http_parser)
+    second_job = scheduler.submit(http_parser)
+    other_job = scheduler.submit(other_http_parser)
+    await asyncio.sleep(0)
+    # запуски одного парсера идут по очереди, разные http-парсеры - одновременно
+    assert first_job.state == JobState.RUNNING
+    assert second_job.state == JobState.QUEUED
+    assert other_job.state == JobState.RUNNING
+    assert scheduler.is_busy(http_parser)
+    assert first_job.parser.is_running
+    assert not second_job.parser.is_running
+    assert first_job.template is http_parser and first_job.parser is not http_parser
+    http_parser.gate.set()
+    other_http_parser.gate.set()
+    assert await first_job.wait() is None
+    assert await second_job.wait() is None
+    assert await other_job.wait() is None
+    assert http_parser.counters['max_active'] == 1
+    assert second_job.started_at >= first_job.finished_at
+    assert not scheduler.is_busy(http_parser)
+    assert not first_job.parser.is_running
+
+
+@pytest.mark.asyncio
+async def test_job_scheduler_browser_profile():
+    service = FakeBrowserService()
+    scheduler = JobScheduler(service=service)
+    browser_parser = FirstBrowserParser(is_running=Event())
+    other_browser_parser = SecondBrowserParser(is_running=Event())
+    http_parser = FirstHTTPParser(is_running=Event())
+    first_job = scheduler.submit(browser_parser)
+    second_job = scheduler.submit(other_browser_parser)
+    http_job = scheduler.submit(http_parser)
+    await asyncio.sleep(0)
+    # профиль браузера один, второй браузерный запуск ждет, http-запуск - нет
+    assert first_job.state == JobState.RUNNING
+    assert second_job.state == JobState.QUEUED
+    assert http_job.state == JobState.RUNNING
+    http_parser.gate.set()
+    await http_job.wait()
+    assert second_job.state == JobState.QUEUED
+    browser_parser.gate.set()
+    other_browser_parser.gate.set()
+    assert await first_job.wait() is not None
+    assert await second_job.wait() is not None
+    assert len(service.contexts) == 1
+
+
+@pytest.mark.asyncio
+async def test_job_scheduler_failed_job():
+    scheduler = JobScheduler()
+    failed_parser = FailedHTTPParser(is_running=Event())
+    job = scheduler.submit(failed_parser)
+    with pytest.raises(ValueError):
+        await job.wait()
+    assert job.state == JobState.FAILED
+    assert not job.parser.is_running
+    # ошибка запуска не держит очередь парсеров с тем же именем
+    http_parser = FirstHTTPParser(is_running=Event())
+    http_parser.gate.set()
+    assert await scheduler.run(http_parser) is None
+
+
+@pytest.mark.asyncio
+async def test_job_result(tmp_path):
+    scheduler = JobScheduler()
+    scheduler.results_dir = tmp_path / 'jobs'
+    http_parser = ResultHTTPParser(is_running=Event())
+    http_parser.result_dir = tmp_path
+    job = scheduler.submit(http_parser)
+    await asyncio.sleep(0)
+    job_data = await scheduler.get_job_data(job.id)
+    assert job_data['state'] == 'RUNNING'
+    assert job_data['progress']['count_links'] == 10
+    assert job_data['progress']['count_processed_links'] == 4
+    with pytest.raises(HTTPException) as exc_info:
+        await scheduler.get_result_response(job.id)
+    assert exc_info.value.status_code == 409
+    http_parser.gate.set()
+    await job.wait()
+    # следующий запуск парсера удаляет свой прошлый файл, файл запуска остается в results_dir
+    job.parser.delete_older_file()
+    for _ in range(2):
+        response = await scheduler.get_result_response(job.id)
+        assert Path(response.path).parent == scheduler.results_dir
+        assert Path(response.path).read_bytes() == b'result'
+        assert response.filename == 'result.xlsx'
+    job_data = await scheduler.get_job_data(job.id)
+    assert job_data['state'] == 'DONE'
+    assert job_data['progress']['count_links'] == 10
+    with pytest.raises(HTTPException) as exc_info:
+        await scheduler.get_result_response('unknown')
+    assert exc_info.value.status_code == 404
+
+
+def test_cron_spec():
+    msk = pytz.timezone('Europe/Moscow')
+    now = msk.localize(datetime(2025, 12, 19, 10, 7, 30))
+    assert CronSpec('*/15 * * * *').get_next(now) == msk.localize(datetime(2025, 12, 19, 10, 15))
+    assert CronSpec('0 8-20/6 * * *').get_next(now) == msk.localize(datetime(2025, 12, 19, 14, 0))
+    assert CronSpec('30 9 * * 1,3').get_next(now) == msk.localize(datetime(2025, 12, 22, 9, 30))
+    assert CronSpec('0 0 1 1 *').get_next(now) == msk.localize(datetime(2026, 1, 1, 0, 0))
+    assert CronSpec('0 12 * * 7').get_next(now) == msk.localize(datetime(2025, 12, 21, 12, 0))
+    with pytest.raises(ValueError):
+        CronSpec('* * * *')
+    with pytest.raises(ValueError):
+        CronSpec('61 * * * *')
+
+
+@pytest.mark.asyncio
+async def test_snapshot_scheduler():
+    scheduler = JobScheduler(service=FakeBrowserService(), max_http_jobs=2)
+    snapshots = SnapshotScheduler(scheduler, max_jobs=1)
+    first = snapshots.add(FirstHTTPParser(is_running=Event()), '*/10 * * * *', 'Ближайшие 2 часа')
+    second = snapshots.add(SecondHTTPParser(is_running=Event()), '*/10 * * * *', 'Ближайший час')
+    assert first.parser.history_only
+    assert first.parser.radio_period == 'Ближайшие 2 часа'
+    assert snapshots.get_snapshots(FirstHTTPParser(is_running=Event())) == [first]
+    now = first.next_run
+    assert snapshots.tick(now - timedelta(minutes=1)) == []
+    # бюджет - один слепок: второй ждет, пока первый не закончится
+    jobs = snapshots.tick(now)
+    assert [job.template for job in jobs] == [first.parser]
+    assert snapshots.tick(now + timedelta(minutes=1)) == []
+    # первый слепок еще идет: следующее срабатывание его расписания не ставит второй запуск
+    assert snapshots.tick(first.next_run) == []
+    assert 'выполняется' in first.info
+    first.parser.gate.set()
+    await jobs[0].wait()
+    jobs = snapshots.tick(first.next_run)
+    assert [job.template for job in jobs] == [second.parser]
+    assert first.last_state == JobState.DONE
+    assert first.last_duration is not None
+    second.parser.gate.set()
+    await jobs[0].wait()
+    jobs = snapshots.tick(first.next_run)
+    assert [job.template for job in jobs] == [first.parser]
+    await jobs[0].wait()
+
+
+@pytest.mark.asyncio
+async def test_job_parser_state(tmp_path):
+    scheduler = JobScheduler()
+    scheduler.results_dir = tmp_path / 'jobs'
+    http_parser = ResultHTTPParser(is_running=Event())
+    http_parser.result_dir = tmp_path
+    view = ParserView(scheduler, http_parser)
+    assert view.parser is http_parser
+    assert view.count_links == 'Количество ссылок: -'
+    http_parser.radio_period = 'Ближайший час'
+    first_job = scheduler.submit(http_parser)
+    # настройки формы копируются при постановке, их изменение не трогает уже поставленный запуск
+    http_parser.radio_period = '24 часа'
+    second_job = scheduler.submit(http_parser)
+    await asyncio.sleep(0)
+    assert first_job.parser.radio_period == 'Ближайший час'
+    assert second_job.parser.radio_period == '24 часа'
+    # у каждого запуска свое состояние, у парсера формы и ждущего запуска его нет
+    assert view.parser is first_job.parser
+    assert view.count_links == 'Количество ссылок: 10'
+    assert http_parser.get_progress()['count_links'] is None
+    assert (await scheduler.get_job_data(first_job.id))['progress']['count_processed_links'] == 4
+    assert (await scheduler.get_job_data(second_job.id))['progress'] == {}
+    http_parser.gate.set()
+    await first_job.wait()
+    await second_job.wait()
+    assert view.parser is second_job.parser
+    assert first_job.progress['count_links'] == 10
+    assert first_job.result.path != second_job.result.path
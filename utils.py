@@ -1,7 +1,8 @@
+import asyncio
 import calendar
 import locale
 from pathlib import Path
-from typing import Any, Iterator, Optional, Sequence, Union
+from typing import Any, Awaitable, Iterator, List, Optional, Sequence, Union
 
 import pymongo.errors
 import yaml
@@ -31,6 +32,23 @@ def parse_date_str(date: str):
     return parsed_date
 
 
+async def gather_tasks(*aws: Awaitable) -> List[Any]:
+    """asyncio.gather, который при ошибке одной задачи отменяет остальные и дожидается их завершения
+
+    Ошибка пробрасывается как есть, а не ExceptionGroup, как у asyncio.TaskGroup.
+    """
+
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
 def get_saved_url(fname):
     url = None
     saved_url = Path(fname)